@@ -0,0 +1,675 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2019 Caleb Robinson <calebrob6@gmail.com>
+#
+# Distributed under terms of the MIT license.
+'''
+Fast calibration of the parameters of the models in `MigrationModels`.
+
+The models are calibrated as in the "Train migration models" notebook: the model probabilities P are row normalized and scaled by
+the production function, T_pred = beta * origins * P / P.sum(axis=1), and alpha (and optionally beta) are fit by maximizing the CPC
+between T_pred and the observed flows T. After row normalization every factor of P that only depends on the origin cancels out, so each
+calibrator only computes the destination dependent "weights" W of its model, from terms that are precomputed once (logarithms of the
+distances or intervening opportunities, masks, ...), together with the analytic derivative of W with respect to alpha. This gives the
+analytic gradient of the objective, which is passed to a gradient based optimizer.
+'''
+import os
+import glob
+import json
+import time
+import hashlib
+import shutil
+import tempfile
+import collections
+import concurrent.futures
+
+import numpy as np
+import pandas as pd
+import scipy.optimize
+import scipy.sparse
+
+import MigrationData
+import MigrationModels
+import MigrationEvaluationMethods
+
+class ModelCalibrator(object):
+    '''Base class of the calibrators, subclasses implement `getWeights(alpha)` which returns (W, dW/dalpha).
+
+    The (n x m) work arrays are allocated once and reused by every evaluation, so the arrays returned by `getWeights` are only valid
+    until the next call.
+
+    Inputs:
+        origins - (n x 1) origin populations
+        T - (n x m) observed flows
+        beta - value of the production function parameter, used when it is not fit
+    '''
+    def __init__(self, origins, T, beta):
+        assert len(origins.shape) == 2 and origins.shape[1] == 1, "`origins` must be 2D with a single column"
+        assert len(T.shape) == 2 and T.shape[0] == origins.shape[0], "`T` must have one row per origin"
+
+        self.origins = origins.astype(float)[:,0]
+        self.T = T.astype(float)
+        self.sumT = self.T.sum()
+        self.beta = beta
+
+        self.W = np.empty(T.shape, dtype=float)
+        self.dW = np.empty(T.shape, dtype=float)
+        self.G = np.empty(T.shape, dtype=float)
+        self.mask = np.empty(T.shape, dtype=bool)
+
+    def getWeights(self, alpha):
+        raise NotImplementedError()
+
+    def getScale(self, R):
+        '''Returns origins / R, the factor that turns rows of W into rows of T_pred for beta = 1. Rows of W that sum to 0 are left at 0.
+        '''
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.where(R > 0, self.origins / R, 0.0)
+
+    def predict(self, alpha, beta=None):
+        '''Returns the calibrated flows T_pred for the given parameters (as a new array).
+        '''
+        if beta is None:
+            beta = self.beta
+        W, _ = self.getWeights(alpha)
+        return W * (beta * self.getScale(W.sum(axis=1)))[:,None]
+
+    def objective(self, params):
+        '''Returns -CPC(T, T_pred) for params = [alpha] or [alpha, beta].
+        '''
+        return self.objectiveAndGradient(params)[0]
+
+    def objectiveAndGradient(self, params):
+        '''Returns -CPC(T, T_pred) and its gradient with respect to params = [alpha] or [alpha, beta].
+        '''
+        alpha = params[0]
+        beta = params[1] if len(params) > 1 else self.beta
+
+        W, dW = self.getWeights(alpha)
+        R = W.sum(axis=1)
+        dR = dW.sum(axis=1)
+        scale = self.getScale(R)
+
+        # T_pred = beta * H with H = scale * W, sum(H) is the sum of the origins of the rows that aren't empty
+        G, mask = self.G, self.mask
+        np.multiply(W, (beta * scale)[:,None], out=G)
+        np.less(G, self.T, out=mask) # entries where min(T_pred, T) = T_pred, i.e. where the CPC numerator changes with T_pred
+        maskedW = np.einsum("ij,ij->i", W, mask)
+        maskeddW = np.einsum("ij,ij->i", dW, mask)
+        M = np.minimum(G, self.T, out=G).sum()
+        sumH = np.sum(self.origins[R > 0])
+        denominator = self.sumT + beta * sumH
+
+        f = -2.0 * M / denominator
+
+        # dH/dalpha = scale * (dW - W * dR / R), sum(H) does not depend on alpha as the rows of W are normalized
+        with np.errstate(divide="ignore", invalid="ignore"):
+            dM = beta * np.sum(scale * (maskeddW - np.where(R > 0, dR / R, 0.0) * maskedW))
+        gradient = [-2.0 * dM / denominator]
+
+        if len(params) > 1:
+            maskedH = np.sum(scale * maskedW)
+            gradient.append(-2.0 * (maskedH * denominator - M * sumH) / denominator**2)
+
+        return f, np.array(gradient)
+
+    def fit(self, x0=1.0, bounds=(0, 3), fitBeta=False, betaBounds=(0, None), method="L-BFGS-B", **kwargs):
+        '''Fits alpha (and beta if `fitBeta` is True) with `scipy.optimize.minimize` using the analytic gradient.
+
+        returns: the `scipy.optimize.OptimizeResult`, where `x` is [alpha] or [alpha, beta]
+        '''
+        x0 = [x0, self.beta] if fitBeta else [x0]
+        allBounds = [bounds, betaBounds] if fitBeta else [bounds]
+        return scipy.optimize.minimize(self.objectiveAndGradient, x0=x0, jac=True, bounds=allBounds, method=method, **kwargs)
+
+class GravityCalibrator(ModelCalibrator):
+    '''Calibrator for `MigrationModels.gravityModel`, W = destinations * d**-alpha (power) or destinations * exp(-alpha * d) (exponential),
+    and W = 0 where d = 0 (power decay with alpha != 0, as 0**0 = 1).
+    '''
+    def __init__(self, origins, destinations, d, T, beta, decay="power"):
+        super(GravityCalibrator, self).__init__(origins, T, beta)
+        assert decay in ["power", "exponential"], "`decay` must be either 'power' or 'exponential'"
+        assert d.shape == T.shape, "`d` must have the same shape as `T`"
+
+        self.decay = decay
+        with np.errstate(divide="ignore"):
+            self.logDestinations = np.log(destinations.astype(float).T)
+
+        # W = exp(-alpha * x + log(destinations)) and dW = -x * W
+        if decay == "power":
+            self.distanceMask = d > 0
+            with np.errstate(divide="ignore"):
+                self.x = np.where(self.distanceMask, np.log(d), 0.0)
+        else:
+            self.distanceMask = None
+            self.x = d.astype(float)
+        self.negativeX = -self.x
+
+    def getWeights(self, alpha):
+        W, dW = self.W, self.dW
+        np.multiply(self.negativeX, alpha, out=W)
+        W += self.logDestinations
+        np.exp(W, out=W)
+        if self.distanceMask is not None and alpha != 0:
+            W *= self.distanceMask
+        np.multiply(self.negativeX, W, out=dW)
+        return W, dW
+
+class ExtendedRadiationCalibrator(ModelCalibrator):
+    '''Calibrator for `MigrationModels.extendedRadiationModel`. The model is (origins**alpha + 1) * (1/(X + 1) - 1/(Y + 1)) where
+    X = (s + origins)**alpha and Y = (s + origins + destinations)**alpha, so W = 1/(X + 1) - 1/(Y + 1).
+
+    With u = 1/(X + 1) = 1/(exp(alpha * log(s + origins)) + 1), du/dalpha = -u * (1 - u) * log(s + origins) (and the same for Y).
+    '''
+    def __init__(self, origins, destinations, s, T, beta):
+        super(ExtendedRadiationCalibrator, self).__init__(origins, T, beta)
+        assert s.shape == T.shape, "`s` must have the same shape as `T`"
+
+        # log(0) is replaced by the log of the smallest positive float, which gives the same weights as 0**alpha (including 0**0 = 1)
+        tiny = np.finfo(float).tiny
+        a = s + self.origins[:,None]
+        self.logA = np.log(np.maximum(a, tiny))
+        a += destinations.astype(float).T
+        self.logB = np.log(np.maximum(a, tiny))
+        del a
+
+        self.temp = np.empty(T.shape, dtype=float)
+
+    def getWeights(self, alpha):
+        W, dW, temp = self.W, self.dW, self.temp
+
+        # u = 1/(X + 1) is stored in temp and v = 1/(Y + 1) in dW, X = exp(alpha * log(a)) overflows to inf for which u = 0
+        with np.errstate(over="ignore"):
+            for logBase, out in [(self.logA, temp), (self.logB, dW)]:
+                np.multiply(logBase, alpha, out=out)
+                np.exp(out, out=out)
+                out += 1.0
+                np.reciprocal(out, out=out)
+        np.subtract(temp, dW, out=W)
+
+        # dW = v * (1 - v) * log(b) - u * (1 - u) * log(a)
+        dW *= 1.0 - dW
+        dW *= self.logB
+        temp *= 1.0 - temp
+        temp *= self.logA
+        dW -= temp
+        return W, dW
+
+#-----------------------------------------------------------------------------------------------------------------------------------
+# Parameter sweeps
+#-----------------------------------------------------------------------------------------------------------------------------------
+def getMetricFunction(metric):
+    '''Returns `metric` if it is a function `f(T, T_pred)`, or the function with that name in `MigrationEvaluationMethods` (e.g. "cpc").
+    '''
+    if callable(metric):
+        return metric
+    return getattr(MigrationEvaluationMethods, metric)
+
+def evaluateAlphas(model, origins, destinations, x, alphas, decay="power", beta=None, T=None, metrics=None, dtype=np.float64, out=None):
+    '''Evaluates the model for each value of `alphas` in turn, reusing a single (n x m) buffer when reducing to metrics, see `sweepAlpha`.
+    '''
+    n, m = origins.shape[0], destinations.shape[0]
+    metricFunctions = [getMetricFunction(metric) for metric in metrics] if metrics is not None else None
+
+    if metricFunctions is None and out is None:
+        out = np.empty((len(alphas), n, m), dtype=dtype)
+    buffer = None
+    scores = []
+
+    for i, alpha in enumerate(alphas):
+        P = MigrationModels.evaluateModelTile(model, origins, destinations, x, alpha=alpha, decay=decay, dtype=dtype, out=out[i] if out is not None else buffer)
+        if beta is not None:
+            # in place version of `productionFunction(origins, row_normalize(P), beta)`
+            with np.errstate(divide="ignore", invalid="ignore"):
+                P /= P.sum(axis=1, keepdims=True)
+            P *= origins * beta
+        if metricFunctions is not None:
+            scores.append([metricFunction(T, P) for metricFunction in metricFunctions])
+            buffer = P
+
+    if metricFunctions is not None:
+        return np.array(scores, dtype=float).reshape(len(alphas), len(metricFunctions))
+    return out
+
+def _evaluateAlphasJob(args):
+    '''Worker for `sweepAlpha`.
+    '''
+    chunkStart, alphas, evaluateArgs, evaluateKwargs = args
+    return chunkStart, evaluateAlphas(*(evaluateArgs + (alphas,)), **evaluateKwargs)
+
+def sweepAlpha(model, origins, destinations, x, alphas, decay="power", beta=None, T=None, metrics=None, chunkSize=4, workers=1, dtype=np.float64):
+    '''Evaluates a model from `MigrationModels.MODELS` for many values of alpha.
+
+    Inputs:
+        model, origins, destinations, x, decay - see `MigrationModels.evaluateModelTile`
+        alphas - 1D array of values of alpha
+        beta - if given, the model probabilities are turned into flows with `productionFunction(origins, row_normalize(P), beta)`
+        T, metrics - if `metrics` is given (a list of names of functions in `MigrationEvaluationMethods`, e.g. ["cpc", "nrmse"], or of
+                     functions `f(T, T_pred)`) each result is reduced to its metric values against the observed flows `T` as soon as
+                     it is computed, instead of being kept
+        chunkSize - number of alphas evaluated by each job, when reducing to metrics each job only holds one (n x m) result at a time
+        workers - number of processes to evaluate chunks of alphas with
+
+    returns: a (len(alphas) x n x m) array of results, or a (len(alphas) x len(metrics)) array of metric values
+    '''
+    alphas = np.asarray(alphas, dtype=float).ravel()
+    if metrics is not None:
+        assert T is not None and beta is not None, "`T` and `beta` must be given to compute metrics"
+
+    n, m = origins.shape[0], destinations.shape[0]
+    if metrics is not None:
+        result = np.empty((alphas.shape[0], len(metrics)), dtype=float)
+    else:
+        result = np.empty((alphas.shape[0], n, m), dtype=dtype)
+
+    evaluateArgs = (model, origins, destinations, x)
+    evaluateKwargs = {"decay": decay, "beta": beta, "T": T, "metrics": metrics, "dtype": dtype}
+    chunks = [(chunkStart, alphas[chunkStart:chunkStart+chunkSize]) for chunkStart in range(0, alphas.shape[0], chunkSize)]
+
+    if workers == 1:
+        for chunkStart, chunkAlphas in chunks:
+            if metrics is not None:
+                result[chunkStart:chunkStart+chunkAlphas.shape[0]] = evaluateAlphas(*(evaluateArgs + (chunkAlphas,)), **evaluateKwargs)
+            else:
+                evaluateAlphas(*(evaluateArgs + (chunkAlphas,)), out=result[chunkStart:chunkStart+chunkAlphas.shape[0]], **evaluateKwargs)
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            jobs = [(chunkStart, chunkAlphas, evaluateArgs, evaluateKwargs) for chunkStart, chunkAlphas in chunks]
+            for chunkStart, chunkResult in executor.map(_evaluateAlphasJob, jobs):
+                result[chunkStart:chunkStart+chunkResult.shape[0]] = chunkResult
+
+    return result
+
+#-----------------------------------------------------------------------------------------------------------------------------------
+# Calibration runner
+#-----------------------------------------------------------------------------------------------------------------------------------
+# The models of `run_traditional_models` in the notebooks => (model in `MigrationModels.MODELS`, decay)
+CALIBRATION_MODELS = collections.OrderedDict([
+    ("extrad", ("extendedRadiation", None)),
+    ("rad", ("radiation", None)),
+    ("gravpow", ("gravity", "power")),
+    ("gravexp", ("gravity", "exponential")),
+])
+
+# The `MigrationData.MigrationDataset` of the shared inputs, only set in the worker processes of `runCalibration`
+_WORKER_DATASET = None
+
+def getKFoldSplits(idxs, numFolds=5, shuffle=False, seed=None):
+    '''Returns a list of (train, test) arrays of county indices, the same splits of `idxs` as `sklearn.model_selection.KFold(numFolds)`:
+    consecutive folds where the first len(idxs) % numFolds folds have one more county.
+    '''
+    idxs = np.asarray(idxs, dtype=np.int64)
+    if shuffle:
+        idxs = idxs[np.random.RandomState(seed).permutation(idxs.shape[0])]
+    assert 2 <= numFolds <= idxs.shape[0], "`numFolds` must be between 2 and the number of counties"
+
+    foldSizes = np.full(numFolds, idxs.shape[0] // numFolds, dtype=np.int64)
+    foldSizes[:idxs.shape[0] % numFolds] += 1
+    foldEnds = np.cumsum(foldSizes)
+
+    splits = []
+    for foldStart, foldEnd in zip(foldEnds - foldSizes, foldEnds):
+        splits.append((np.concatenate([idxs[:foldStart], idxs[foldEnd:]]), idxs[foldStart:foldEnd]))
+    return splits
+
+def saveSharedArray(fn, x):
+    '''Writes `x`, an array or a list of per-year (n x m) matrices (dense or scipy.sparse), to the `.npy` file `fn` in its own dtype, one
+    matrix at a time. Filenames are returned unchanged.
+    '''
+    if isinstance(x, str):
+        return x
+    if isinstance(x, np.ndarray):
+        np.save(fn, x)
+        return fn
+
+    first = x[0].toarray() if scipy.sparse.issparse(x[0]) else np.asarray(x[0])
+    out = np.lib.format.open_memmap(fn, mode="w+", dtype=first.dtype, shape=(len(x),) + first.shape)
+    for i, matrix in enumerate(x):
+        out[i] = matrix.toarray() if scipy.sparse.issparse(matrix) else matrix
+    out.flush()
+    del out
+    return fn
+
+def getSharedArray(x):
+    '''Returns `x`, or if `x` is the filename of a `.npy` file a read-only memory map of it. As the pages of a memory map are shared
+    through the page cache the inputs are never copied between processes.
+    '''
+    if not isinstance(x, str):
+        return x
+    return np.load(x, mmap_mode="r")
+
+def getCalibrator(model, data):
+    '''Returns the calibrator of one of the `CALIBRATION_MODELS` for a dataset from `MigrationDataset.get`, or None for "rad" which has
+    no parameter to fit.
+    '''
+    assert model in CALIBRATION_MODELS, "`model` must be one of %s" % (", ".join(CALIBRATION_MODELS))
+    T = data["T"].toarray() if scipy.sparse.issparse(data["T"]) else data["T"]
+    baseModel, decay = CALIBRATION_MODELS[model]
+    if baseModel == "extendedRadiation":
+        return ExtendedRadiationCalibrator(data["origin_pop"], data["destination_pop"], data["S"], T, data["beta"])
+    elif baseModel == "gravity":
+        return GravityCalibrator(data["origin_pop"], data["destination_pop"], data["D"], T, data["beta"], decay=decay)
+    return None
+
+def predictFlows(model, data, alpha, beta):
+    '''Returns `productionFunction(origin_pop, row_normalize(P), beta)` for one of the `CALIBRATION_MODELS`, as `run_traditional_models`
+    in the notebooks, except that rows of P that sum to 0 are left at 0.
+    '''
+    baseModel, decay = CALIBRATION_MODELS[model]
+    origins = np.asarray(data["origin_pop"], dtype=float)
+    x = data["D"] if baseModel == "gravity" else data["S"]
+    P = MigrationModels.evaluateModelTile(baseModel, origins, np.asarray(data["destination_pop"], dtype=float), x, alpha=alpha, decay=decay)
+    rowSums = P.sum(axis=1, keepdims=True)
+    P *= np.divide(origins * beta, rowSums, out=np.zeros_like(rowSums), where=rowSums > 0)
+    return P
+
+def calibrateModel(model, dataset, yearIdx, trainIdxs=None, testIdxs=None, destinationIdxs=None, **fitKwargs):
+    '''Fits alpha for flows from the `trainIdxs` counties to the `destinationIdxs` counties of one year of a `MigrationDataset` and
+    evaluates the fitted model (with the beta of the training counties) on the flows from the `testIdxs` counties, like the
+    cross-validation loops of the "Train migration models" notebook. `fitKwargs` are passed to the calibrator's `fit`.
+
+    returns: a dict with the fitted parameters, the optimizer diagnostics, the fit and evaluation times in seconds and the fields of
+             the `MigrationEvaluationMethods.EvaluationResult` of the test counties
+    '''
+    startTime = time.time()
+    data = dataset.get(yearIdx, trainIdxs, destinationIdxs)
+    calibrator = getCalibrator(model, data)
+    if calibrator is not None:
+        optResult = calibrator.fit(**fitKwargs)
+        alpha = float(optResult.x[0])
+        beta = float(optResult.x[1]) if len(optResult.x) > 1 else float(data["beta"])
+        diagnostics = {
+            "train_cpc": -float(optResult.fun),
+            "success": bool(optResult.success),
+            "message": str(optResult.message),
+            "iterations": int(optResult.nit),
+            "evaluations": int(optResult.nfev),
+        }
+    else:
+        alpha, beta = np.nan, float(data["beta"])
+        diagnostics = {
+            "train_cpc": MigrationEvaluationMethods.cpc(data["T"], predictFlows(model, data, alpha, beta)),
+            "success": True,
+            "message": "",
+            "iterations": 0,
+            "evaluations": 1,
+        }
+    del data, calibrator
+    fitTime = time.time() - startTime
+
+    startTime = time.time()
+    data = dataset.get(yearIdx, testIdxs, destinationIdxs)
+    scores = MigrationEvaluationMethods.evaluate_metrics(data["T"], predictFlows(model, data, alpha, beta), data["D"])
+
+    result = collections.OrderedDict([("alpha", alpha), ("beta", beta)])
+    result.update(diagnostics)
+    result["fit_time"] = fitTime
+    result["evaluate_time"] = time.time() - startTime
+    result.update(scores._asdict())
+    return result
+
+def _initCalibrationWorker(inputs):
+    '''Initializer of the worker processes of `runCalibration`, opens the shared inputs once per process so that every job run by the
+    process reuses the same memory maps (and the betas cached by the dataset). The dataset goes away with the process.
+    '''
+    global _WORKER_DATASET
+    _WORKER_DATASET = MigrationData.MigrationDataset(*[getSharedArray(x) for x in inputs])
+
+def _calibrationJob(args):
+    '''Worker for `runCalibration`, needs to be at the module level so that it can be pickled.
+    '''
+    jobIdx, model, yearIdx, fold, trainIdxs, testIdxs, destinationIdxs, fitKwargs = args
+    return jobIdx, calibrateModel(model, _WORKER_DATASET, yearIdx, trainIdxs, testIdxs, destinationIdxs, **fitKwargs)
+
+def runCalibration(populations, distances, interveningOpportunities, migrationMatrices, models=None, years=None, yearLabels=None,
+        countyIdxs=None, destinationIdxs=None, numFolds=None, splits=None, workers=1, workDir=None, fitKwargs=None, store=None, verbose=False):
+    '''Calibrates and evaluates models for every (model, year, fold) combination with a pool of processes, e.g. the 11 year x 4 model
+    sweeps and the cross-validation loops of the "Train migration models" notebook.
+
+    The inputs are written once to `.npy` files (unless they are filenames of `.npy` files already) that every worker opens as read-only
+    memory maps, so the distance matrix and the intervening opportunities and migration cubes are shared by all of the processes through
+    the page cache instead of being pickled to each job. Only the county indices of a split are sent with a job, and each process caches
+    the betas of the subsets it has seen. As the jobs are independent, the sweep scales with the number of workers until it is limited
+    by memory bandwidth.
+
+    Inputs:
+        populations - (years x n x 1) population vectors, or a list of (n x 1) vectors
+        distances - (n x n) distance matrix
+        interveningOpportunities, migrationMatrices - (years x n x n) cubes, or lists of per-year (n x n) matrices (dense or scipy.sparse)
+        models - names from `CALIBRATION_MODELS`, defaults to all of them
+        years - indices of the years to calibrate, defaults to all of them
+        yearLabels - the labels of all of the years (e.g. range(2004, 2015)) for the "year" column, defaults to the year indices
+        countyIdxs - the counties to split into folds, defaults to all counties
+        destinationIdxs - the destinations of the flows that are fit and evaluated, defaults to `countyIdxs`
+        numFolds - number of folds to split `countyIdxs` into with `getKFoldSplits`, if None (and `splits` is None) alpha is fit and
+                   evaluated on the flows from all of `countyIdxs` (fold 0)
+        splits - explicit list of (train, test) county indices, instead of `numFolds`
+        workers - number of processes, 1 runs every job in this process without writing the inputs to disk
+        workDir - directory to write the shared inputs to, a temporary directory (removed afterwards) if None
+        fitKwargs - dict of keyword arguments for `ModelCalibrator.fit`, e.g. {"x0": 1.0, "bounds": (0, 3)}
+        store - a `CalibrationStore`, jobs that are in the store are not rerun and the results of the other jobs are added to it
+
+    returns: a pandas DataFrame with one row per (model, year, fold) job, see `calibrateModel` for the columns
+    '''
+    models = list(CALIBRATION_MODELS) if models is None else list(models)
+    for model in models:
+        assert model in CALIBRATION_MODELS, "`model` must be one of %s" % (", ".join(CALIBRATION_MODELS))
+    fitKwargs = {} if fitKwargs is None else fitKwargs
+
+    numYears = len(populations) if not isinstance(populations, str) else getSharedArray(populations).shape[0]
+    years = list(range(numYears)) if years is None else list(years)
+    yearLabels = list(range(numYears)) if yearLabels is None else list(yearLabels)
+    assert len(yearLabels) == numYears, "`yearLabels` must have one entry per year"
+
+    n = getSharedArray(distances).shape[0]
+    countyIdxs = np.arange(n, dtype=np.int64) if countyIdxs is None else np.asarray(countyIdxs, dtype=np.int64)
+    destinationIdxs = countyIdxs if destinationIdxs is None else np.asarray(destinationIdxs, dtype=np.int64)
+    if splits is None:
+        splits = getKFoldSplits(countyIdxs, numFolds) if numFolds is not None else [(countyIdxs, countyIdxs)]
+
+    jobs = []
+    for model in models:
+        for yearIdx in years:
+            for fold, (trainIdxs, testIdxs) in enumerate(splits):
+                jobs.append((model, yearIdx, fold, np.asarray(trainIdxs, dtype=np.int64), np.asarray(testIdxs, dtype=np.int64)))
+
+    inputs = (populations, distances, interveningOpportunities, migrationMatrices)
+    results = [None] * len(jobs)
+
+    def collect(jobIdx, result):
+        model, yearIdx, fold = jobs[jobIdx][:3]
+        results[jobIdx] = result
+        if store is not None:
+            store.put(fingerprints[jobIdx], result, model=model, year_idx=yearIdx, fit_kwargs=fitKwargs)
+        if verbose:
+            print("%s %s fold %d -- alpha %0.4f, test cpc %0.4f" % (model, yearLabels[yearIdx], fold, result["alpha"], result["cpc"]))
+
+    def getStoredResults(dataset):
+        # Fills in the results of the jobs that are in the store and returns the fingerprints of all of the jobs
+        fingerprints = []
+        for jobIdx, (model, yearIdx, fold, trainIdxs, testIdxs) in enumerate(jobs):
+            fingerprints.append(getCalibrationFingerprint(model, dataset, yearIdx, trainIdxs, testIdxs, destinationIdxs, **fitKwargs))
+            entry = store.get(fingerprints[-1])
+            if entry is not None:
+                store.hits += 1
+                results[jobIdx] = entry["result"]
+            else:
+                store.misses += 1
+        return fingerprints
+
+    if workers == 1:
+        dataset = MigrationData.MigrationDataset(*[getSharedArray(x) for x in inputs])
+        fingerprints = getStoredResults(dataset) if store is not None else None
+        for jobIdx, (model, yearIdx, fold, trainIdxs, testIdxs) in enumerate(jobs):
+            if results[jobIdx] is None:
+                collect(jobIdx, calibrateModel(model, dataset, yearIdx, trainIdxs, testIdxs, destinationIdxs, **fitKwargs))
+    else:
+        # The fingerprints are computed from the inputs as given, so that this process never maps the files written to `workDir`
+        if store is not None:
+            fingerprints = getStoredResults(MigrationData.MigrationDataset(*[getSharedArray(x) for x in inputs]))
+
+        tempDir = None
+        if workDir is None:
+            workDir = tempDir = tempfile.mkdtemp(prefix="MigrationCalibration_")
+        elif not os.path.exists(workDir):
+            os.makedirs(workDir)
+        try:
+            names = ["populations", "distances", "interveningOpportunities", "migrationMatrices"]
+            inputs = tuple(saveSharedArray(os.path.join(workDir, name + ".npy"), x) for name, x in zip(names, inputs))
+
+            with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=_initCalibrationWorker, initargs=(inputs,)) as executor:
+                pending = {}
+                for jobIdx, (model, yearIdx, fold, trainIdxs, testIdxs) in enumerate(jobs):
+                    if results[jobIdx] is not None:
+                        continue
+                    job = (jobIdx, model, yearIdx, fold, trainIdxs, testIdxs, destinationIdxs, fitKwargs)
+                    pending[executor.submit(_calibrationJob, job)] = jobIdx
+                    if len(pending) >= 2 * workers:
+                        done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                        for future in done:
+                            del pending[future]
+                            collect(*future.result())
+                for future in concurrent.futures.as_completed(pending):
+                    collect(*future.result())
+        finally:
+            if tempDir is not None:
+                shutil.rmtree(tempDir, ignore_errors=True)
+
+    rows = []
+    for (model, yearIdx, fold, trainIdxs, testIdxs), result in zip(jobs, results):
+        row = collections.OrderedDict([
+            ("model", model),
+            ("year_idx", yearIdx),
+            ("year", yearLabels[yearIdx]),
+            ("fold", fold),
+            ("num_train", trainIdxs.shape[0]),
+            ("num_test", testIdxs.shape[0]),
+        ])
+        row.update(result)
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+#-----------------------------------------------------------------------------------------------------------------------------------
+# Calibration store
+#-----------------------------------------------------------------------------------------------------------------------------------
+DEFAULT_STORE_LOCATION = os.path.join(os.path.expanduser("~"), ".MigrationCalibrationStore/")
+
+# Part of every fingerprint, increase it when a change to the calibration or evaluation code changes the results
+STORE_VERSION = 1
+
+def toJson(x):
+    '''`default` function for `json.dump` that converts numpy scalars and arrays to Python values. Other types raise a TypeError, as their
+    `str` would not identify their value (e.g. in a fingerprint).
+    '''
+    if isinstance(x, np.generic):
+        return x.item()
+    if isinstance(x, np.ndarray):
+        return x.tolist()
+    raise TypeError("Object of type %s is not JSON serializable" % (type(x).__name__))
+
+def getCalibrationFingerprint(model, dataset, yearIdx, trainIdxs=None, testIdxs=None, destinationIdxs=None, **fitKwargs):
+    '''Returns the sha224 hex digest identifying a `calibrateModel` call: the model name, the optimizer settings `fitKwargs`, the
+    fingerprint of the data of the year (see `MigrationDataset.get_fingerprint`) and the counties of the split.
+    '''
+    h = hashlib.sha224()
+    settings = {"version": STORE_VERSION, "model": model, "fitKwargs": fitKwargs}
+    h.update(json.dumps(settings, sort_keys=True, default=toJson).encode("utf-8"))
+    h.update(dataset.get_fingerprint(yearIdx).encode("utf-8"))
+    for idxs in [trainIdxs, testIdxs, destinationIdxs]:
+        idxs = np.ascontiguousarray(dataset.get_county_idxs(idxs), dtype=np.int64)
+        h.update(("%d;" % (idxs.shape[0])).encode("utf-8"))
+        h.update(idxs.tobytes())
+    return h.hexdigest()
+
+class CalibrationStore(object):
+    '''On-disk store of the results of `calibrateModel`, i.e. the fitted parameters, objective value, optimizer diagnostics, timings and
+    test metrics of a calibration.
+
+    Each entry is a JSON file named after the fingerprint of its calibration (see `getCalibrationFingerprint`), so repeating a
+    calibration returns the stored result without refitting, and any change to the data, the county split, the model or the optimizer
+    settings gives a new fingerprint and a new calibration. The `hits` and `misses` counters record how often fitting was skipped.
+    '''
+    def __init__(self, storeDir=None, verbose=False):
+        if storeDir is None:
+            storeDir = DEFAULT_STORE_LOCATION
+        if not os.path.exists(storeDir):
+            os.makedirs(storeDir)
+
+        self.storeDir = storeDir
+        self.verbose = verbose
+        self.hits = 0
+        self.misses = 0
+
+    def getEntryFn(self, fingerprint):
+        return os.path.join(self.storeDir, "%s.json" % (fingerprint))
+
+    def get(self, fingerprint):
+        '''Returns the stored entry (a dict whose "result" is the dict returned by `calibrateModel`), or None if there is no readable entry.
+        '''
+        entryFn = self.getEntryFn(fingerprint)
+        if not os.path.isfile(entryFn):
+            return None
+        try:
+            with open(entryFn) as f:
+                return json.load(f, object_pairs_hook=collections.OrderedDict)
+        except (IOError, ValueError):
+            if self.verbose:
+                print("Store entry %s is unreadable, refitting" % (entryFn))
+            return None
+
+    def put(self, fingerprint, result, **metadata):
+        '''Stores a result of `calibrateModel`, with `metadata` (e.g. the model name and year) to describe the entry.
+        '''
+        entry = collections.OrderedDict([("fingerprint", fingerprint), ("created", time.time())])
+        entry.update(metadata)
+        entry["result"] = result
+
+        # Write to a temporary file first so that concurrent readers never see a partially written entry
+        entryFn = self.getEntryFn(fingerprint)
+        tmpFn = "%s.%d.tmp" % (entryFn, os.getpid())
+        with open(tmpFn, "w") as f:
+            json.dump(entry, f, default=toJson)
+        os.replace(tmpFn, entryFn)
+
+    def calibrate(self, model, dataset, yearIdx, trainIdxs=None, testIdxs=None, destinationIdxs=None, refit=False, **fitKwargs):
+        '''Returns the stored result of `calibrateModel` with the same arguments, or runs and stores it if there is none (or if `refit`).
+        '''
+        fingerprint = getCalibrationFingerprint(model, dataset, yearIdx, trainIdxs, testIdxs, destinationIdxs, **fitKwargs)
+        entry = self.get(fingerprint) if not refit else None
+        if entry is not None:
+            self.hits += 1
+            return entry["result"]
+
+        self.misses += 1
+        result = calibrateModel(model, dataset, yearIdx, trainIdxs, testIdxs, destinationIdxs, **fitKwargs)
+        self.put(fingerprint, result, model=model, year_idx=yearIdx, fit_kwargs=fitKwargs)
+        if self.verbose:
+            print("Stored %s year %d as %s" % (model, yearIdx, fingerprint))
+        return result
+
+    def getEntries(self):
+        '''Returns a pandas DataFrame with one row per stored entry: its fingerprint, creation time, metadata and result fields.
+        '''
+        rows = []
+        for entryFn in sorted(glob.glob(os.path.join(self.storeDir, "*.json"))):
+            entry = self.get(os.path.basename(entryFn)[:-len(".json")])
+            if entry is None:
+                continue
+            row = collections.OrderedDict((key, value) for key, value in entry.items() if key != "result")
+            row.update(entry["result"])
+            rows.append(row)
+        return pd.DataFrame(rows)
+
+    def clear(self):
+        '''Removes all entries from the store and resets the counters.
+        '''
+        for entryFn in glob.glob(os.path.join(self.storeDir, "*.json")):
+            os.remove(entryFn)
+        self.hits = 0
+        self.misses = 0
+
+
+if __name__ == "__main__":
+    pass
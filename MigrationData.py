@@ -7,8 +7,14 @@
 # Distributed under terms of the MIT license.
 import os
 import csv
+import json
+import glob
+import hashlib
+import concurrent.futures
 
 import numpy as np
+import pandas as pd
+import scipy.sparse
 
 def parse_row_04_08(line):
     ''' This method parses rows from the 2004-2008 IRS migration data.
@@ -103,6 +109,349 @@ def load_file_11_15(fn):
 
     return records
 
+#-----------------------------------------------------------------------------------------------------------------------------------
+# Columnar loaders
+#-----------------------------------------------------------------------------------------------------------------------------------
+# (start, end) character offsets of the fields used from the 2004-2008 fixed width format, see `parse_row_04_08`
+FIELDS_04_08 = {
+    'State_Code_Origin' : (0, 2),
+    'County_Code_Origin' : (3, 6),
+    'State_Code_Dest' : (7, 9),
+    'County_Code_Dest' : (10, 13),
+    'Exmpt_Num' : (60, 70),
+}
+
+# CSV column names of the (origin state, origin county, destination state, destination county, value) fields
+COLUMNS_08_11 = ('State_Code_Origin', 'County_Code_Origin', 'State_Code_Dest', 'County_Code_Dest', 'Exmpt_Num')
+COLUMNS_11_15 = ('y1_statefips', 'y1_countyfips', 'y2_statefips', 'y2_countyfips', 'n2')
+
+def parse_lines_04_08(lines):
+    ''' Vectorized version of `parse_row_04_08` over a list of (stripped, non-empty) lines read in binary mode.
+
+    Input: lines - list of bytes objects
+    Output: origin, destination, value - int64 arrays where origin and destination are FIPS codes encoded as state*1000+county
+    '''
+    width = max(end for start, end in FIELDS_04_08.values())
+    num_lines = len(lines)
+
+    # Pack the lines into a (num_lines x width) character matrix so that each field becomes a column slice
+    buffer = np.frombuffer(b''.join(line[:width].ljust(width) for line in lines), dtype=np.uint8).reshape(num_lines, width)
+
+    fields = dict()
+    for name, (start, end) in FIELDS_04_08.items():
+        fields[name] = np.ascontiguousarray(buffer[:, start:end]).view('S%d' % (end-start)).ravel().astype(np.int64)
+
+    origin = fields['State_Code_Origin'] * 1000 + fields['County_Code_Origin']
+    destination = fields['State_Code_Dest'] * 1000 + fields['County_Code_Dest']
+
+    return origin, destination, fields['Exmpt_Num']
+
+def parse_frame_csv(frame, columns):
+    ''' Converts a DataFrame read from the 2008-2015 CSV files into (origin, destination, value) arrays.
+    
+    Input: frame - DataFrame containing (at least) the given columns
+           columns - one of `COLUMNS_08_11` or `COLUMNS_11_15`
+    Output: origin, destination, value - int64 arrays where origin and destination are FIPS codes encoded as state*1000+county
+    '''
+    origin_state, origin_county, destination_state, destination_county, value = [frame[column].values.astype(np.int64) for column in columns]
+
+    origin = origin_state * 1000 + origin_county
+    destination = destination_state * 1000 + destination_county
+
+    return origin, destination, value
+
+def load_file_04_08_columnar(fn):
+    ''' Columnar version of `load_file_04_08`, returns the records as (origin, destination, value) arrays.
+    '''
+    f = open(fn, 'rb')
+    lines = [line.strip() for line in f]
+    f.close()
+    lines = [line for line in lines if line!=b'']
+
+    return parse_lines_04_08(lines)
+
+def load_file_08_11_columnar(fn):
+    ''' Columnar version of `load_file_08_11`, returns the records as (origin, destination, value) arrays.
+    '''
+    frame = pd.read_csv(fn, encoding='ISO-8859-1', usecols=COLUMNS_08_11, dtype=str)
+    return parse_frame_csv(frame, COLUMNS_08_11)
+
+def load_file_11_15_columnar(fn):
+    ''' Columnar version of `load_file_11_15`, returns the records as (origin, destination, value) arrays.
+    '''
+    frame = pd.read_csv(fn, encoding='ISO-8859-1', usecols=COLUMNS_11_15, dtype=str)
+    return parse_frame_csv(frame, COLUMNS_11_15)
+
+#-----------------------------------------------------------------------------------------------------------------------------------
+# Streaming loaders
+#-----------------------------------------------------------------------------------------------------------------------------------
+DEFAULT_BATCH_SIZE = 2**16
+
+def iter_file_04_08(fn, batch_size=DEFAULT_BATCH_SIZE):
+    ''' Streaming version of `load_file_04_08_columnar`, yields the records in (origin, destination, value) batches of at most
+    `batch_size` records.
+    '''
+    f = open(fn, 'rb')
+    lines = []
+    for line in f:
+        line = line.strip()
+        if line!=b'':
+            lines.append(line)
+            if len(lines) == batch_size:
+                yield parse_lines_04_08(lines)
+                lines = []
+    f.close()
+    if len(lines) > 0:
+        yield parse_lines_04_08(lines)
+
+def iter_file_08_11(fn, batch_size=DEFAULT_BATCH_SIZE):
+    ''' Streaming version of `load_file_08_11_columnar`, see `iter_file_04_08`.
+    '''
+    for frame in pd.read_csv(fn, encoding='ISO-8859-1', usecols=COLUMNS_08_11, dtype=str, chunksize=batch_size):
+        yield parse_frame_csv(frame, COLUMNS_08_11)
+
+def iter_file_11_15(fn, batch_size=DEFAULT_BATCH_SIZE):
+    ''' Streaming version of `load_file_11_15_columnar`, see `iter_file_04_08`.
+    '''
+    for frame in pd.read_csv(fn, encoding='ISO-8859-1', usecols=COLUMNS_11_15, dtype=str, chunksize=batch_size):
+        yield parse_frame_csv(frame, COLUMNS_11_15)
+
+def get_fips_mask(fips, states=None, counties=None):
+    ''' Get a mask of the integer FIPS codes that are in one of `states` (state FIPS codes as strings, e.g. '01', or integers) and/or
+    in `counties` (county FIPS codes as strings or integers). A filter that is None accepts every code.
+    '''
+    mask = np.ones(fips.shape, dtype=bool)
+    if states is not None:
+        mask &= np.isin(fips // 1000, [int(state) for state in states])
+    if counties is not None:
+        mask &= np.isin(fips, fips_to_int(counties))
+    return mask
+
+def filter_records(records, states=None, counties=None, match='both'):
+    ''' Filters a batch of (origin, destination, value) records by state and/or county, see `get_fips_mask`.
+
+    Input: match - 'both' keeps records where the origin and destination pass the filter, 'any' keeps records where either does
+    '''
+    assert match in ['both', 'any'], "`match` must be either 'both' or 'any'"
+    origin, destination, value = records
+    if states is None and counties is None:
+        return records
+
+    origin_mask = get_fips_mask(origin, states, counties)
+    destination_mask = get_fips_mask(destination, states, counties)
+    mask = (origin_mask & destination_mask) if match == 'both' else (origin_mask | destination_mask)
+
+    return origin[mask], destination[mask], value[mask]
+
+def fips_to_int(fips):
+    ''' Converts 5 character FIPS code strings (e.g. '01001') to the integer encoding state*1000+county used throughout this module.
+
+    Input: fips - a FIPS code string, or a list/array of FIPS code strings or of FIPS codes that are already integers
+    Output: int or int64 array
+    '''
+    if isinstance(fips, str):
+        return int(fips)
+    return np.array([int(code) for code in fips], dtype=np.int64)
+
+def get_fips_lookup(county_fips):
+    ''' Builds a dense lookup table that maps integer FIPS codes to their index in `county_fips`, codes not in the list map to -1.
+
+    Integer FIPS codes are < 100000, so the table is small and a lookup is a single gather.
+    '''
+    county_fips = fips_to_int(county_fips)
+    lookup = np.full(county_fips.max()+1, -1, dtype=np.int64)
+    lookup[county_fips] = np.arange(county_fips.shape[0])
+    return lookup
+
+def fips_to_index(lookup, fips):
+    ''' Vectorized lookup of an array of integer FIPS codes in a table built by `get_fips_lookup`, returns -1 for unknown codes.
+    '''
+    idx = np.full(fips.shape, -1, dtype=np.int64)
+    mask = (fips >= 0) & (fips < lookup.shape[0])
+    idx[mask] = lookup[fips[mask]]
+    return idx
+
+def fips_to_str(fips):
+    ''' Inverse of `fips_to_int`.
+    '''
+    if np.ndim(fips) == 0:
+        return '%05d' % (fips)
+    return ['%05d' % (code) for code in np.asarray(fips).tolist()]
+
+def records_to_columnar(records):
+    ''' Converts a list of (origin, destination, value) tuples, as returned by the `load_file_*` methods, to columnar arrays.
+    '''
+    origin = fips_to_int([record[0] for record in records])
+    destination = fips_to_int([record[1] for record in records])
+    value = np.array([record[2] for record in records], dtype=np.int64)
+    return origin, destination, value
+
+def columnar_to_records(origin, destination, value):
+    ''' Inverse of `records_to_columnar`.
+    '''
+    return list(zip(fips_to_str(origin), fips_to_str(destination), value.tolist()))
+
+#-----------------------------------------------------------------------------------------------------------------------------------
+# Dense/sparse migration matrix helpers
+#-----------------------------------------------------------------------------------------------------------------------------------
+def save_migration_matrix(fn, migration_matrix):
+    ''' Saves a migration matrix, sparse matrices are saved with `scipy.sparse.save_npz` (use a `.npz` filename) and dense matrices with `np.save`.
+    '''
+    if scipy.sparse.issparse(migration_matrix):
+        scipy.sparse.save_npz(fn, migration_matrix.tocsr())
+    else:
+        np.save(fn, migration_matrix)
+
+def load_migration_matrix(fn):
+    ''' Loads a migration matrix saved with `save_migration_matrix`, `.npz` files are returned as `scipy.sparse.csr_matrix`.
+    '''
+    if fn.endswith('.npz'):
+        return scipy.sparse.load_npz(fn).tocsr()
+    else:
+        return np.load(fn)
+
+def outgoing_totals(migration_matrix):
+    ''' Number of migrants leaving each county (row sums) as a 1D array, for dense or sparse matrices.
+    '''
+    return np.asarray(migration_matrix.sum(axis=1)).ravel()
+
+def incoming_totals(migration_matrix):
+    ''' Number of migrants arriving in each county (column sums) as a 1D array, for dense or sparse matrices.
+    '''
+    return np.asarray(migration_matrix.sum(axis=0)).ravel()
+
+def remove_diagonal(migration_matrix):
+    ''' Sets the diagonal of a dense or sparse (CSR) migration matrix to zero in place, and returns it.
+    '''
+    if scipy.sparse.issparse(migration_matrix):
+        assert scipy.sparse.isspmatrix_csr(migration_matrix), 'Sparse migration matrices must be in CSR format'
+        rows = np.repeat(np.arange(migration_matrix.shape[0]), np.diff(migration_matrix.indptr))
+        migration_matrix.data[migration_matrix.indices == rows] = 0
+        migration_matrix.eliminate_zeros()
+    else:
+        np.fill_diagonal(migration_matrix, 0)
+    return migration_matrix
+
+#-----------------------------------------------------------------------------------------------------------------------------------
+# Parsed record cache
+#-----------------------------------------------------------------------------------------------------------------------------------
+DEFAULT_CACHE_LOCATION = os.path.join(os.path.expanduser("~"), ".MigrationDataCache/")
+
+class RecordCache(object):
+    ''' On-disk cache of the (origin, destination, value) arrays returned by the columnar loaders.
+
+    Each source file gets one `.npz` entry named after a hash of its absolute path and a hash of its (size, mtime), so modified
+    source files miss the cache and their stale entry is replaced. When `max_bytes` is set, the least recently used entries are
+    evicted after every write until the cache fits. The `hits` and `misses` counters record how often text parsing was skipped.
+    '''
+
+    def __init__(self, cache_dir=None, max_bytes=None, verbose=False):
+        if cache_dir is None:
+            cache_dir = DEFAULT_CACHE_LOCATION
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.verbose = verbose
+        self.hits = 0
+        self.misses = 0
+
+    def get_cache_fn(self, fn):
+        '''Get the path of the cache entry for a source file in its current state.
+        '''
+        fn = os.path.abspath(fn)
+        stat = os.stat(fn)
+        path_hash = hashlib.sha224(fn.encode('utf-8')).hexdigest()
+        state_hash = hashlib.sha224(('%d,%d' % (stat.st_size, stat.st_mtime_ns)).encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, '%s_%s.npz' % (path_hash[:32], state_hash[:16]))
+
+    def load(self, fn, loader):
+        ''' Returns the records of `fn` from the cache, or parses them with `loader` (one of the `load_file_*_columnar` methods) and
+        caches the result.
+        '''
+        cache_fn = self.get_cache_fn(fn)
+
+        if os.path.isfile(cache_fn):
+            try:
+                with np.load(cache_fn) as data:
+                    records = (data['origin'].astype(np.int64), data['destination'].astype(np.int64), data['value'].astype(np.int64))
+                os.utime(cache_fn) # mark the entry as recently used
+                self.hits += 1
+                if self.verbose:
+                    print('Loaded %s from cache' % (fn))
+                return records
+            except (IOError, ValueError, KeyError):
+                if self.verbose:
+                    print('Cache entry %s is unreadable, rebuilding' % (cache_fn))
+
+        self.misses += 1
+        origin, destination, value = loader(fn)
+
+        # Remove entries of previous versions of this file, but not the temporary files other processes are writing entries to
+        path_prefix = os.path.basename(cache_fn).split('_')[0]
+        for old_fn in glob.glob(os.path.join(self.cache_dir, path_prefix + '_*.npz')):
+            if old_fn.endswith('.tmp.npz'):
+                continue
+            try:
+                os.remove(old_fn)
+            except OSError: # removed by another process
+                pass
+
+        # Write to a temporary file first so that concurrent readers never see a partially written entry
+        tmp_fn = '%s.%d.tmp.npz' % (cache_fn[:-4], os.getpid())
+        np.savez(tmp_fn, origin=origin.astype(np.int32), destination=destination.astype(np.int32), value=value.astype(np.int32))
+        os.replace(tmp_fn, cache_fn)
+        if self.verbose:
+            print('Cached %s to %s' % (fn, cache_fn))
+
+        self.evict(keep=cache_fn)
+
+        return origin, destination, value
+
+    def get_entries(self):
+        '''Get a list of (last used time, size in bytes, path) for all the entries in the cache, least recently used first.
+        '''
+        entries = []
+        for cache_fn in glob.glob(os.path.join(self.cache_dir, '*_*.npz')):
+            if cache_fn.endswith('.tmp.npz'):
+                continue
+            try:
+                stat = os.stat(cache_fn)
+            except OSError: # removed by another process
+                continue
+            entries.append((stat.st_mtime, stat.st_size, cache_fn))
+        return sorted(entries)
+
+    def evict(self, keep=None):
+        ''' Removes the least recently used entries until the cache is at most `max_bytes` in size, the entry `keep` is never removed.
+        '''
+        if self.max_bytes is None:
+            return
+
+        entries = self.get_entries()
+        total_bytes = sum(size for _, size, _ in entries)
+        for _, size, cache_fn in entries:
+            if total_bytes <= self.max_bytes:
+                break
+            if cache_fn == keep:
+                continue
+            try:
+                os.remove(cache_fn)
+            except OSError:
+                pass
+            total_bytes -= size
+            if self.verbose:
+                print('Evicted %s from cache' % (cache_fn))
+
+    def clear(self):
+        ''' Removes all entries from the cache and resets the counters.
+        '''
+        for _, _, cache_fn in self.get_entries():
+            os.remove(cache_fn)
+        self.hits = 0
+        self.misses = 0
+
 class IRSMigrationData(object):
 
     YEAR_FN_MAP = {
@@ -120,8 +469,12 @@ class IRSMigrationData(object):
         2014 : ('county1415','countyinflow1415.csv','countyoutflow1415.csv'),
     }
 
-    def __init__(self, data_dir='data/raw/migration/'):
+    def __init__(self, data_dir='data/raw/migration/', cache=None):
+        ''' Input: data_dir - directory containing the raw IRS migration data
+                   cache - optional `RecordCache` used to skip parsing the raw files when they have been parsed before
+        '''
         self.data_dir = data_dir
+        self.cache = cache
     
     def get_fn_from_year(self, year):
         '''Get paths to the IRS data assosciated with some year.
@@ -137,44 +490,237 @@ class IRSMigrationData(object):
         else:
             raise ValueError('Year %d out of range' % (year))
 
-    def get_raw_data(self, year):
+    def get_loader_from_year(self, year, columnar=False):
+        '''Get the method used to load the IRS data files assosciated with some year.
+        '''
+        if 2004<=year<2008:
+            return load_file_04_08_columnar if columnar else load_file_04_08
+        elif 2008<=year<2011: 
+            return load_file_08_11_columnar if columnar else load_file_08_11
+        elif 2011<=year<2015:
+            return load_file_11_15_columnar if columnar else load_file_11_15
+        else:
+            raise ValueError('Year %d out of range' % (year))
+
+    def get_iterator_from_year(self, year):
+        '''Get the method used to stream the IRS data files assosciated with some year.
+        '''
+        if 2004<=year<2008:
+            return iter_file_04_08
+        elif 2008<=year<2011: 
+            return iter_file_08_11
+        elif 2011<=year<2015:
+            return iter_file_11_15
+        else:
+            raise ValueError('Year %d out of range' % (year))
+
+    def iter_raw_data(self, year, direction='both', batch_size=DEFAULT_BATCH_SIZE, states=None, counties=None, match='both'):
+        ''' Stream rows from raw IRS migration data files in batches of columnar records, without loading the files into memory.
+
+        Input: year - the year of data to get as an int
+               direction - 'in', 'out' or 'both' (the inflow file is streamed before the outflow file)
+               batch_size - maximum number of records per batch (batches are smaller after filtering)
+               states, counties, match - filters applied to each batch as it is read, see `filter_records`
+        Output: generator of (origin, destination, value) int64 arrays with FIPS codes encoded as state*1000+county
+        '''
+        assert direction in ['in', 'out', 'both'], "`direction` must be one of 'in', 'out' or 'both'"
+        incoming_fn, outgoing_fn = self.get_fn_from_year(year)
+        iterator = self.get_iterator_from_year(year)
+
+        fns = []
+        if direction in ['in', 'both']:
+            fns.append(incoming_fn)
+        if direction in ['out', 'both']:
+            fns.append(outgoing_fn)
+
+        for fn in fns:
+            for records in iterator(fn, batch_size=batch_size):
+                records = filter_records(records, states=states, counties=counties, match=match)
+                if records[0].shape[0] > 0:
+                    yield records
+
+    def get_county_fips(self, year, states=None, batch_size=DEFAULT_BATCH_SIZE):
+        ''' Get all the (origin or destination) county FIPS codes that appear in a year of data, excluding the county code 000 which is
+        reserved for state level totals, in a single streaming pass over the raw files.
+
+        Input: states - optional list of state FIPS codes to restrict the counties to
+        Output: sorted array of integer FIPS codes
+        '''
+        fips_set = np.zeros(0, dtype=np.int64)
+        for origin, destination, _ in self.iter_raw_data(year, batch_size=batch_size):
+            fips = np.concatenate([origin, destination])
+            fips = fips[get_fips_mask(fips, states=states) & (fips % 1000 != 0)]
+            fips_set = np.union1d(fips_set, fips)
+        return fips_set
+
+    def get_county_intersection(self, years=None, states=None, batch_size=DEFAULT_BATCH_SIZE, verbose=False):
+        ''' Get the counties that appear in every year of data (see `get_county_fips`) with one streaming pass over each year.
+
+        Memory use is bounded by the batch size and the number of counties, not by the size of the raw files.
+
+        Input: years - list of years, defaults to all years in `YEAR_FN_MAP`
+        Output: sorted array of integer FIPS codes (use `fips_to_str` to get 5 character strings)
+        '''
+        if years is None:
+            years = sorted(IRSMigrationData.YEAR_FN_MAP.keys())
+
+        joined_set = None
+        for year in years:
+            fips_set = self.get_county_fips(year, states=states, batch_size=batch_size)
+            if verbose:
+                print('%d -- %d counties' % (year, fips_set.shape[0]))
+            joined_set = fips_set if joined_set is None else np.intersect1d(joined_set, fips_set)
+
+        return joined_set
+
+    def get_raw_data(self, year, columnar=False):
         ''' Get rows from raw IRS migration data files.
 
         Input: year - the year of data to get as an int
+               columnar - if True, return each set of records as (origin, destination, value) int64 arrays (with FIPS codes encoded
+                          as state*1000+county) instead of a list of tuples
         Output: list incoming and outgoing migrant records from that year in the format (origin, destination, number of exemptions)
         '''
         incoming_fn, outgoing_fn = self.get_fn_from_year(year)
 
-        in_records = None
-        out_records = None
-        if 2004<=year<2008:
-            in_records = load_file_04_08(incoming_fn)
-            out_records = load_file_04_08(outgoing_fn)
-        elif 2008<=year<2011: 
-            in_records = load_file_08_11(incoming_fn)
-            out_records = load_file_08_11(outgoing_fn)
-        elif 2011<=year<2015:
-            in_records = load_file_11_15(incoming_fn)
-            out_records = load_file_11_15(outgoing_fn)
+        if self.cache is not None:
+            loader = self.get_loader_from_year(year, columnar=True)
+            in_records = self.cache.load(incoming_fn, loader)
+            out_records = self.cache.load(outgoing_fn, loader)
+            if not columnar:
+                in_records = columnar_to_records(*in_records)
+                out_records = columnar_to_records(*out_records)
         else:
-            raise ValueError('Year %d out of range' % (year))
+            loader = self.get_loader_from_year(year, columnar=columnar)
+            in_records = loader(incoming_fn)
+            out_records = loader(outgoing_fn)
 
         return in_records, out_records
 
-    def get_processed_data(self, year, county_fips, verbose=False):
+    def get_processed_data(self, year, county_fips, verbose=False, slow_mode=False, sparse=False):
         ''' Get migration matrix for a given year and set of county FIPS codes.
 
         Input: year - the year of data to get as an int
+               county_fips - list of FIPS codes, either as strings (e.g. '01001') or integers encoded as state*1000+county
+               slow_mode - if True, build the matrix by iterating over the records one at a time (reference implementation)
+               sparse - if True, return the matrix as a `scipy.sparse.csr_matrix` without explicitly stored zeros
         Output: Migration matrix of size (|county_fips| x |county_fips|) where an i,j entry corresponds to the number of migrants leaving county i for county j
         '''
-    
+        county_fips = fips_to_int(county_fips)
+        assert len(np.unique(county_fips)) == len(county_fips), 'List of counties should not have duplicates'
+        n = len(county_fips)
+
+        if slow_mode:
+            migration_matrix = np.zeros((n,n), dtype=np.int32)
+            repeats, discrepancies = self._fill_migration_matrix_slow(year, county_fips, migration_matrix)
+            if sparse:
+                migration_matrix = scipy.sparse.csr_matrix(migration_matrix)
+        else:
+            origin_idx, destination_idx, value, repeats, discrepancies = self._get_migration_entries(year, county_fips)
+            if sparse:
+                mask = value != 0
+                migration_matrix = scipy.sparse.csr_matrix(
+                    (value[mask].astype(np.int32), (origin_idx[mask], destination_idx[mask])), shape=(n,n)
+                )
+            else:
+                migration_matrix = np.zeros((n,n), dtype=np.int32)
+                migration_matrix[origin_idx, destination_idx] = value
+
+        # Sanity check, there should not be any u,v in the in_records that contradict with records from out_records
+        if verbose:
+            print('Found %d repeats' % (repeats))
+            print('Error of %d migrants' % (discrepancies))
+
+        return migration_matrix
+
+    def get_processed_cube(self, years, county_fips, workers=None, sparse=False):
+        ''' Get the migration matrices for several years, parsing and assembling each year in a separate process.
+
+        Input: years - list of years of data to get
+               county_fips - list of FIPS codes, see `get_processed_data`
+               workers - number of worker processes, defaults to one per CPU (capped at the number of years), use 1 to run serially
+               sparse - if True, return a list of `scipy.sparse.csr_matrix` (one per year) instead of a dense array
+        Output: int32 array of size (|years| x |county_fips| x |county_fips|) where the k,i,j entry corresponds to the number of
+                migrants leaving county i for county j in years[k]
+        '''
+        years = list(years)
+        county_fips = fips_to_int(county_fips)
+        n = len(county_fips)
+
+        if workers is None:
+            workers = os.cpu_count() or 1
+        workers = max(1, min(workers, len(years)))
+
+        jobs = [(self, year, county_fips, sparse) for year in years]
+        if workers == 1:
+            results = map(_get_processed_data_job, jobs)
+            matrices = self._stack_matrices(results, len(years), n, sparse)
+        else:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+                results = executor.map(_get_processed_data_job, jobs)
+                matrices = self._stack_matrices(results, len(years), n, sparse)
+
+        return matrices
+
+    def _stack_matrices(self, results, num_years, n, sparse):
+        if sparse:
+            return list(results)
+        cube = np.zeros((num_years, n, n), dtype=np.int32)
+        for i, migration_matrix in enumerate(results):
+            cube[i] = migration_matrix
+        return cube
+
+    def _get_migration_entries(self, year, county_fips):
+        ''' Vectorized implementation of `get_processed_data`, returns the (origin_idx, destination_idx, value) entries of the migration
+        matrix (each entry appears once) and the number of repeats and discrepancies.
+
+        Records from the inflow file are written first and records from the outflow file overwrite them, so for each (origin, destination)
+        pair the matrix gets the value of the last record in (in_records + out_records) order. A "repeat" is an outflow record whose pair
+        already holds a different non-zero value at the time it is written.
+        '''
+        n = len(county_fips)
+        lookup = get_fips_lookup(county_fips)
+
+        (in_origin, in_destination, in_value), (out_origin, out_destination, out_value) = self.get_raw_data(year, columnar=True)
+        if 2004<=year<2008: # the 2004 - 2008 data has this backwards
+            in_origin, in_destination = in_destination, in_origin
+
+        origin_idx = fips_to_index(lookup, np.concatenate([in_origin, out_origin]))
+        destination_idx = fips_to_index(lookup, np.concatenate([in_destination, out_destination]))
+        value = np.concatenate([in_value, out_value])
+        is_outflow = np.concatenate([np.zeros(in_value.shape[0], dtype=bool), np.ones(out_value.shape[0], dtype=bool)])
+
+        mask = (origin_idx >= 0) & (destination_idx >= 0)
+        keys = origin_idx[mask] * n + destination_idx[mask]
+        value = value[mask]
+        is_outflow = is_outflow[mask]
+
+        # Group the records by matrix entry, keeping their original order within each group (mergesort is stable)
+        order = np.argsort(keys, kind='mergesort')
+        keys, value, is_outflow = keys[order], value[order], is_outflow[order]
+        same_as_previous = keys[1:] == keys[:-1]
+
+        # The last record in each group is the one that ends up in the matrix
+        is_last = np.ones(keys.shape[0], dtype=bool)
+        is_last[:-1] = ~same_as_previous
+
+        # The value each record overwrites is the value of the previous record in its group (or 0 if it is the first one)
+        previous_value = np.zeros_like(value)
+        previous_value[1:][same_as_previous] = value[:-1][same_as_previous]
+        is_repeat = is_outflow & (previous_value != 0) & (previous_value != value)
+
+        repeats = int(is_repeat.sum())
+        discrepancies = int(np.abs(previous_value[is_repeat] - value[is_repeat]).sum())
+
+        return keys[is_last] // n, keys[is_last] % n, value[is_last], repeats, discrepancies
+
+    def _fill_migration_matrix_slow(self, year, county_fips, migration_matrix):
+        ''' Reference implementation of `get_processed_data` that iterates over the records one at a time.
+        '''
+        county_fips = fips_to_str(county_fips)
         county_set = set(county_fips)
-        assert len(county_set) == len(county_fips), 'List of counties should not have duplicates'
         county_fips_to_idx = {fips:i for i, fips in enumerate(county_fips)}
-        n = len(county_fips)
 
-        migration_matrix = np.zeros((n,n), dtype=np.int32)
-        
         in_records, out_records = self.get_raw_data(year)
 
         for origin, destination, val in in_records:
@@ -202,10 +748,358 @@ class IRSMigrationData(object):
                         discrepancies += abs(migration_matrix[origin_idx, destination_idx] - val)
 
                 migration_matrix[origin_idx, destination_idx] = val
-        
-        # Sanity check, there should not be any u,v in the in_records that contradict with records from out_records
+
+        return repeats, discrepancies
+
+#-----------------------------------------------------------------------------------------------------------------------------------
+# Memory-mapped migration cube
+#-----------------------------------------------------------------------------------------------------------------------------------
+class MigrationCube(object):
+    ''' Memory-mapped on-disk store of a (year x origin x destination) migration cube with its list of years and counties.
+
+    The store is a directory containing the cube as a `.npy` file and a JSON metadata file. Opening it only reads the metadata,
+    data is paged in from disk as it is touched, so reading one year or a few rows of the cube only costs the size of what was read.
+    The store is opened read-only and is never modified by reads (e.g. the diagonal is masked in the returned block instead of with
+    `np.fill_diagonal` on the stored data).
+    '''
+
+    CUBE_FN = 'migration_cube.npy'
+    METADATA_FN = 'metadata.json'
+
+    def __init__(self, path):
+        self.path = path
+
+        f = open(os.path.join(path, MigrationCube.METADATA_FN), 'r')
+        metadata = json.load(f)
+        f.close()
+
+        self.years = metadata['years']
+        self.county_fips = metadata['county_fips']
+        self.data = np.load(os.path.join(path, MigrationCube.CUBE_FN), mmap_mode='r')
+
+        assert self.data.shape == (len(self.years), len(self.county_fips), len(self.county_fips)), 'Cube does not match its metadata'
+
+        self.year_to_idx = {year:i for i, year in enumerate(self.years)}
+        self.county_lookup = get_fips_lookup(self.county_fips)
+
+    @staticmethod
+    def from_matrices(path, years, county_fips, matrices, dtype=np.int32):
+        ''' Creates a store at `path` from a list of migration matrices (one per year, in the order of `years`) and returns it opened.
+
+        `matrices` can be any iterable of dense arrays, sparse matrices, or filenames readable by `load_migration_matrix`; they are
+        written to disk one at a time so only one year needs to be in memory.
+        '''
+        years = [int(year) for year in years]
+        county_fips = fips_to_str(fips_to_int(county_fips))
+        n = len(county_fips)
+
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+        cube = np.lib.format.open_memmap(os.path.join(path, MigrationCube.CUBE_FN), mode='w+', dtype=dtype, shape=(len(years), n, n))
+        num_matrices = 0
+        for i, migration_matrix in enumerate(matrices):
+            if isinstance(migration_matrix, str):
+                migration_matrix = load_migration_matrix(migration_matrix)
+            if scipy.sparse.issparse(migration_matrix):
+                migration_matrix = migration_matrix.toarray()
+            assert migration_matrix.shape == (n, n), 'Migration matrix for %d has the wrong shape' % (years[i])
+            cube[i] = migration_matrix
+            num_matrices += 1
+        assert num_matrices == len(years), 'Expected %d migration matrices, got %d' % (len(years), num_matrices)
+        cube.flush()
+        del cube
+
+        f = open(os.path.join(path, MigrationCube.METADATA_FN), 'w')
+        json.dump({'years': years, 'county_fips': county_fips}, f)
+        f.close()
+
+        return MigrationCube(path)
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+    def get_county_idxs(self, county_fips):
+        ''' Get the indices of a list of county FIPS codes (strings or integers) in the cube, raises a ValueError for unknown counties.
+        '''
+        idxs = fips_to_index(self.county_lookup, fips_to_int(county_fips))
+        if np.any(idxs < 0):
+            raise ValueError('Counties not in the cube: %s' % (', '.join(fips_to_str(fips_to_int(county_fips)[idxs < 0]))))
+        return idxs
+
+    def get(self, year, origins=None, destinations=None, remove_diagonal=False):
+        ''' Read the migration matrix of a year, or a block of it.
+
+        Input: year - the year to read
+               origins, destinations - None (all counties), a slice, or an array of county indices (see `get_county_idxs`)
+               remove_diagonal - if True, entries where the origin and destination county are the same are zero in the result
+        Output: Array of size (|origins| x |destinations|). When both selectors are None/slices and the diagonal is kept this is a
+                read-only view of the memory map, otherwise it is a new array holding only the selected block.
+        '''
+        if year not in self.year_to_idx:
+            raise ValueError('Year %d not in the cube' % (year))
+        matrix = self.data[self.year_to_idx[year]]
+        n = matrix.shape[0]
+
+        if origins is None:
+            origins = slice(None)
+        if destinations is None:
+            destinations = slice(None)
+
+        if isinstance(origins, slice) or isinstance(destinations, slice):
+            block = matrix[origins][:, destinations]
+        else:
+            block = matrix[np.ix_(origins, destinations)]
+
+        if remove_diagonal:
+            origin_idxs = np.arange(n)[origins]
+            destination_idxs = np.arange(n)[destinations]
+            # positions in the block whose origin and destination are the same county
+            _, block_rows, block_cols = np.intersect1d(origin_idxs, destination_idxs, assume_unique=True, return_indices=True)
+            if block_rows.shape[0] > 0:
+                if np.may_share_memory(block, self.data):
+                    block = np.array(block)
+                block[block_rows, block_cols] = 0
+
+        return block
+
+    def get_years(self, years=None, origins=None, destinations=None, remove_diagonal=False):
+        ''' Read a list of years (defaults to all years) as a (|years| x |origins| x |destinations|) array, see `get`.
+        '''
+        if years is None:
+            years = self.years
+        return np.stack([
+            self.get(year, origins=origins, destinations=destinations, remove_diagonal=remove_diagonal) for year in years
+        ])
+
+#-----------------------------------------------------------------------------------------------------------------------------------
+# Model datasets
+#-----------------------------------------------------------------------------------------------------------------------------------
+class MigrationDataset(object):
+    ''' The per-year population vectors, intervening opportunities and migration matrices, and the distance matrix, that the migration
+    models are fit and evaluated on, held once in their native dtypes.
+
+    `get` replaces `get_full_dataset` from the model notebooks: instead of copying every matrix with
+    `[origin_list,:][:,destination_list].astype(float)`, subsets are views when possible and a single gather otherwise. When `groups`
+    (e.g. {'flooded': flooded_county_idxs, 'unflooded': unflooded_county_idxs}) are given, the counties are reordered once so that each
+    group is a contiguous range, which makes every (group, group) subset a view. The `beta` of each subset and the fingerprint of each
+    year (see `get_fingerprint`) are cached, so the arrays must not be modified after the dataset is created.
+    '''
+
+    def __init__(self, population_vectors, distances, intervening_opportunities, migration_matrices, groups=None):
+        ''' Input: population_vectors - list (or array) of (n x 1) population vectors, one per year
+                   distances - (n x n) distance matrix
+                   intervening_opportunities - list (or array) of (n x n) intervening opportunities matrices, one per year
+                   migration_matrices - list (or array) of (n x n) migration matrices, one per year, dense or scipy.sparse
+                   groups - optional dict of group name => list of (disjoint) county indices
+        '''
+        num_years = len(population_vectors)
+        n = distances.shape[0]
+        assert len(intervening_opportunities) == num_years and len(migration_matrices) == num_years, 'All per-year inputs must have the same number of years'
+
+        # `order[k]` is the original index of the county at position k, `positions[i]` is the position of county i
+        self.groups = {}
+        if groups is not None:
+            order = []
+            for name, idxs in groups.items():
+                idxs = np.asarray(idxs, dtype=np.int64)
+                self.groups[name] = slice(len(order), len(order) + idxs.shape[0])
+                order.extend(idxs.tolist())
+            assert len(set(order)) == len(order), 'Groups must be disjoint'
+            order = np.array(order + sorted(set(range(n)) - set(order)), dtype=np.int64)
+        else:
+            order = np.arange(n, dtype=np.int64)
+        self.order = order
+        self.positions = np.empty(n, dtype=np.int64)
+        self.positions[order] = np.arange(n)
+        self.is_reordered = not np.array_equal(order, np.arange(n))
+
+        self.population_vectors = [self._reorder(x, rows_only=True) for x in population_vectors]
+        self.distances = self._reorder(distances)
+        self.intervening_opportunities = [self._reorder(x) for x in intervening_opportunities]
+        self.migration_matrices = [self._reorder(x) for x in migration_matrices]
+
+        self.beta_cache = {}
+        self.fingerprint_cache = {}
+
+    def _reorder(self, x, rows_only=False):
+        if not self.is_reordered:
+            return x
+        if rows_only:
+            return x[self.order]
+        if scipy.sparse.issparse(x):
+            return x.tocsr()[self.order][:, self.order]
+        return x[np.ix_(self.order, self.order)]
+
+    def get_selector(self, idxs):
+        ''' Returns the positions of a subset of counties in the stored arrays: a slice if they are a contiguous range in order (a group
+        name, None for all counties, or a list of original county indices), otherwise an array of positions.
+        '''
+        if idxs is None:
+            return slice(None)
+        if isinstance(idxs, str):
+            return self.groups[idxs]
+        if isinstance(idxs, slice):
+            idxs = np.arange(self.order.shape[0])[idxs]
+        positions = self.positions[np.asarray(idxs, dtype=np.int64)]
+        if positions.shape[0] > 0 and np.array_equal(positions, np.arange(positions[0], positions[0] + positions.shape[0])):
+            return slice(int(positions[0]), int(positions[0]) + positions.shape[0])
+        return positions
+
+    def get_county_idxs(self, idxs):
+        ''' Returns the original county indices of a subset of counties (see `get_selector`), in the order of the rows of `get`.
+        '''
+        return self.order[self.get_selector(idxs)]
+
+    @staticmethod
+    def subset(matrix, origins, destinations):
+        ''' Returns matrix[origins, destinations] for two selectors from `get_selector`: a view when both are slices, otherwise one gather
+        (dense or scipy.sparse).
+        '''
+        if isinstance(origins, slice) and isinstance(destinations, slice):
+            return matrix[origins, destinations]
+        if scipy.sparse.issparse(matrix):
+            return matrix[origins][:, destinations]
+        if isinstance(origins, slice) or isinstance(destinations, slice):
+            return matrix[origins][:, destinations] if isinstance(origins, slice) else matrix[origins, destinations]
+        return matrix[np.ix_(origins, destinations)]
+
+    def get_beta(self, year_idx, origins=None, destinations=None):
+        ''' Returns the (cached) coefficient of the no-intercept regression of the total outgoing migration from each origin (to the
+        destinations) on the origin populations, i.e. `LinearRegression(fit_intercept=False).fit(origin_pop, T.sum(axis=1)).coef_[0]`
+        computed in closed form as sum(x*y)/sum(x*x).
+        '''
+        origin_selector = self.get_selector(origins)
+        destination_selector = self.get_selector(destinations)
+        key = (year_idx, MigrationDataset._get_selector_key(origin_selector), MigrationDataset._get_selector_key(destination_selector))
+
+        if key not in self.beta_cache:
+            x = np.asarray(self.population_vectors[year_idx][origin_selector], dtype=np.float64).ravel()
+            T = self.subset(self.migration_matrices[year_idx], origin_selector, destination_selector)
+            y = np.asarray(T.sum(axis=1), dtype=np.float64).ravel()
+            self.beta_cache[key] = np.dot(x, y) / np.dot(x, x)
+        return self.beta_cache[key]
+
+    @staticmethod
+    def _get_selector_key(selector):
+        if isinstance(selector, slice):
+            return (selector.start, selector.stop, selector.step)
+        return hashlib.sha224(np.ascontiguousarray(selector).tobytes()).hexdigest()
+
+    def get_fingerprint(self, year_idx):
+        ''' Returns the (cached) sha224 hex digest of the data of one year: the population vector, intervening opportunities and migration
+        matrix of the year, the distance matrix and the county order. Any change to the values, dtypes or shapes changes the fingerprint.
+        '''
+        if 'distances' not in self.fingerprint_cache:
+            h = hashlib.sha224()
+            update_array_hash(h, self.order)
+            update_array_hash(h, self.distances)
+            self.fingerprint_cache['distances'] = h.hexdigest()
+
+        if year_idx not in self.fingerprint_cache:
+            h = hashlib.sha224(self.fingerprint_cache['distances'].encode('utf-8'))
+            for x in [self.population_vectors[year_idx], self.intervening_opportunities[year_idx], self.migration_matrices[year_idx]]:
+                update_array_hash(h, x)
+            self.fingerprint_cache[year_idx] = h.hexdigest()
+        return self.fingerprint_cache[year_idx]
+
+    def get(self, year_idx, origins=None, destinations=None):
+        ''' Returns the dataset of one year for a subset of origins and destinations, with the same keys as `get_full_dataset` in the
+        model notebooks ('origin_pop', 'destination_pop', 'S', 'D', 'T', 'beta'), but with the arrays in their stored dtypes and as views
+        of the stored arrays whenever the subsets are contiguous (see `get_selector`).
+
+        Input: year_idx - index of the year
+               origins, destinations - group names, lists of county indices, or None for all counties
+        '''
+        origin_selector = self.get_selector(origins)
+        destination_selector = self.get_selector(destinations)
+        population = self.population_vectors[year_idx]
+
+        return {
+            'origin_pop': population[origin_selector],
+            'destination_pop': population[destination_selector],
+            'S': self.subset(self.intervening_opportunities[year_idx], origin_selector, destination_selector),
+            'D': self.subset(self.distances, origin_selector, destination_selector),
+            'T': self.subset(self.migration_matrices[year_idx], origin_selector, destination_selector),
+            'beta': self.get_beta(year_idx, origins, destinations),
+        }
+
+def update_array_hash(h, x, tile_size=1024):
+    ''' Adds the shape, dtype and values of an array (which can be a memory map) or scipy.sparse matrix to the hashlib object `h`.
+
+    Both are hashed as the (row, column, value) triplets of their non-zero entries in row-major order, `tile_size` rows at a time, so a
+    scipy.sparse matrix and its dense equivalent add the same bytes to `h`.
+    '''
+    if scipy.sparse.issparse(x):
+        x = x.tocsr()
+        if not x.has_canonical_format:
+            x = x.copy()
+            x.sum_duplicates()
+    else:
+        x = np.asarray(x)
+    h.update(('%s,%s;' % (str(x.shape), x.dtype.str)).encode('utf-8'))
+    if x.ndim == 0:
+        h.update(x.tobytes())
+        return
+
+    rows = x if scipy.sparse.issparse(x) else x.reshape(x.shape[0], -1)
+    for start in range(0, rows.shape[0], tile_size):
+        tile = rows[start:start+tile_size]
+        if scipy.sparse.issparse(tile):
+            tile_rows = np.repeat(np.arange(tile.shape[0], dtype=np.int64), np.diff(tile.indptr))
+            mask = tile.data != 0
+            tile_rows, tile_cols, values = tile_rows[mask], tile.indices[mask].astype(np.int64), tile.data[mask]
+        else:
+            tile_rows, tile_cols = np.nonzero(tile)
+            values = tile[tile_rows, tile_cols]
+        for values in [tile_rows.astype(np.int64) + start, tile_cols.astype(np.int64), values]:
+            h.update(np.ascontiguousarray(values).tobytes())
+
+def _get_processed_data_job(args):
+    ''' Worker for `IRSMigrationData.get_processed_cube`, needs to be at the module level so that it can be pickled.
+    '''
+    migration_data, year, county_fips, sparse = args
+    return migration_data.get_processed_data(year, county_fips, sparse=sparse)
+
+def check_columnar_loaders(data_dir='data/raw/migration/', years=None, verbose=False):
+    ''' Asserts that the columnar loaders return the same records, in the same order, as the reference `load_file_*` methods.
+    '''
+    migration_data = IRSMigrationData(data_dir=data_dir)
+    if years is None:
+        years = sorted(IRSMigrationData.YEAR_FN_MAP.keys())
+
+    for year in years:
+        for fn in migration_data.get_fn_from_year(year):
+            reference = records_to_columnar(migration_data.get_loader_from_year(year)(fn))
+            columnar = migration_data.get_loader_from_year(year, columnar=True)(fn)
+            for expected, actual in zip(reference, columnar):
+                assert np.array_equal(expected, actual), 'Columnar loader does not match reference loader for %s' % (fn)
+            if verbose:
+                print('%d %s -- %d records match' % (year, fn, reference[0].shape[0]))
+
+def check_processed_data(county_fips, data_dir='data/raw/migration/', years=None, verbose=False):
+    ''' Asserts that `get_processed_data` gives the same migration matrices with and without `slow_mode`.
+    '''
+    migration_data = IRSMigrationData(data_dir=data_dir)
+    if years is None:
+        years = sorted(IRSMigrationData.YEAR_FN_MAP.keys())
+
+    for year in years:
+        expected = migration_data.get_processed_data(year, county_fips, verbose=verbose, slow_mode=True)
+        actual = migration_data.get_processed_data(year, county_fips, verbose=verbose)
+        actual_sparse = migration_data.get_processed_data(year, county_fips, sparse=True)
+        assert np.array_equal(expected, actual), 'Migration matrices do not match for %d' % (year)
+        assert np.array_equal(expected, actual_sparse.toarray()), 'Sparse migration matrix does not match for %d' % (year)
         if verbose:
-            print('Found %d repeats' % (repeats))
-            print('Error of %d migrants' % (discrepancies))
+            print('%d -- migration matrices match' % (year))
 
-        return migration_matrix
\ No newline at end of file
+if __name__ == "__main__":
+    import sys
+    data_dir = sys.argv[1] if len(sys.argv) > 1 else 'data/raw/migration/'
+    check_columnar_loaders(data_dir, verbose=True)
+    if len(sys.argv) > 2:
+        f = open(sys.argv[2])
+        county_fips = f.read().strip().split('\n')
+        f.close()
+        check_processed_data(county_fips, data_dir, verbose=True)
@@ -0,0 +1,230 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2019 Caleb Robinson <calebrob6@gmail.com>
+#
+# Distributed under terms of the MIT license.
+'''
+Vectorized great-circle (haversine) distance matrices between locations.
+
+Distances are computed in tiles of rows so that memory use is bounded for large numbers of locations (e.g. block groups), and
+matrices can be stored in "condensed" form, i.e. only the upper triangle as a 1D array in the same order as
+`scipy.spatial.distance.squareform`, which halves the memory needed for a symmetric distance matrix. `MigrationModels` and
+`MigrationEvaluationMethods` accept condensed distance matrices directly, reading them a block of rows at a time.
+'''
+import mmap
+import collections
+
+import numpy as np
+
+# Mean earth radius, the same value as used by the `haversine` package
+EARTH_RADIUS_KM = 6371.0088
+
+def haversineDistances(coordinatesA, coordinatesB, radius=EARTH_RADIUS_KM, dtype=np.float64):
+    '''Computes the (n x m) great-circle distances between two sets of (latitude, longitude) coordinates in degrees.
+
+    This gives the same results as `scipy.spatial.distance.cdist(coordinatesA, coordinatesB, haversine.haversine)`.
+    '''
+    assert len(coordinatesA.shape) == 2 and coordinatesA.shape[1] == 2, "`coordinates` must be (n x 2) arrays of (latitude, longitude)"
+    assert len(coordinatesB.shape) == 2 and coordinatesB.shape[1] == 2, "`coordinates` must be (n x 2) arrays of (latitude, longitude)"
+
+    latA, lonA = np.radians(coordinatesA[:,0:1]), np.radians(coordinatesA[:,1:2])
+    latB, lonB = np.radians(coordinatesB[:,0]), np.radians(coordinatesB[:,1])
+
+    # a = sin^2(dlat/2) + cos(latA) * cos(latB) * sin^2(dlon/2), computed in place in the result array
+    D = np.subtract(lonA, lonB, dtype=dtype)
+    D *= 0.5
+    np.sin(D, out=D)
+    np.square(D, out=D)
+    D *= np.cos(latA)
+    D *= np.cos(latB)
+    D += np.square(np.sin((latA - latB) * 0.5))
+
+    # d = 2 * radius * arcsin(sqrt(a))
+    np.clip(D, 0.0, 1.0, out=D)
+    np.sqrt(D, out=D)
+    np.arcsin(D, out=D)
+    D *= 2.0 * radius
+    return D
+
+def getDistanceMatrix(coordinates, condensed=False, tileSize=1024, radius=EARTH_RADIUS_KM, dtype=np.float64, out=None):
+    '''Computes the great-circle distance matrix between (n x 2) (latitude, longitude) coordinates, a block of `tileSize` rows at a time.
+
+    If `condensed` is True only the upper triangle is returned, as a 1D array of length n*(n-1)/2. `out` can be used to pass a
+    preallocated result array (e.g. a `np.memmap`) of the right shape.
+    '''
+    n = coordinates.shape[0]
+
+    if condensed:
+        shape = (n * (n-1) // 2,)
+    else:
+        shape = (n, n)
+
+    if out is None:
+        out = np.empty(shape, dtype=dtype)
+    assert out.shape == shape, "`out` must have shape %s" % (str(shape))
+
+    for rowStart in range(0, n, tileSize):
+        rowEnd = min(rowStart + tileSize, n)
+        D = haversineDistances(coordinates[rowStart:rowEnd], coordinates, radius=radius, dtype=dtype)
+
+        if condensed:
+            # In row-major order, the upper triangle entries of these rows are a contiguous range of the condensed array, starting
+            # after the entries of the previous rows
+            mask = np.arange(rowStart, rowEnd)[:,None] < np.arange(n)[None,:]
+            start = n*rowStart - (rowStart*(rowStart+1))//2
+            values = D[mask]
+            out[start:start+values.shape[0]] = values
+        else:
+            out[rowStart:rowEnd] = D
+
+    return out
+
+class HaversineDistanceRows(object):
+    '''Callable that computes rows [rowStart, rowEnd) of the distance matrix on the fly, for use with `MigrationModels.evaluateModelTiled`.
+    '''
+    def __init__(self, coordinates, radius=EARTH_RADIUS_KM, dtype=np.float64):
+        self.coordinates = coordinates
+        self.radius = radius
+        self.dtype = dtype
+
+    def __call__(self, rowStart, rowEnd):
+        return haversineDistances(self.coordinates[rowStart:rowEnd], self.coordinates, radius=self.radius, dtype=self.dtype)
+
+#-----------------------------------------------------------------------------------------------------------------------------------
+# Condensed distance matrices
+#-----------------------------------------------------------------------------------------------------------------------------------
+# Number of rows read at a time from condensed distance matrices
+CONDENSED_TILE_SIZE = 1024
+
+def isCondensed(distanceMatrix):
+    return len(distanceMatrix.shape) == 1
+
+def getCondensedSize(condensed):
+    '''Returns the number of locations n of a condensed distance matrix of length n*(n-1)/2.
+    '''
+    length = condensed.shape[0]
+    n = int(round((1 + np.sqrt(1 + 8*length)) / 2))
+    assert n * (n-1) // 2 == length, "Condensed distance matrices must have a length of the form n*(n-1)/2"
+    return n
+
+def getCondensedIndex(n, i, j):
+    '''Index of the (i,j) entry (with i < j) of an (n x n) distance matrix in its condensed form, works elementwise on arrays.
+    '''
+    return n*i - (i*(i+1))//2 + (j - i - 1)
+
+def getCondensedRows(condensed, rowStart, rowEnd):
+    '''Returns rows [rowStart, rowEnd) of the square distance matrix stored in `condensed`, without expanding the rest of it.
+    '''
+    n = getCondensedSize(condensed)
+    i = np.arange(rowStart, rowEnd, dtype=np.int64)[:,None]
+    j = np.arange(n, dtype=np.int64)[None,:]
+
+    low, high = np.minimum(i, j), np.maximum(i, j)
+    idx = getCondensedIndex(n, low, high)
+    diagonal = low == high
+    idx[diagonal] = 0
+
+    D = np.asarray(condensed)[idx]
+    D[diagonal] = 0
+    return D
+
+# Location of a memory mapped array in its file, see `getMemmapReference`
+MemmapReference = collections.namedtuple("MemmapReference", ["filename", "offset", "dtype", "shape", "order"])
+
+def getMemmapReference(x):
+    '''Returns the `MemmapReference` to reopen `x` with, if `x` is a memory map (or a contiguous view of one, e.g. a block of its rows)
+    backed by a file, or None otherwise.
+    '''
+    if not isinstance(x, np.memmap) or x.filename is None or getattr(x, "_mmap", None) is None or x.size == 0:
+        return None
+    if x.flags.c_contiguous:
+        order = "C"
+    elif x.flags.f_contiguous:
+        order = "F"
+    else:
+        return None
+
+    # `np.memmap` maps the file from the allocation granularity boundary below the offset it was opened with, which views inherit
+    mapStart = x.offset - x.offset % mmap.ALLOCATIONGRANULARITY
+    mapAddress = np.frombuffer(x._mmap, dtype=np.uint8).ctypes.data
+    return MemmapReference(x.filename, mapStart + x.ctypes.data - mapAddress, x.dtype.str, x.shape, order)
+
+def openMemmapReference(reference):
+    '''Opens the array of a `MemmapReference` as a read-only memory map.
+    '''
+    return np.memmap(reference.filename, mode="r", dtype=np.dtype(reference.dtype), shape=tuple(reference.shape), offset=reference.offset,
+        order=reference.order)
+
+class MemmapPicklable(object):
+    '''Base class of the row readers (functions `f(rowStart, rowEnd)`) passed to worker processes. Attributes that are memory maps are
+    pickled as `MemmapReference`s and reopened read-only when unpickled, so that each job only reads the rows it needs from the file
+    instead of receiving a copy of the whole matrix.
+    '''
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for key, value in state.items():
+            reference = getMemmapReference(value)
+            if reference is not None:
+                state[key] = reference
+        return state
+
+    def __setstate__(self, state):
+        for key, value in state.items():
+            if isinstance(value, MemmapReference):
+                state[key] = openMemmapReference(value)
+        self.__dict__.update(state)
+
+class CondensedDistanceRows(MemmapPicklable):
+    '''Callable that reads rows [rowStart, rowEnd) of a condensed distance matrix, for use with `MigrationModels.evaluateModelTiled`.
+    A memory mapped `condensed` matrix is pickled by reference, see `MemmapPicklable`.
+    '''
+    def __init__(self, condensed):
+        self.condensed = condensed
+
+    def __call__(self, rowStart, rowEnd):
+        return getCondensedRows(self.condensed, rowStart, rowEnd)
+
+def getDistanceRows(distanceMatrix, rowStart, rowEnd):
+    '''Returns rows [rowStart, rowEnd) of a square or condensed distance matrix.
+    '''
+    if isCondensed(distanceMatrix):
+        return getCondensedRows(distanceMatrix, rowStart, rowEnd)
+    return np.asarray(distanceMatrix[rowStart:rowEnd])
+
+def getDistances(distanceMatrix, rows, cols):
+    '''Returns the entries (rows[k], cols[k]) of a square or condensed distance matrix, e.g. at the non-zero entries of a sparse matrix.
+    '''
+    if isCondensed(distanceMatrix):
+        n = getCondensedSize(distanceMatrix)
+        low = np.minimum(rows, cols).astype(np.int64)
+        high = np.maximum(rows, cols).astype(np.int64)
+        diagonal = low == high
+        idx = getCondensedIndex(n, low, high)
+        idx[diagonal] = 0
+
+        D = np.asarray(distanceMatrix)[idx]
+        D[diagonal] = 0
+        return D
+    return np.asarray(distanceMatrix[rows, cols])
+
+def getDistanceMatrixSize(distanceMatrix):
+    '''Returns the number of locations of a square or condensed distance matrix.
+    '''
+    if isCondensed(distanceMatrix):
+        return getCondensedSize(distanceMatrix)
+    return distanceMatrix.shape[0]
+
+def latLonToUnitVectors(coordinates):
+    '''Converts (n x 2) (latitude, longitude) coordinates in degrees to (n x 3) points on the unit sphere. The euclidean distance between
+    two of these points increases monotonically with the great-circle distance between the coordinates, so a KD-tree over them gives
+    the nearest neighbours by great-circle distance.
+    '''
+    lat = np.radians(coordinates[:,0])
+    lon = np.radians(coordinates[:,1])
+    return np.stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)], axis=1)
+
+
+if __name__ == "__main__":
+    pass
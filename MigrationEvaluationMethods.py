@@ -12,34 +12,35 @@ These are implementations of the methods described in [1] and [2].
 [1] Lenormand, Maxime, Aleix Bassolas, and José J. Ramasco. "Systematic comparison of trip distribution laws and models." Journal of Transport Geography 51 (2016): 158-169.
 [2] Lenormand, Maxime, et al. "A universal model of commuting networks." PloS one 7.10 (2012): e45985.
 '''
+import collections
+import concurrent.futures
+
 import numpy as np
+import pandas as pd
+import scipy.sparse
 
-from sklearn.metrics import mean_absolute_error, mean_squared_error, median_absolute_error, r2_score
+from MigrationDistances import isCondensed, getDistanceRows, CONDENSED_TILE_SIZE, getDistances, getDistanceMatrixSize
 
 def evaluate_all(y_test, y_pred, distances):
-    cpc_matrix  = cpc(y_test, y_pred)
-    cpcd_matrix = cpc_d(y_test, y_pred, distances)
-    
-    mae_matrix = mean_absolute_error(y_test.flatten(), y_pred.flatten())
-    r2_matrix = r2_score(y_test.flatten(), y_pred.flatten())
-    
-    y_test_incoming = y_test.sum(axis=0)
-    y_pred_incoming = y_pred.sum(axis=0)
-    
-    mae_incoming = mean_absolute_error(y_test_incoming, y_pred_incoming)
-    r2_incoming = r2_score(y_test_incoming, y_pred_incoming)
-
-    return (cpc_matrix, cpcd_matrix, mae_matrix, r2_matrix, mae_incoming, r2_incoming)
+    '''Returns (cpc, cpc_d, mae, r2, mae_incoming, r2_incoming), see `evaluate_metrics` for all of the metrics.
+    '''
+    result = evaluate_metrics(y_test, y_pred, distances)
+    return (result.cpc, result.cpc_d, result.mae, result.r2, result.mae_incoming, result.r2_incoming)
 
 #-----------------------------------------------------------------------------------------------------------------------------------
 #-----------------------------------------------------------------------------------------------------------------------------------
 def cpc(O,G):
     '''Calcuates the common part of commuters value between the generated matrix, G, and the observed matrix, O as defined by Lenormand et al. in [2].
 
+    O and/or G can be scipy.sparse matrices, see `get_pair_statistics`.
+
     returns: cpc value
     '''
     assert len(G.shape) == 2 and len(O.shape) == 2
     assert G.shape[0] == O.shape[0] and G.shape[1] == O.shape[1]
+
+    if scipy.sparse.issparse(O) or scipy.sparse.issparse(G):
+        return 2.0 * get_pair_statistics(O, G)[0] / (O.sum() + G.sum())
     
     numerator = 2.0 * np.sum(np.minimum(G,O))
     denominator = np.sum(O) + np.sum(G)
@@ -51,11 +52,17 @@ def cpc(O,G):
 def cpl(O,G):
     '''Calcuates the common part of links value between the generated matrix, G, and the observed matrix, O as defined by Lenormand et al. in [1].
 
+    O and/or G can be scipy.sparse matrices, see `get_pair_statistics`.
+
     returns: cpl value
     '''
     assert len(G.shape) == 2 and len(O.shape) == 2
     assert G.shape[0] == O.shape[0] and G.shape[1] == O.shape[1]
 
+    if scipy.sparse.issparse(O) or scipy.sparse.issparse(G):
+        countO, countG, countBoth = get_pair_statistics(O, G)[3:]
+        return 2.0 * countBoth / (countO + countG)
+
     numerator = 2.0 * np.sum((O>0)&(G>0))
     denominator = np.sum(O>0) + np.sum(G>0)
     
@@ -67,21 +74,49 @@ def cpc_d(O,G,distanceMatrix):
     '''Calcuates the common part of commuters according to distance value between the generated matrix, G, and
     the observed matrix, O as defined by Lenormand et al. in [1].
 
+    `distanceMatrix` can also be a condensed distance matrix (see `MigrationDistances`), which is read a block of rows at a time, or a
+    `DistanceBins` built from the distance matrix (which is much faster when cpc_d is calculated repeatedly). O and/or G can be
+    scipy.sparse matrices, in which case only the distances of their stored entries are read.
+
     returns: cpc_d value
     '''
-    assert len(O.shape)==2 and len(G.shape)==2 and len(distanceMatrix.shape)==2
-    assert O.shape[0] == G.shape[0] and O.shape[0] == distanceMatrix.shape[0]
-    assert O.shape[1] == G.shape[1] and O.shape[1] == distanceMatrix.shape[1]
+    if isinstance(distanceMatrix, DistanceBins):
+        assert O.shape == distanceMatrix.shape and G.shape == distanceMatrix.shape
+        return distanceMatrix.cpc_d(O, G)
+
+    assert len(O.shape)==2 and len(G.shape)==2
+    assert O.shape[0] == G.shape[0] and O.shape[1] == G.shape[1]
+    if isCondensed(distanceMatrix):
+        assert O.shape[0] == O.shape[1] and O.shape[0] == getDistanceMatrixSize(distanceMatrix)
+    else:
+        assert len(distanceMatrix.shape)==2
+        assert O.shape[0] == distanceMatrix.shape[0]
+        assert O.shape[1] == distanceMatrix.shape[1]
 
     binWidth = 2
 
     bins = np.arange(0, np.ceil(distanceMatrix.max())+1, binWidth)
 
-    Omask = O > 0.0
-    Gmask = G > 0.0
+    if scipy.sparse.issparse(O) or scipy.sparse.issparse(G):
+        oBins = get_distance_histogram(O, distanceMatrix, bins=bins)
+        gBins = get_distance_histogram(G, distanceMatrix, bins=bins)
+    elif isCondensed(distanceMatrix):
+        oBins = np.zeros(bins.shape[0]-1, dtype=float)
+        gBins = np.zeros(bins.shape[0]-1, dtype=float)
+        for rowStart in range(0, O.shape[0], CONDENSED_TILE_SIZE):
+            rowEnd = min(rowStart + CONDENSED_TILE_SIZE, O.shape[0])
+            distanceRows = getDistanceRows(distanceMatrix, rowStart, rowEnd)
+            oRows, gRows = O[rowStart:rowEnd], G[rowStart:rowEnd]
+            Omask = oRows > 0.0
+            Gmask = gRows > 0.0
+            oBins += np.histogram(distanceRows[Omask], bins=bins, weights=oRows[Omask])[0]
+            gBins += np.histogram(distanceRows[Gmask], bins=bins, weights=gRows[Gmask])[0]
+    else:
+        Omask = O > 0.0
+        Gmask = G > 0.0
 
-    oBins, oBinEdges = np.histogram(distanceMatrix[Omask].flatten(), bins=bins, weights=O[Omask].flatten())
-    gBins, gBinEdges = np.histogram(distanceMatrix[Gmask].flatten(), bins=bins, weights=G[Gmask].flatten())
+        oBins, oBinEdges = np.histogram(distanceMatrix[Omask].flatten(), bins=bins, weights=O[Omask].flatten())
+        gBins, gBinEdges = np.histogram(distanceMatrix[Gmask].flatten(), bins=bins, weights=G[Gmask].flatten())
 
     numerator = np.sum(np.minimum(oBins,gBins))
     denominator = np.sum(oBins)
@@ -95,11 +130,16 @@ def nrmse(O,G):
 
     Note: we have modified the definition to include the square root.
 
+    O and/or G can be scipy.sparse matrices, see `get_pair_statistics`.
+
     returns: normalized root mean squared value
     '''
     assert len(G.shape) == 2 and len(O.shape) == 2
     assert G.shape[0] == O.shape[0] and G.shape[1] == O.shape[1]
 
+    if scipy.sparse.issparse(O) or scipy.sparse.issparse(G):
+        return np.sqrt(get_pair_statistics(O, G)[1] / O.sum())
+
     numerator = np.sum((O-G)**2)
     denominator = np.sum(O)
     
@@ -110,15 +150,592 @@ def nrmse(O,G):
 def rmse(O,G):
     '''Calcuates the root mean squared error between the generated matrix, G, and the observed matrix, O.
      
+    O and/or G can be scipy.sparse matrices, see `get_pair_statistics`.
+
     returns: root mean squared value
     '''
     assert len(G.shape) == 2 and len(O.shape) == 2
     assert G.shape[0] == O.shape[0] and G.shape[1] == O.shape[1]
+
+    if scipy.sparse.issparse(O) or scipy.sparse.issparse(G):
+        return np.sqrt(get_pair_statistics(O, G)[1] / float(O.shape[0] * O.shape[1]))
  
     numerator = np.sum((O-G)**2)
     denominator = float(O.shape[0] * O.shape[1])
      
     return np.sqrt(numerator/denominator)
 
+#-----------------------------------------------------------------------------------------------------------------------------------
+# Sparse matrices
+#-----------------------------------------------------------------------------------------------------------------------------------
+def to_canonical_csr(X):
+    '''Returns the scipy.sparse matrix X in CSR format without duplicate entries, without modifying X.
+    '''
+    X = X.tocsr()
+    if not X.has_canonical_format:
+        X = X.copy()
+        X.sum_duplicates()
+    return X
+
+def get_stored_entries(X):
+    '''Returns (rows, cols, values) of the stored entries of the scipy.sparse matrix X.
+    '''
+    X = to_canonical_csr(X)
+    rows = np.repeat(np.arange(X.shape[0], dtype=np.int64), np.diff(X.indptr))
+    return rows, X.indices, X.data
+
+def dense_statistics(X, tileSize=1024):
+    '''Returns sum(min(X,0)), sum(X**2), sum(|X|) and the number of positive entries of the dense matrix X, a block of rows at a time.
+    '''
+    sumMinimum = sumSquares = sumAbsolute = 0.0
+    count = 0
+    for rowStart in range(0, X.shape[0], tileSize):
+        rows = np.asarray(X[rowStart:rowStart+tileSize], dtype=np.float64)
+        sumMinimum += np.minimum(rows, 0).sum()
+        sumSquares += np.einsum("ij,ij->", rows, rows)
+        sumAbsolute += np.abs(rows).sum()
+        count += np.count_nonzero(rows > 0)
+    return sumMinimum, sumSquares, sumAbsolute, count
+
+def get_pair_statistics(O, G, tileSize=1024):
+    '''Returns sum(min(O,G)), sum((O-G)**2), sum(|O-G|), count(O>0), count(G>0) and count(O>0 & G>0) for dense and/or scipy.sparse O
+    and G, without densifying the sparse matrices.
+
+    When both are sparse the sums are over the union of their non-zero structure. When only one is sparse, the sums are taken over
+    the dense matrix as if the sparse one were all zeros, and then corrected at the stored entries of the sparse one.
+    '''
+    assert O.shape == G.shape
+    if not scipy.sparse.issparse(O) and not scipy.sparse.issparse(G):
+        sumMinimum = sumSquares = sumAbsolute = 0.0
+        countO = countG = countBoth = 0
+        for rowStart in range(0, O.shape[0], tileSize):
+            oRows = np.asarray(O[rowStart:rowStart+tileSize])
+            gRows = np.asarray(G[rowStart:rowStart+tileSize])
+            tileMinimum, tileSquares, tileAbsolute = compare_tile(oRows, gRows)
+            sumMinimum += tileMinimum
+            sumSquares += tileSquares
+            sumAbsolute += tileAbsolute
+            Omask = oRows > 0
+            Gmask = gRows > 0
+            countO += np.count_nonzero(Omask)
+            countG += np.count_nonzero(Gmask)
+            countBoth += np.count_nonzero(Omask & Gmask)
+        return sumMinimum, sumSquares, sumAbsolute, countO, countG, countBoth
+
+    if scipy.sparse.issparse(O) and scipy.sparse.issparse(G):
+        O = to_canonical_csr(O).astype(np.float64)
+        G = to_canonical_csr(G).astype(np.float64)
+        difference = (O - G).data
+        return (
+            O.minimum(G).sum(),
+            np.dot(difference, difference),
+            np.abs(difference).sum(),
+            np.count_nonzero(O.data > 0),
+            np.count_nonzero(G.data > 0),
+            (O > 0).multiply(G > 0).count_nonzero()
+        )
+
+    sparseIsObserved = scipy.sparse.issparse(O)
+    S, X = (O, G) if sparseIsObserved else (G, O)
+    rows, cols, s = get_stored_entries(S)
+    s = s.astype(np.float64)
+    x = np.asarray(X[rows, cols], dtype=np.float64)
+
+    xMinimum, xSquares, xAbsolute, countX = dense_statistics(X, tileSize=tileSize)
+    difference = s - x
+    sumMinimum = xMinimum + (np.minimum(s, x) - np.minimum(x, 0)).sum()
+    sumSquares = xSquares + np.dot(difference, difference) - np.dot(x, x)
+    sumAbsolute = xAbsolute + (np.abs(difference) - np.abs(x)).sum()
+    countS = np.count_nonzero(s > 0)
+    countBoth = np.count_nonzero((s > 0) & (x > 0))
+
+    if sparseIsObserved:
+        return sumMinimum, sumSquares, sumAbsolute, countS, countX, countBoth
+    return sumMinimum, sumSquares, sumAbsolute, countX, countS, countBoth
+
+def get_matrix_sums(X, tileSize=1024):
+    '''Returns the (float64) row sums and column sums of the dense or scipy.sparse matrix X.
+    '''
+    if scipy.sparse.issparse(X):
+        return np.asarray(X.sum(axis=1), dtype=np.float64).ravel(), np.asarray(X.sum(axis=0), dtype=np.float64).ravel()
+    outgoing = np.zeros(X.shape[0], dtype=np.float64)
+    incoming = np.zeros(X.shape[1], dtype=np.float64)
+    for rowStart in range(0, X.shape[0], tileSize):
+        rows = np.asarray(X[rowStart:rowStart+tileSize])
+        outgoing[rowStart:rowStart+tileSize] = rows.sum(axis=1, dtype=np.float64)
+        incoming += rows.sum(axis=0, dtype=np.float64)
+    return outgoing, incoming
+
+def get_total_sum_of_squares(O, tileSize=1024):
+    '''Returns the sum of squared deviations of the entries of the dense or scipy.sparse matrix O from their mean.
+    '''
+    if scipy.sparse.issparse(O):
+        rows, cols, values = get_stored_entries(O)
+        size = O.shape[0] * O.shape[1]
+        mean = values.sum(dtype=np.float64) / size
+        deviations = values - mean
+        return np.dot(deviations, deviations) + (size - values.shape[0]) * mean**2
+
+    count, mean, m2 = 0, 0.0, 0.0
+    for rowStart in range(0, O.shape[0], tileSize):
+        oRows = np.asarray(O[rowStart:rowStart+tileSize])
+        count, mean, m2 = combine_moments(count, mean, m2, *get_tile_moments(oRows, oRows.sum(axis=1, dtype=np.float64)))
+    return m2
+
+def get_distance_histogram(X, distanceMatrix, bins=None, tileSize=1024):
+    '''Returns the distance histogram of the positive entries of the dense or scipy.sparse matrix X computed in `cpc_d`, where
+    `distanceMatrix` is square, condensed or a `DistanceBins` (in which case `bins` is not used).
+    '''
+    if isinstance(distanceMatrix, DistanceBins):
+        return distanceMatrix.histogram(X)
+    if bins is None:
+        bins = np.arange(0, np.ceil(distanceMatrix.max())+1, 2)
+
+    if scipy.sparse.issparse(X):
+        rows, cols, values = get_stored_entries(X)
+        mask = values > 0
+        return np.histogram(getDistances(distanceMatrix, rows[mask], cols[mask]), bins=bins, weights=values[mask])[0]
+
+    histogram = np.zeros(bins.shape[0]-1, dtype=float)
+    for rowStart in range(0, X.shape[0], tileSize):
+        rowEnd = min(rowStart + tileSize, X.shape[0])
+        distanceRows = getDistanceRows(distanceMatrix, rowStart, rowEnd)
+        rows = np.asarray(X[rowStart:rowEnd])
+        mask = rows > 0.0
+        histogram += np.histogram(distanceRows[mask], bins=bins, weights=rows[mask])[0]
+    return histogram
+
+#-----------------------------------------------------------------------------------------------------------------------------------
+# Fused metrics
+#-----------------------------------------------------------------------------------------------------------------------------------
+VECTOR_METRICS = ["cpc", "cpl", "nrmse", "rmse", "mae", "r2"]
+MATRIX_METRICS = ["cpc", "cpl", "cpc_d", "nrmse", "rmse", "mae", "r2"]
+
+EvaluationResult = collections.namedtuple("EvaluationResult",
+    MATRIX_METRICS + ["%s_incoming" % (metric) for metric in VECTOR_METRICS] + ["%s_outgoing" % (metric) for metric in VECTOR_METRICS]
+)
+EvaluationResult.__doc__ = '''Metrics between an observed and a generated migration matrix, as returned by `evaluate_metrics`. The `_incoming` and `_outgoing`
+metrics compare the column sums and the row sums of the matrices.'''
+
+def combine_moments(count, mean, m2, blockCount, blockMean, blockM2):
+    '''Combines the (count, mean, sum of squared deviations from the mean) of two sets of values (Chan et al.'s parallel algorithm).
+    '''
+    if blockCount == 0:
+        return count, mean, m2
+    total = count + blockCount
+    delta = blockMean - mean
+    mean = mean + delta * blockCount / total
+    m2 = m2 + blockM2 + delta**2 * count * blockCount / total
+    return total, mean, m2
+
+def get_r2(ssRes, ssTot):
+    '''Coefficient of determination from the residual and total sums of squares, with the same conventions as sklearn's `r2_score`
+    for constant observations.
+    '''
+    if ssTot == 0:
+        return 1.0 if ssRes == 0 else 0.0
+    return 1.0 - ssRes / ssTot
+
+def vector_metrics(o, g):
+    '''Calculates the metrics in `VECTOR_METRICS` between the observed and generated 1D vectors `o` and `g` (e.g. incoming flows).
+
+    returns: dict of metric values
+    '''
+    o = np.asarray(o, dtype=np.float64)
+    g = np.asarray(g, dtype=np.float64)
+    difference = o - g
+    sumSquares = np.dot(difference, difference)
+
+    return {
+        "cpc": 2.0 * np.minimum(o, g).sum() / (o.sum() + g.sum()),
+        "cpl": 2.0 * np.sum((o>0)&(g>0)) / float(np.sum(o>0) + np.sum(g>0)),
+        "nrmse": np.sqrt(sumSquares / o.sum()),
+        "rmse": np.sqrt(sumSquares / o.shape[0]),
+        "mae": np.abs(difference).sum() / o.shape[0],
+        "r2": get_r2(sumSquares, np.sum((o - o.mean())**2)),
+    }
+
+def compare_tile(oRows, gRows):
+    '''Returns the sums of min(O,G), (O-G)**2 and |O-G| over a block of rows of O and G, reusing a single float64 temporary.
+    '''
+    temp = np.minimum(oRows, gRows, dtype=np.float64)
+    sumMinimum = temp.sum()
+    np.subtract(oRows, gRows, out=temp, dtype=np.float64)
+    sumSquares = np.einsum("ij,ij->", temp, temp)
+    np.abs(temp, out=temp)
+    sumAbsolute = temp.sum()
+    return sumMinimum, sumSquares, sumAbsolute
+
+def get_tile_moments(oRows, oRowSums):
+    '''Returns the (count, mean, sum of squared deviations from the mean) of a block of rows of O, see `combine_moments`.
+    '''
+    blockCount = oRows.size
+    if blockCount == 0:
+        return 0, 0.0, 0.0
+    blockMean = oRowSums.sum() / blockCount
+    temp = np.subtract(oRows, blockMean, dtype=np.float64)
+    return blockCount, blockMean, np.einsum("ij,ij->", temp, temp)
+
+def get_evaluation_result(sumMinimum, sumSquares, sumAbsolute, countO, countG, countBoth, ssTot, outgoingO, outgoingG, incomingO, incomingG, oBins=None, gBins=None):
+    '''Assembles an `EvaluationResult` from the statistics accumulated over the blocks of rows of O and G.
+    '''
+    sumO = outgoingO.sum()
+    sumG = outgoingG.sum()
+    size = float(outgoingO.shape[0] * incomingO.shape[0])
+
+    values = {
+        "cpc": 2.0 * sumMinimum / (sumO + sumG),
+        "cpl": 2.0 * countBoth / float(countO + countG),
+        "cpc_d": np.sum(np.minimum(oBins, gBins)) / np.sum(oBins) if oBins is not None else np.nan,
+        "nrmse": np.sqrt(sumSquares / sumO),
+        "rmse": np.sqrt(sumSquares / size),
+        "mae": sumAbsolute / size,
+        "r2": get_r2(sumSquares, ssTot),
+    }
+    for suffix, o, g in [("incoming", incomingO, incomingG), ("outgoing", outgoingO, outgoingG)]:
+        for metric, value in vector_metrics(o, g).items():
+            values["%s_%s" % (metric, suffix)] = value
+
+    return EvaluationResult(**values)
+
+def evaluate_metrics(O, G, distanceMatrix=None, tileSize=1024):
+    '''Calculates all of the metrics in `EvaluationResult` between the observed matrix, O, and the generated matrix, G, in a single pass
+    over blocks of `tileSize` rows, without flattening or copying either matrix (both can be memory maps).
+
+    The matrix metrics have the same definitions as `cpc`, `cpl`, `cpc_d`, `nrmse`, `rmse` and sklearn's `mean_absolute_error` and
+    `r2_score` on the flattened matrices. `cpc_d` is only computed when `distanceMatrix` (square, condensed or a `DistanceBins`) is
+    given, and is NaN otherwise. When O or G is a scipy.sparse matrix the metrics are computed from the stored entries instead, see
+    `get_pair_statistics`.
+
+    returns: EvaluationResult
+    '''
+    assert len(G.shape) == 2 and len(O.shape) == 2
+    assert G.shape[0] == O.shape[0] and G.shape[1] == O.shape[1]
+    n, m = O.shape
+
+    if scipy.sparse.issparse(O) or scipy.sparse.issparse(G):
+        sumMinimum, sumSquares, sumAbsolute, countO, countG, countBoth = get_pair_statistics(O, G, tileSize=tileSize)
+        outgoingO, incomingO = get_matrix_sums(O, tileSize=tileSize)
+        outgoingG, incomingG = get_matrix_sums(G, tileSize=tileSize)
+        oBins = gBins = None
+        if distanceMatrix is not None:
+            bins = np.arange(0, np.ceil(distanceMatrix.max())+1, 2) if not isinstance(distanceMatrix, DistanceBins) else None
+            oBins = get_distance_histogram(O, distanceMatrix, bins=bins, tileSize=tileSize)
+            gBins = get_distance_histogram(G, distanceMatrix, bins=bins, tileSize=tileSize)
+        return get_evaluation_result(sumMinimum, sumSquares, sumAbsolute, countO, countG, countBoth, get_total_sum_of_squares(O, tileSize=tileSize),
+            outgoingO, outgoingG, incomingO, incomingG, oBins=oBins, gBins=gBins)
+
+    oBins = gBins = None
+    distanceBins = distanceMatrix if isinstance(distanceMatrix, DistanceBins) else None
+    if distanceBins is not None:
+        assert distanceBins.shape == (n, m)
+        oBins = np.zeros(distanceBins.numBins + 1, dtype=float)
+        gBins = np.zeros(distanceBins.numBins + 1, dtype=float)
+    elif distanceMatrix is not None:
+        if isCondensed(distanceMatrix):
+            assert n == m and n == getDistanceMatrixSize(distanceMatrix)
+        else:
+            assert len(distanceMatrix.shape) == 2 and distanceMatrix.shape[0] == n and distanceMatrix.shape[1] == m
+        bins = np.arange(0, np.ceil(distanceMatrix.max())+1, 2)
+        oBins = np.zeros(bins.shape[0]-1, dtype=float)
+        gBins = np.zeros(bins.shape[0]-1, dtype=float)
+
+    sumMinimum = sumAbsolute = sumSquares = 0.0
+    countO = countG = countBoth = 0
+    count, mean, m2 = 0, 0.0, 0.0
+    outgoingO = np.zeros(n, dtype=np.float64)
+    outgoingG = np.zeros(n, dtype=np.float64)
+    incomingO = np.zeros(m, dtype=np.float64)
+    incomingG = np.zeros(m, dtype=np.float64)
+
+    for rowStart in range(0, n, tileSize):
+        rowEnd = min(rowStart + tileSize, n)
+        oRows = np.asarray(O[rowStart:rowEnd])
+        gRows = np.asarray(G[rowStart:rowEnd])
+
+        oRowSums = oRows.sum(axis=1, dtype=np.float64)
+        outgoingO[rowStart:rowEnd] = oRowSums
+        outgoingG[rowStart:rowEnd] = gRows.sum(axis=1, dtype=np.float64)
+        incomingO += oRows.sum(axis=0, dtype=np.float64)
+        incomingG += gRows.sum(axis=0, dtype=np.float64)
+
+        Omask = oRows > 0.0
+        Gmask = gRows > 0.0
+        countO += np.count_nonzero(Omask)
+        countG += np.count_nonzero(Gmask)
+        countBoth += np.count_nonzero(Omask & Gmask)
+
+        tileMinimum, tileSquares, tileAbsolute = compare_tile(oRows, gRows)
+        sumMinimum += tileMinimum
+        sumSquares += tileSquares
+        sumAbsolute += tileAbsolute
+        count, mean, m2 = combine_moments(count, mean, m2, *get_tile_moments(oRows, oRowSums))
+
+        if distanceBins is not None:
+            oBins += distanceBins.tile_histogram(rowStart, rowEnd, oRows, Omask)
+            gBins += distanceBins.tile_histogram(rowStart, rowEnd, gRows, Gmask)
+        elif distanceMatrix is not None:
+            distanceRows = getDistanceRows(distanceMatrix, rowStart, rowEnd)
+            oBins += np.histogram(distanceRows[Omask], bins=bins, weights=oRows[Omask])[0]
+            gBins += np.histogram(distanceRows[Gmask], bins=bins, weights=gRows[Gmask])[0]
+
+    if distanceBins is not None:
+        oBins, gBins = oBins[:distanceBins.numBins], gBins[:distanceBins.numBins]
+    return get_evaluation_result(sumMinimum, sumSquares, sumAbsolute, countO, countG, countBoth, m2,
+        outgoingO, outgoingG, incomingO, incomingG, oBins=oBins, gBins=gBins)
+
+#-----------------------------------------------------------------------------------------------------------------------------------
+# Cached distance bins
+#-----------------------------------------------------------------------------------------------------------------------------------
+class DistanceBins(object):
+    '''Precomputed assignment of every (origin, destination) pair to a distance bin, for calculating `cpc_d` with a `bincount` over the
+    flow values instead of rebuilding the bins and histogramming masked copies of the distance matrix on every call.
+
+    The bins are the same as in `cpc_d`, `np.arange(0, ceil(max distance)+1, binWidth)` with the same edge semantics as `np.histogram`
+    (the last bin is closed and distances past the last edge, which happens when `binWidth` does not divide the range, are dropped).
+    The bin index of each pair is stored in the smallest unsigned integer type that fits, e.g. 2 bytes per pair for county distances.
+    '''
+    def __init__(self, distanceMatrix, binWidth=2, tileSize=1024):
+        '''`distanceMatrix` can be square or condensed, or the filename of a `.npy` file of either (which is read as a memory map).
+        '''
+        if isinstance(distanceMatrix, str):
+            distanceMatrix = np.load(distanceMatrix, mmap_mode="r")
+
+        if isCondensed(distanceMatrix):
+            n = m = getDistanceMatrixSize(distanceMatrix)
+        else:
+            assert len(distanceMatrix.shape) == 2
+            n, m = distanceMatrix.shape
+
+        self.binWidth = binWidth
+        self.edges = np.arange(0, np.ceil(distanceMatrix.max())+1, binWidth)
+        self.numBins = self.edges.shape[0] - 1
+        assert self.numBins > 0, "`binWidth` must be smaller than the largest distance"
+
+        # pairs outside of the bins are assigned to an extra bin, `numBins`, which is dropped from the histograms
+        self.index = np.empty((n, m), dtype=np.min_scalar_type(self.numBins))
+        for rowStart in range(0, n, tileSize):
+            rowEnd = min(rowStart + tileSize, n)
+            distanceRows = np.asarray(getDistanceRows(distanceMatrix, rowStart, rowEnd))
+            binRows = np.searchsorted(self.edges, distanceRows, side="right") - 1
+            binRows[distanceRows == self.edges[-1]] = self.numBins - 1
+            binRows[(binRows < 0) | (binRows >= self.numBins)] = self.numBins
+            self.index[rowStart:rowEnd] = binRows
+
+        self.tileSize = tileSize
+
+    @property
+    def shape(self):
+        return self.index.shape
+
+    def save(self, fn):
+        np.savez(fn, index=self.index, edges=self.edges, binWidth=self.binWidth)
+
+    @classmethod
+    def load(cls, fn, tileSize=1024):
+        data = np.load(fn)
+        distanceBins = cls.__new__(cls)
+        distanceBins.index = data["index"]
+        distanceBins.edges = data["edges"]
+        distanceBins.binWidth = data["binWidth"].item()
+        distanceBins.numBins = distanceBins.edges.shape[0] - 1
+        distanceBins.tileSize = tileSize
+        return distanceBins
+
+    def tile_histogram(self, rowStart, rowEnd, rows, mask):
+        '''Returns the (numBins + 1) histogram of `rows` (rows [rowStart, rowEnd) of a matrix) where `mask` is True, the last bin holds
+        the pairs outside of the bins.
+        '''
+        binRows = self.index[rowStart:rowEnd].ravel()
+        return np.bincount(binRows, weights=np.where(mask, rows, 0.0).ravel(), minlength=self.numBins + 1)
+
+    def histogram(self, X):
+        '''Returns the total of the positive entries of X in each distance bin, i.e. the weighted histogram computed in `cpc_d`.
+        '''
+        return self.histograms([X])[0]
+
+    def histograms(self, Xs):
+        '''Returns a (k x numBins) array with the histogram of each of the k matrices in `Xs` (a (k x n x m) array or a list of matrices),
+        each block of rows of the bin index is read once for all of the dense matrices. Sparse matrices only read the bin index at their
+        stored entries.
+        '''
+        n, m = self.index.shape
+        for X in Xs:
+            assert X.shape == (n, m), "matrices must have shape %s" % (str((n, m)))
+
+        result = np.zeros((len(Xs), self.numBins + 1), dtype=np.float64)
+        for i, X in enumerate(Xs):
+            if scipy.sparse.issparse(X):
+                rows, cols, values = get_stored_entries(X)
+                mask = values > 0
+                result[i] = np.bincount(self.index[rows[mask], cols[mask]], weights=values[mask], minlength=self.numBins + 1)
+
+        for rowStart in range(0, n, self.tileSize):
+            rowEnd = min(rowStart + self.tileSize, n)
+            for i, X in enumerate(Xs):
+                if not scipy.sparse.issparse(X):
+                    rows = np.asarray(X[rowStart:rowEnd])
+                    result[i] += self.tile_histogram(rowStart, rowEnd, rows, rows > 0)
+        return result[:, :self.numBins]
+
+    def cpc_d(self, O, G):
+        '''Same as `cpc_d(O, G, distanceMatrix)`.
+        '''
+        oBins, gBins = self.histograms([O, G])
+        return np.sum(np.minimum(oBins, gBins)) / np.sum(oBins)
+
+    def cpc_d_batch(self, O, Gs):
+        '''Returns an array with `cpc_d(O, G)` for each of the generated matrices in `Gs` (a (k x n x m) array or a list of matrices).
+        '''
+        oBins = self.histogram(O)
+        gBins = self.histograms(Gs)
+        return np.minimum(oBins, gBins).sum(axis=1) / np.sum(oBins)
+
+#-----------------------------------------------------------------------------------------------------------------------------------
+# Batched evaluation
+#-----------------------------------------------------------------------------------------------------------------------------------
+class ObservedFlows(object):
+    '''Everything that `evaluate_metrics` derives from the observed matrix O alone (row/column sums, number of positive entries, total sum
+    of squares and distance histogram), computed once so that it can be shared by the evaluation of many generated matrices. O and the
+    generated matrices can be dense or scipy.sparse.
+    '''
+    def __init__(self, O, distanceMatrix=None, binWidth=2, tileSize=1024):
+        '''`distanceMatrix` can be square, condensed or a `DistanceBins`, it is turned into a `DistanceBins` (with `binWidth`) otherwise.
+        '''
+        assert len(O.shape) == 2
+        self.O = O
+        self.shape = O.shape
+        self.tileSize = tileSize
+        n, m = O.shape
+
+        if distanceMatrix is None or isinstance(distanceMatrix, DistanceBins):
+            self.distanceBins = distanceMatrix
+        else:
+            self.distanceBins = DistanceBins(distanceMatrix, binWidth=binWidth, tileSize=tileSize)
+        if self.distanceBins is not None:
+            assert self.distanceBins.shape == (n, m)
+
+        if scipy.sparse.issparse(O):
+            self.O = to_canonical_csr(O)
+            self.outgoing, self.incoming = get_matrix_sums(self.O)
+            self.countO = np.count_nonzero(self.O.data > 0)
+            self.ssTot = get_total_sum_of_squares(self.O)
+            self.oBins = self.distanceBins.histogram(self.O) if self.distanceBins is not None else None
+            return
+
+        self.countO = 0
+        count, mean, self.ssTot = 0, 0.0, 0.0
+        self.outgoing = np.zeros(n, dtype=np.float64)
+        self.incoming = np.zeros(m, dtype=np.float64)
+        self.oBins = np.zeros(self.distanceBins.numBins + 1, dtype=float) if self.distanceBins is not None else None
+
+        for rowStart in range(0, n, tileSize):
+            rowEnd = min(rowStart + tileSize, n)
+            oRows = np.asarray(O[rowStart:rowEnd])
+            oRowSums = oRows.sum(axis=1, dtype=np.float64)
+            self.outgoing[rowStart:rowEnd] = oRowSums
+            self.incoming += oRows.sum(axis=0, dtype=np.float64)
+
+            Omask = oRows > 0.0
+            self.countO += np.count_nonzero(Omask)
+            count, mean, self.ssTot = combine_moments(count, mean, self.ssTot, *get_tile_moments(oRows, oRowSums))
+            if self.distanceBins is not None:
+                self.oBins += self.distanceBins.tile_histogram(rowStart, rowEnd, oRows, Omask)
+
+        if self.oBins is not None:
+            self.oBins = self.oBins[:self.distanceBins.numBins]
+
+    def evaluate(self, G):
+        '''Same as `evaluate_metrics(O, G, distanceMatrix)`, but only the terms that involve G are computed.
+
+        returns: EvaluationResult
+        '''
+        assert G.shape == self.shape, "`G` must have shape %s" % (str(self.shape))
+        n, m = self.shape
+
+        if scipy.sparse.issparse(self.O) or scipy.sparse.issparse(G):
+            sumMinimum, sumSquares, sumAbsolute, countO, countG, countBoth = get_pair_statistics(self.O, G, tileSize=self.tileSize)
+            outgoingG, incomingG = get_matrix_sums(G, tileSize=self.tileSize)
+            gBins = self.distanceBins.histogram(G) if self.distanceBins is not None else None
+            return get_evaluation_result(sumMinimum, sumSquares, sumAbsolute, self.countO, countG, countBoth, self.ssTot,
+                self.outgoing, outgoingG, self.incoming, incomingG, oBins=self.oBins, gBins=gBins)
+
+        sumMinimum = sumAbsolute = sumSquares = 0.0
+        countG = countBoth = 0
+        outgoingG = np.zeros(n, dtype=np.float64)
+        incomingG = np.zeros(m, dtype=np.float64)
+        gBins = np.zeros(self.distanceBins.numBins + 1, dtype=float) if self.distanceBins is not None else None
+
+        for rowStart in range(0, n, self.tileSize):
+            rowEnd = min(rowStart + self.tileSize, n)
+            oRows = np.asarray(self.O[rowStart:rowEnd])
+            gRows = np.asarray(G[rowStart:rowEnd])
+
+            outgoingG[rowStart:rowEnd] = gRows.sum(axis=1, dtype=np.float64)
+            incomingG += gRows.sum(axis=0, dtype=np.float64)
+
+            Gmask = gRows > 0.0
+            countG += np.count_nonzero(Gmask)
+            countBoth += np.count_nonzero((oRows > 0.0) & Gmask)
+
+            tileMinimum, tileSquares, tileAbsolute = compare_tile(oRows, gRows)
+            sumMinimum += tileMinimum
+            sumSquares += tileSquares
+            sumAbsolute += tileAbsolute
+
+            if gBins is not None:
+                gBins += self.distanceBins.tile_histogram(rowStart, rowEnd, gRows, Gmask)
+
+        if gBins is not None:
+            gBins = gBins[:self.distanceBins.numBins]
+        return get_evaluation_result(sumMinimum, sumSquares, sumAbsolute, self.countO, countG, countBoth, self.ssTot,
+            self.outgoing, outgoingG, self.incoming, incomingG, oBins=self.oBins, gBins=gBins)
+
+def evaluate_many(O, predictions, distanceMatrix=None, labels=None, workers=1, binWidth=2, tileSize=1024):
+    '''Evaluates many generated matrices against one observed matrix, O, sharing all of the work on O between them.
+
+    Inputs:
+        O - the observed matrix, or an `ObservedFlows` built from it (in which case `distanceMatrix` is ignored)
+        predictions - a (k x n x m) array, a list or a generator of (n x m) generated matrices, or a dict of label => matrix
+        distanceMatrix - square, condensed or a `DistanceBins`, to calculate cpc_d with
+        labels - the labels of the predictions (e.g. (model, year, alpha) tuples), in the same order, defaults to 0..k-1
+        workers - number of threads to evaluate the predictions with, at most 2*workers predictions are held at a time so that
+                  generators of large matrices can be evaluated in bounded memory
+
+    returns: a pandas DataFrame with one row per prediction and one column per field of `EvaluationResult`
+    '''
+    if not isinstance(O, ObservedFlows):
+        O = ObservedFlows(O, distanceMatrix, binWidth=binWidth, tileSize=tileSize)
+
+    if isinstance(predictions, dict):
+        labels, predictions = list(predictions.keys()), predictions.values()
+
+    results = []
+    if workers == 1:
+        for G in predictions:
+            results.append(O.evaluate(G))
+    else:
+        resultsByIndex = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = {}
+            for i, G in enumerate(predictions):
+                pending[executor.submit(O.evaluate, G)] = i
+                del G
+                if len(pending) >= 2 * workers:
+                    done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        resultsByIndex[pending.pop(future)] = future.result()
+            for future in concurrent.futures.as_completed(pending):
+                resultsByIndex[pending[future]] = future.result()
+        results = [resultsByIndex[i] for i in range(len(resultsByIndex))]
+
+    if labels is not None:
+        labels = list(labels)
+        assert len(labels) == len(results), "`labels` must have one entry per prediction"
+        if len(labels) > 0 and isinstance(labels[0], tuple):
+            labels = pd.MultiIndex.from_tuples(labels)
+
+    return pd.DataFrame(results, columns=EvaluationResult._fields, index=labels)
+
 if __name__ == "__main__":
     pass
\ No newline at end of file
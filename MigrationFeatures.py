@@ -0,0 +1,221 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2017 Caleb Robinson <calebrob6@gmail.com>
+#
+# Distributed under terms of the MIT license.
+'''
+Vectorized construction of the origin-destination pair features used to train the machine learning migration models.
+
+Each (origin, destination) pair is a row of the feature matrix X with the columns in `FEATURE_NAMES` (origin population, destination
+population, distance and intervening opportunities), and the observed flow between them is the matching entry of Y. Pairs are in
+row-major order, i.e. pair (i,j) is row i*m + j, so model predictions can be reshaped back to an (n x m) matrix.
+
+Like MigrationModels, `getPairFeatures` has a `slowMode` flag which builds the pairs with a nested for loop instead.
+
+`PairSampler` samples the positive and negative training pairs straight from the migration matrix, so that features only need to be
+built for the sampled pairs.
+'''
+import numpy as np
+import scipy.sparse
+
+from MigrationModels import getRows, getOutputBuffer
+from MigrationDistances import getDistances
+
+FEATURE_NAMES = ["origin_pop", "dest_pop", "D", "S"]
+
+#-----------------------------------------------------------------------------------------------------------------------------------
+#-----------------------------------------------------------------------------------------------------------------------------------
+def fillPairFeatures(origins, destinations, dRows, sRows, out):
+    '''Fills `out`, an (k*m x 4) block of rows of X, with the features of the pairs of k origins and all m destinations.
+    '''
+    assert out.flags.c_contiguous, "`out` must be C contiguous"
+    k, m = dRows.shape
+    X = out.reshape(k, m, len(FEATURE_NAMES))
+    X[:,:,0] = origins
+    X[:,:,1] = destinations.T
+    X[:,:,2] = dRows
+    X[:,:,3] = sRows
+    return out
+
+def getPairFeatures(origins, destinations, d, s, T=None, dtype=np.float64, out=None, yOut=None, chunkSize=1024, slowMode=False):
+    '''Builds the pair feature matrix X (and the matching flows Y when `T` is given).
+
+    Inputs:
+        origins, destinations - (n x 1) and (m x 1) populations
+        d, s - the (n x m) distance and intervening opportunities matrices, either arrays (which can be memory maps, only `chunkSize`
+               rows are read at a time) or functions `f(rowStart, rowEnd)` returning those rows (e.g. `MigrationModels.InterveningOpportunitiesRows`)
+        T - the (n x m) observed migration matrix, dense or scipy.sparse (densified `chunkSize` rows at a time)
+        dtype - dtype of X and Y, np.float32 halves their size
+        out, yOut - preallocated (n*m x 4) and (n*m,) arrays, or filenames of `.npy` files to create as memory maps, to write X and Y to
+
+    returns: X, or (X, Y) if `T` is given
+    '''
+    assert len(origins.shape) == 2 and origins.shape[1] == 1, "`origins` and `destinations` must be 2D with a single column"
+    assert len(destinations.shape) == 2 and destinations.shape[1] == 1, "`origins` and `destinations` must be 2D with a single column"
+
+    n = origins.shape[0]
+    m = destinations.shape[0]
+
+    X = getOutputBuffer(out, (n*m, len(FEATURE_NAMES)), dtype)
+    Y = getOutputBuffer(yOut, (n*m,), dtype) if T is not None else None
+
+    if slowMode:
+        for i in range(n):
+            for j in range(m):
+                idx = (i*m) + j
+                X[idx,:] = [
+                    origins[i,0],
+                    destinations[j,0],
+                    d[i,j],
+                    s[i,j],
+                ]
+                if T is not None:
+                    Y[idx] = T[i,j]
+    else:
+        for rowStart, rowEnd, XChunk, YChunk in iterPairFeatures(origins, destinations, d, s, T=T, dtype=dtype, chunkSize=chunkSize, out=X, yOut=Y):
+            pass
+
+    for array in [X, Y]:
+        if isinstance(array, np.memmap):
+            array.flush()
+
+    if T is not None:
+        return X, Y
+    return X
+
+def iterPairFeatures(origins, destinations, d, s, T=None, dtype=np.float64, chunkSize=1024, out=None, yOut=None):
+    '''Yields (rowStart, rowEnd, X, Y) with the pair features (and flows, Y is None if `T` is not given) of origins [rowStart, rowEnd),
+    i.e. rows [rowStart*m, rowEnd*m) of the result of `getPairFeatures`, so that training sets that do not fit in memory can be built
+    (or fed to a model) one chunk of origins at a time. See `getPairFeatures` for the inputs.
+
+    The same (chunkSize*m x 4) buffer is reused for every chunk, copy it to keep it, unless `out` and `yOut` (full sized arrays) are
+    given in which case the chunks are views of them.
+    '''
+    assert len(origins.shape) == 2 and origins.shape[1] == 1, "`origins` and `destinations` must be 2D with a single column"
+    assert len(destinations.shape) == 2 and destinations.shape[1] == 1, "`origins` and `destinations` must be 2D with a single column"
+
+    n = origins.shape[0]
+    m = destinations.shape[0]
+    if scipy.sparse.issparse(T):
+        T = T.tocsr()
+
+    if out is None:
+        buffer = np.empty((min(chunkSize, n)*m, len(FEATURE_NAMES)), dtype=dtype)
+    if yOut is None and T is not None:
+        yBuffer = np.empty(min(chunkSize, n)*m, dtype=dtype)
+
+    for rowStart in range(0, n, chunkSize):
+        rowEnd = min(rowStart + chunkSize, n)
+        k = rowEnd - rowStart
+
+        XChunk = out[rowStart*m:rowEnd*m] if out is not None else buffer[:k*m]
+        fillPairFeatures(origins[rowStart:rowEnd], destinations, getRows(d, rowStart, rowEnd), getRows(s, rowStart, rowEnd), XChunk)
+
+        YChunk = None
+        if T is not None:
+            YChunk = yOut[rowStart*m:rowEnd*m] if yOut is not None else yBuffer[:k*m]
+            YChunk.reshape(k, m)[:] = T[rowStart:rowEnd].toarray() if scipy.sparse.issparse(T) else getRows(T, rowStart, rowEnd)
+
+        yield rowStart, rowEnd, XChunk, YChunk
+
+#-----------------------------------------------------------------------------------------------------------------------------------
+# Sampling pairs
+#-----------------------------------------------------------------------------------------------------------------------------------
+def getPairFeaturesAt(origins, destinations, d, s, rows, cols, dtype=np.float64):
+    '''Returns the (k x 4) features of the pairs (rows[i], cols[i]) only, i.e. the matching rows of `getPairFeatures`.
+
+    `d` and `s` can be arrays or memory maps (only the sampled entries are read), `d` can also be a condensed distance matrix.
+    '''
+    X = np.empty((rows.shape[0], len(FEATURE_NAMES)), dtype=dtype)
+    X[:,0] = origins[rows,0]
+    X[:,1] = destinations[cols,0]
+    X[:,2] = getDistances(d, rows, cols)
+    X[:,3] = s[rows, cols]
+    return X
+
+class PairSampler(object):
+    '''Samples training pairs directly from the non-zero structure of an (n x m) migration matrix T, without building the features of
+    all n*m pairs: all of the positive pairs (T > 0) plus `negativeRatio` negative pairs (T == 0) per positive pair.
+
+    Negatives are drawn uniformly with replacement, like `np.random.choice(negative_indices, replace=True)` in the training notebooks,
+    but from their ranks among the negative pairs (mapped to pair indices with a search in the sorted positive pair indices) instead of
+    from a list of all of the negative pairs. The notebooks draw max(number of negative pairs, 40 * number of positive pairs) negatives,
+    which can be reproduced with `numNegatives`.
+    '''
+    def __init__(self, T, negativeRatio=40, numNegatives=None, seed=None):
+        '''`T` can be a dense array (or memory map) or a scipy.sparse matrix, `seed` makes the samples reproducible.
+        '''
+        assert len(T.shape) == 2
+        self.shape = T.shape
+        n, m = T.shape
+
+        if scipy.sparse.issparse(T):
+            T = T.tocsr()
+            if not T.has_canonical_format:
+                T = T.copy()
+                T.sum_duplicates()
+            rows = np.repeat(np.arange(n, dtype=np.int64), np.diff(T.indptr))
+            mask = T.data > 0
+            self.positiveKeys = rows[mask] * m + T.indices[mask]
+            self.positiveValues = T.data[mask]
+        else:
+            self.positiveKeys = np.flatnonzero(np.asarray(T) > 0).astype(np.int64)
+            self.positiveValues = np.asarray(T).ravel()[self.positiveKeys]
+
+        self.numPositives = self.positiveKeys.shape[0]
+        self.numNegativePairs = n * m - self.numPositives
+        # the number of negative pairs before each positive pair
+        self.negativesBefore = self.positiveKeys - np.arange(self.numPositives, dtype=np.int64)
+        if numNegatives is None:
+            numNegatives = int(negativeRatio * self.numPositives)
+        self.numNegatives = numNegatives
+        assert self.numNegatives == 0 or self.numNegativePairs > 0, "T has no negative pairs to sample"
+
+        self.random = np.random.RandomState(seed)
+
+    def sampleNegatives(self, numNegatives=None):
+        '''Returns the indices (row*m + col), in increasing order, of `numNegatives` negative pairs drawn uniformly with replacement.
+        '''
+        if numNegatives is None:
+            numNegatives = self.numNegatives
+
+        # Draw the ranks u of the negative pairs, the u-th negative pair is u plus the number of positive pairs before it, which is the
+        # number of positive pairs with at most u negative pairs before them. Sorted draws make the search sequential.
+        ranks = np.sort(self.random.randint(0, self.numNegativePairs, size=numNegatives, dtype=np.int64))
+        return ranks + np.searchsorted(self.negativesBefore, ranks, side="right")
+
+    def sample(self, shuffle=False):
+        '''Returns (rows, cols, Y) of all of the positive pairs followed by a new sample of negative pairs (both in row-major order), or
+        of the same pairs in random order if `shuffle` is True.
+        '''
+        m = self.shape[1]
+        keys = np.concatenate([self.positiveKeys, self.sampleNegatives()])
+        Y = np.zeros(keys.shape[0], dtype=self.positiveValues.dtype)
+        Y[:self.numPositives] = self.positiveValues
+
+        if shuffle:
+            order = self.random.permutation(keys.shape[0])
+            keys, Y = keys[order], Y[order]
+        return keys // m, keys % m, Y
+
+    def getTrainingSet(self, origins, destinations, d, s, shuffle=False, dtype=np.float64):
+        '''Returns (X, Y) for a sample of pairs, see `sample`, with the features gathered for the sampled pairs only.
+        '''
+        rows, cols, Y = self.sample(shuffle=shuffle)
+        return getPairFeaturesAt(origins, destinations, d, s, rows, cols, dtype=dtype), Y.astype(dtype)
+
+    def iterBatches(self, origins, destinations, d, s, batchSize=2**12, numEpochs=1, dtype=np.float64):
+        '''Yields (X, Y) mini-batches of shuffled pairs, the negative pairs are resampled at the start of every epoch and features are
+        only gathered for the pairs of the current batch.
+        '''
+        for epoch in range(numEpochs):
+            rows, cols, Y = self.sample(shuffle=True)
+            for batchStart in range(0, rows.shape[0], batchSize):
+                batch = slice(batchStart, batchStart + batchSize)
+                yield getPairFeaturesAt(origins, destinations, d, s, rows[batch], cols[batch], dtype=dtype), Y[batch].astype(dtype)
+
+
+if __name__ == "__main__":
+    pass
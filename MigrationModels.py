@@ -9,7 +9,7 @@
 Vectorized (fast) implementation of the radiation model[1], the extended radiation model[2], and the gravity model with power and exponential law decay[3].
 
 All implementations have a `slowMode` flag which, when true, calculates the results using a nested for loop (instead of in a vectorized manner).
-We inlcude tests that assert the results of the vectorized implementation against the "slowMode" implementations.
+The vectorized implementations are checked against the "slowMode" implementations in tests/test_MigrationModels.py.
 
 [1] Simini, Filippo, et al. "A universal model for mobility and migration patterns." Nature 484.7392 (2012): 96-100.
 [2] Yang, Yingxiang, et al. "Limits of Predictability in Commuting Flows in the Absence of Data for Calibration." Scientific Reports 4 (2014).
@@ -18,8 +18,15 @@ We inlcude tests that assert the results of the vectorized implementation agains
 import sys
 import os
 import time
+import warnings
+import concurrent.futures
 
 import numpy as np
+import scipy.sparse
+import scipy.spatial
+
+from MigrationDistances import EARTH_RADIUS_KM, latLonToUnitVectors, isCondensed, getDistanceRows, CONDENSED_TILE_SIZE, getDistanceMatrixSize, MemmapPicklable
+from MigrationDistances import MemmapReference, getMemmapReference, openMemmapReference
 
 #-----------------------------------------------------------------------------------------------------------------------------------
 # Misc methods
@@ -31,9 +38,32 @@ def row_normalize(P):
     assert len(P.shape) == 2
     return P / P.sum(axis=1, keepdims=True)
 
+def getOutputBuffer(out, shape, dtype):
+    '''Returns `out` after checking that it can hold a result of the given shape and dtype, a new `.npy` memory map if `out` is a
+    filename, or a new uninitialized array if `out` is None.
+    '''
+    if isinstance(out, str):
+        return np.lib.format.open_memmap(out, mode="w+", dtype=dtype, shape=shape)
+    if out is None:
+        return np.empty(shape, dtype=dtype)
+    assert out.shape == shape, "`out` must have shape %s" % (str(shape))
+    assert out.dtype == np.dtype(dtype), "`out` must have dtype %s" % (np.dtype(dtype).name)
+    return out
+
+def sanitize(P):
+    '''Sets the NaN and inf entries of P to 0 in place (in a single pass), and returns P.
+    '''
+    return np.nan_to_num(P, copy=False, nan=0.0, posinf=0.0, neginf=0.0)
+
 #-----------------------------------------------------------------------------------------------------------------------------------
 #-----------------------------------------------------------------------------------------------------------------------------------
-def extendedRadiationModel(origins, destinations, s, alpha, slowMode=False):
+def extendedRadiationModel(origins, destinations, s, alpha, slowMode=False, dtype=np.float64, out=None):
+    '''The vectorized implementation only allocates one (n x m) temporary besides the result, `dtype` sets the precision the model is
+    computed in (np.float32 halves the memory use, but overflows once (s + origins + destinations)**alpha exceeds ~3e38) and `out` can be used to pass a preallocated (n x m) result array.
+
+    Note: for very large alphas, where ((s + origins)**alpha + 1) * ((s + origins + destinations)**alpha + 1) overflows, the slowMode
+    implementation returns 0 while the vectorized implementation still returns the (finite) value of the model.
+    '''
     assert len(origins.shape) == 2 and origins.shape[1] == 1, "`origins` and `destinations` must be 2D with a single column"
     assert len(destinations.shape) == 2 and destinations.shape[1] == 1, "`origins` and `destinations` must be 2D with a single column"
 
@@ -42,30 +72,56 @@ def extendedRadiationModel(origins, destinations, s, alpha, slowMode=False):
 
     assert len(s.shape) == 2 and s.shape[0] == n and s.shape[1] == m, "`s` must be a square matrix with same length/width as the origin and destination features"
 
-    origins = origins.astype(np.float)
-    destinations = destinations.astype(np.float)
-    P = np.zeros((n,m), dtype=float)
+    if isinstance(s, SparseInterveningOpportunities):
+        assert not slowMode, "`slowMode` is not supported for sparse `s`"
+        return s.evaluate(extendedRadiationModelValues, origins, destinations, alpha, dtype=dtype)
 
     if slowMode:
+        origins = origins.astype(float)[:,0]
+        destinations = destinations.astype(float)[:,0]
+        P = np.zeros((n,m), dtype=float)
+
         for i in range(n):
             for j in range(m):
                 numerator = ((origins[i] + destinations[j] + s[i,j])**alpha - (origins[i] + s[i,j])**alpha) * (origins[i]**alpha + 1)
                 denominator = ((origins[i] + s[i,j])**alpha + 1) * ((origins[i] + destinations[j] + s[i,j])**alpha + 1)
                 P[i,j] = numerator/denominator
     else:
-        numerator = ((s + origins + destinations.T)**alpha - (s + origins)**alpha) * (origins**alpha + 1)
-        denominator = ((s+origins)**alpha + 1) * ((s + origins  + destinations.T)**alpha + 1)
-        P = np.divide(numerator,denominator)
+        origins = origins.astype(dtype)
+        destinations = destinations.astype(dtype)
+        P = getOutputBuffer(out, (n,m), dtype)
+        temp = np.empty((n,m), dtype=dtype)
+
+        # With x = (s + origins)**alpha and y = (s + origins + destinations)**alpha the model is
+        # ((y - x) * (origins**alpha + 1)) / ((x + 1) * (y + 1)) = (origins**alpha + 1) * (1/(x + 1) - 1/(y + 1))
+        with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+            np.add(s, origins, out=temp)
+            np.add(temp, destinations.T, out=P)
+
+            np.power(temp, alpha, out=temp)
+            temp += 1.0
+            np.reciprocal(temp, out=temp)
+
+            np.power(P, alpha, out=P)
+            P += 1.0
+            np.reciprocal(P, out=P)
 
-    P[np.isnan(P) | np.isinf(P)] = 0.0
-    assert not np.any(np.isnan(P))
-    assert not np.any(np.isinf(P))
+            temp -= P
+            # 1/(y + 1) is 0 only where y overflowed, the original formulation gives inf/inf (which is set to 0) there
+            np.sign(P, out=P)
+            P *= temp
+            P *= origins**alpha + 1.0
 
-    return P
+        del temp
+
+    return sanitize(P)
 
 #-----------------------------------------------------------------------------------------------------------------------------------
 #-----------------------------------------------------------------------------------------------------------------------------------
-def radiationModel(origins, destinations, s, slowMode=False):
+def radiationModel(origins, destinations, s, slowMode=False, dtype=np.float64, out=None):
+    '''The vectorized implementation only allocates one (n x m) temporary besides the result, see `extendedRadiationModel` for `dtype`
+    and `out`.
+    '''
     assert len(origins.shape) == 2 and origins.shape[1] == 1, "`origins` and `destinations` must be 2D with a single column"
     assert len(destinations.shape) == 2 and destinations.shape[1] == 1, "`origins` and `destinations` must be 2D with a single column"
 
@@ -74,46 +130,67 @@ def radiationModel(origins, destinations, s, slowMode=False):
 
     assert len(s.shape) == 2 and s.shape[0] == n and s.shape[1] == m, "`s` must be a square matrix with same length/width as the origin and destination features"
 
-    origins = origins.astype(np.float)
-    destinations = destinations.astype(np.float)
-    P = np.zeros((n,m), dtype=float)
+    if isinstance(s, SparseInterveningOpportunities):
+        assert not slowMode, "`slowMode` is not supported for sparse `s`"
+        return s.evaluate(radiationModelValues, origins, destinations, dtype=dtype)
 
     if slowMode:
+        origins = origins.astype(float)[:,0]
+        destinations = destinations.astype(float)[:,0]
+        P = np.zeros((n,m), dtype=float)
+
         for i in range(n):
             for j in range(m):
                 P[i,j] = (origins[i] * destinations[j]) / ((s[i,j] + origins[i]) * (s[i,j] + origins[i] + destinations[j]))
     else:
-        numerator = np.dot(origins,destinations.T)
-        denominator = (s + origins) * (s + origins + destinations.T) 
-        
-        P = np.divide(numerator,denominator)
+        origins = origins.astype(dtype)
+        destinations = destinations.astype(dtype)
+        P = getOutputBuffer(out, (n,m), dtype)
+        temp = np.empty((n,m), dtype=dtype)
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            # denominator
+            np.add(s, origins, out=temp)
+            np.add(temp, destinations.T, out=P)
+            P *= temp
 
-    P[np.isnan(P) | np.isinf(P)] = 0.0
-    assert not np.any(np.isnan(P))
-    assert not np.any(np.isinf(P))
+            # numerator
+            np.multiply(origins, destinations.T, out=temp)
+            np.divide(temp, P, out=P)
 
-    return P
+        del temp
+
+    return sanitize(P)
 
 #-----------------------------------------------------------------------------------------------------------------------------------
 #-----------------------------------------------------------------------------------------------------------------------------------
-def gravityModel(origins, destinations, d, alpha, decay="power", slowMode=False):
+def gravityModel(origins, destinations, d, alpha, decay="power", slowMode=False, dtype=np.float64, out=None):
+    '''See `extendedRadiationModel` for `dtype` and `out`, the vectorized implementation does not allocate any (n x m) temporaries.
+
+    `d` can also be a condensed distance matrix (see `MigrationDistances`), in which case it is read into the result array a block of
+    rows at a time instead of being expanded to a square matrix.
+    '''
     assert len(origins.shape) == 2 and origins.shape[1] == 1, "`origins` and `destinations` must be 2D with a single column"
     assert len(destinations.shape) == 2 and destinations.shape[1] == 1, "`origins` and `destinations` must be 2D with a single column"
 
     n = origins.shape[0]
     m = destinations.shape[0]
 
-    assert len(d.shape) == 2 and d.shape[0] == n and d.shape[1] == m, "`d` must be a square matrix with same length/width as the origin and destination features"
+    if isCondensed(d):
+        assert getDistanceMatrixSize(d) == n and n == m, "A condensed `d` must have the same length/width as the origin and destination features"
+        assert not slowMode, "`slowMode` is not supported for a condensed `d`"
+    else:
+        assert len(d.shape) == 2 and d.shape[0] == n and d.shape[1] == m, "`d` must be a square matrix with same length/width as the origin and destination features"
 
     assert decay in ["power", "exponential"], "`decay` must be either 'power' or 'exponential'"
 
-    origins = origins.astype(np.float)
-    destinations = destinations.astype(np.float)
-    d = d.astype(np.float)
+    if slowMode:
+        origins = origins.astype(float)[:,0]
+        destinations = destinations.astype(float)[:,0]
+        d = d.astype(float)
 
-    P = np.zeros((n,m), dtype=float)
+        P = np.zeros((n,m), dtype=float)
 
-    if slowMode:
         for i in range(n):
             for j in range(m):
                 if i!=j: # on the diagonal the distance matrix will be zero, so we ignore these
@@ -122,35 +199,97 @@ def gravityModel(origins, destinations, d, alpha, decay="power", slowMode=False)
                     elif decay=="exponential":
                         P[i,j] = (origins[i] * destinations[j]) / (np.exp(d[i,j]*alpha))                
     else:
-        numerator = np.dot(origins,destinations.T)
-        denominator = None
-        if decay=="power":
-            denominator = d**(alpha)
-        elif decay=="exponential":
-            denominator = np.exp(d*alpha)
-        # the denominator will be 0 where d[i,j] == 0, causing a divide by zero error 
-        mask = denominator==0 # record where there are 0's
-        denominator[mask]=1.0 # set the 0's to 1.0, avoiding the divide by 0
-        P = np.divide(numerator,denominator)
-        P[mask] = 0.0 # set the results that would have been divided by 0, to 0
-
-    P[np.isnan(P) | np.isinf(P)] = 0.0
-    assert not np.any(np.isnan(P))
-    assert not np.any(np.isinf(P))
-
-    return P
+        origins = origins.astype(dtype)
+        destinations = destinations.astype(dtype)
+        P = getOutputBuffer(out, (n,m), dtype)
+
+        if isCondensed(d):
+            for rowStart in range(0, n, CONDENSED_TILE_SIZE):
+                P[rowStart:rowStart+CONDENSED_TILE_SIZE] = getDistanceRows(d, rowStart, min(rowStart+CONDENSED_TILE_SIZE, n))
+            d = P
+
+        with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+            # denominator
+            if decay=="power":
+                np.power(d, alpha, out=P)
+            elif decay=="exponential":
+                np.multiply(d, alpha, out=P)
+                np.exp(P, out=P)
+
+            # the denominator will be 0 where d[i,j] == 0, its reciprocal is inf there and the result is set to 0 by `sanitize`
+            np.reciprocal(P, out=P)
+            P *= origins
+            P *= destinations.T
+
+    return sanitize(P)
 
 #-----------------------------------------------------------------------------------------------------------------------------------
 #-----------------------------------------------------------------------------------------------------------------------------------
-def getInterveningOpportunities(features, distanceMatrix, slowMode=False):
-    assert len(features.shape) == 2
-    assert features.shape[1] == 1
+def getDistanceRanks(distanceMatrix, tileSize=1024):
+    '''Returns, for each row of `distanceMatrix`, the column indices sorted by increasing distance (a stable sort, so ties are in index order).
+
+    The result only depends on the distance matrix, so it can be computed once, saved with `np.save` (or loaded with `mmap_mode="r"`),
+    and passed as `ranks` to `getInterveningOpportunities` for every year of population data. `distanceMatrix` can be condensed.
+    '''
+    if isCondensed(distanceMatrix):
+        n = m = getDistanceMatrixSize(distanceMatrix)
+    else:
+        assert len(distanceMatrix.shape)==2
+        n, m = distanceMatrix.shape
 
-    n = features.shape[0]
+    ranks = np.empty((n, m), dtype=np.int32 if m < 2**31 else np.int64)
+    for rowStart in range(0, n, tileSize):
+        rowEnd = min(rowStart+tileSize, n)
+        # Very important that we use mergesort here as it is a stable sort
+        ranks[rowStart:rowEnd] = np.argsort(getDistanceRows(distanceMatrix, rowStart, rowEnd), kind="mergesort", axis=1)
+    return ranks
+
+def scatterInterveningOpportunities(features, ranks, out):
+    '''Fills `out` (a (k x n) block of rows of S) from the matching rows of `ranks` (see `getDistanceRanks`).
+
+    In sorted order, the closest location (the origin itself) and the second closest one get 0 intervening opportunities, then each
+    location gets the sum of the features of the locations before it, not counting the origin.
+    '''
+    k, n = ranks.shape
+    sortedS = np.zeros((k, n), dtype=np.float64)
+    if n > 2:
+        np.cumsum(features[ranks[:,1:-1], 0], axis=1, out=sortedS[:,2:])
+    np.put_along_axis(out, ranks, sortedS.astype(out.dtype, copy=False), axis=1)
+    return out
+
+def getInterveningOpportunities(features, distanceMatrix, slowMode=False, ranks=None, tileSize=1024):
+    '''Computes the (n x n) intervening opportunities matrix S, where S[i,j] is the sum of the features of the locations that are closer
+    to i than j is (excluding i itself).
+
+    `features` is either an (n x 1) vector or a (k x n x 1) stack of vectors (e.g. one population vector per year) in which case a
+    (k x n x n) stack of S matrices is returned. All of them are computed from a single sort of the distance matrix, which can also be
+    passed precomputed as `ranks` (see `getDistanceRanks`), in which case `distanceMatrix` can be None. `distanceMatrix` can be condensed.
+    '''
+    if len(features.shape) == 3:
+        assert features.shape[2] == 1
+        n = features.shape[1]
+    else:
+        assert len(features.shape) == 2
+        assert features.shape[1] == 1
+        n = features.shape[0]
+
+    if slowMode:
+        assert len(distanceMatrix.shape)==2
+        assert distanceMatrix.shape[0] == distanceMatrix.shape[1]
+        assert distanceMatrix.shape[0] == n
+    elif ranks is None:
+        assert isCondensed(distanceMatrix) or (len(distanceMatrix.shape)==2 and distanceMatrix.shape[0] == distanceMatrix.shape[1])
+        assert getDistanceMatrixSize(distanceMatrix) == n
+    else:
+        assert ranks.shape == (n, n)
 
-    assert len(distanceMatrix.shape)==2
-    assert distanceMatrix.shape[0] == distanceMatrix.shape[1]
-    assert distanceMatrix.shape[0] == n
+    if len(features.shape) == 3:
+        if ranks is None and not slowMode:
+            ranks = getDistanceRanks(distanceMatrix, tileSize=tileSize)
+        return np.stack([
+            getInterveningOpportunities(features[i], distanceMatrix, slowMode=slowMode, ranks=ranks, tileSize=tileSize)
+            for i in range(features.shape[0])
+        ])
 
     S = np.zeros((n, n), dtype=np.float32)
     
@@ -165,18 +304,487 @@ def getInterveningOpportunities(features, distanceMatrix, slowMode=False):
             cumSum = 0.0
             for distance, j in otherPatches[1:]:
                 S[i,j] = cumSum
-                cumSum += features[j]
+                cumSum += features[j,0]
     else:
-        # Very important that we use mergesort here as it is a stable sort
-        d = np.argsort(distanceMatrix, kind="mergesort", axis=1)
-
-        for i in range(n):
-            tempFeatures = features[d[i]]
-            newFeatures = [0,0] + list(np.cumsum(tempFeatures[1:-1]))
-            S[i,d[i]] =  newFeatures
+        for rowStart in range(0, n, tileSize):
+            rowEnd = min(rowStart + tileSize, n)
+            if ranks is None:
+                rankRows = getDistanceRanks(getDistanceRows(distanceMatrix, rowStart, rowEnd))
+            else:
+                rankRows = np.asarray(ranks[rowStart:rowEnd])
+            scatterInterveningOpportunities(features, rankRows, S[rowStart:rowEnd])
 
     return S
 
+def getInterveningOpportunitiesRows(features, distanceRows):
+    '''Vectorized intervening opportunities for a block of rows of the distance matrix, i.e. rows of the result of
+    `getInterveningOpportunities(features, distanceMatrix)` where `distanceRows` are the same rows of `distanceMatrix`.
+    '''
+    assert len(features.shape) == 2 and features.shape[1] == 1
+    assert len(distanceRows.shape) == 2 and distanceRows.shape[1] == features.shape[0]
+
+    S = np.empty(distanceRows.shape, dtype=np.float32)
+    return scatterInterveningOpportunities(features, getDistanceRanks(distanceRows), S)
+
+#-----------------------------------------------------------------------------------------------------------------------------------
+# Sparse intervening opportunities
+#-----------------------------------------------------------------------------------------------------------------------------------
+class SparseInterveningOpportunities(object):
+    '''Intervening opportunities for a neighbourhood of destinations around each origin, see `getSparseInterveningOpportunities`.
+
+    Attributes:
+        matrix - (n x n) `scipy.sparse.csr_matrix` whose stored entries (including explicitly stored zeros) are the `s` values of each
+                 origin's neighbourhood, the entries that are not stored are not part of the neighbourhood
+        tail - (n x 1) intervening opportunities at the edge of each neighbourhood, i.e. the sum of the features of all the locations
+               in the neighbourhood except the origin
+        total - (n x 1) sum of the features of all locations except the origin
+
+    `radiationModel` and `extendedRadiationModel` accept this object as `s` and return a sparse matrix with the same structure, the
+    probability mass of all the destinations outside of the neighbourhoods is given by `radiationModelTail` and `extendedRadiationModelTail`.
+    '''
+    def __init__(self, matrix, tail, total):
+        self.matrix = matrix
+        self.tail = tail
+        self.total = total
+
+    @property
+    def shape(self):
+        return self.matrix.shape
+
+    def evaluate(self, modelValues, origins, destinations, *args, **kwargs):
+        '''Evaluates an elementwise model function `modelValues(originValues, destinationValues, sValues, *args)` on the stored entries.
+        '''
+        dtype = kwargs.get("dtype", np.float64)
+        n = self.matrix.shape[0]
+        rows = np.repeat(np.arange(n), np.diff(self.matrix.indptr))
+
+        originValues = origins[rows,0].astype(dtype)
+        destinationValues = destinations[self.matrix.indices,0].astype(dtype)
+        sValues = self.matrix.data.astype(dtype)
+
+        values = sanitize(modelValues(originValues, destinationValues, sValues, *args))
+        return scipy.sparse.csr_matrix((values, self.matrix.indices.copy(), self.matrix.indptr.copy()), shape=self.matrix.shape)
+
+def radiationModelValues(origins, destinations, s):
+    '''Elementwise radiation model.
+    '''
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return (origins * destinations) / ((s + origins) * (s + origins + destinations))
+
+def extendedRadiationModelValues(origins, destinations, s, alpha):
+    '''Elementwise extended radiation model, in the same form as the vectorized implementation of `extendedRadiationModel`.
+    '''
+    with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+        x = 1.0 / ((s + origins)**alpha + 1.0)
+        y = 1.0 / ((s + origins + destinations)**alpha + 1.0)
+        return (origins**alpha + 1.0) * (x - y) * np.sign(y)
+
+def radiationModelTail(origins, s):
+    '''Total probability the radiation model gives to the destinations outside of each origin's neighbourhood, as an (n x 1) vector.
+
+    The radiation model telescopes: summing it over destinations in order of distance, from intervening opportunities `tail` up to
+    `total`, gives origins * (1/(origins + tail) - 1/(origins + total)).
+    '''
+    origins = origins.astype(float)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return sanitize(origins * (1.0 / (origins + s.tail) - 1.0 / (origins + s.total)))
+
+def extendedRadiationModelTail(origins, s, alpha):
+    '''Total probability the extended radiation model gives to the destinations outside of each origin's neighbourhood, as an (n x 1)
+    vector, see `radiationModelTail`.
+    '''
+    origins = origins.astype(float)
+    with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+        x = 1.0 / ((origins + s.tail)**alpha + 1.0)
+        y = 1.0 / ((origins + s.total)**alpha + 1.0)
+        return sanitize((origins**alpha + 1.0) * (x - y))
+
+def getSparseInterveningOpportunities(features, coordinates, k=None, radius=None):
+    '''Computes intervening opportunities only for the `k` nearest destinations (and/or the destinations within `radius` km) of each
+    origin, using a KD-tree over the location coordinates instead of sorting full rows of a distance matrix.
+
+    The values of the stored entries are the same as in `getInterveningOpportunities` with a great-circle distance matrix, as the
+    locations closer to an origin than one of its neighbours are also in its neighbourhood.
+
+    Inputs:
+        features - (n x 1) features (e.g. population) of the locations
+        coordinates - (n x 2) (latitude, longitude) of the locations in degrees (e.g. from `county_centroid_list.csv`)
+        k - number of nearest destinations to keep for each origin (not counting the origin itself)
+        radius - keep the destinations within this great-circle distance, in km (if `k` is also given, at most `k` of them)
+
+    returns: SparseInterveningOpportunities
+    '''
+    assert len(features.shape) == 2 and features.shape[1] == 1
+    assert len(coordinates.shape) == 2 and coordinates.shape[1] == 2 and coordinates.shape[0] == features.shape[0]
+    assert k is not None or radius is not None, "At least one of `k` and `radius` must be given"
+
+    n = features.shape[0]
+    points = latLonToUnitVectors(coordinates)
+    tree = scipy.spatial.cKDTree(points)
+
+    # maximum chord length between two points on the unit sphere that are `radius` km apart
+    maxChord = np.inf if radius is None else 2.0 * np.sin(min(radius / EARTH_RADIUS_KM, np.pi) / 2.0)
+
+    if k is not None:
+        distances, cols = tree.query(points, k=min(k+1, n), distance_upper_bound=maxChord)
+        distances, cols = distances.reshape(n, -1), cols.reshape(n, -1)
+        mask = cols < n # missing neighbours (beyond the radius) are returned with index n
+        rows = np.repeat(np.arange(n), mask.sum(axis=1))
+        cols, distances = cols[mask], distances[mask]
+    else:
+        neighbours = tree.query_ball_point(points, maxChord)
+        rows = np.repeat(np.arange(n), [len(neighbourList) for neighbourList in neighbours])
+        cols = np.concatenate([np.asarray(neighbourList, dtype=np.int64) for neighbourList in neighbours])
+        distances = np.linalg.norm(points[rows] - points[cols], axis=1)
+
+    # Sort each neighbourhood by distance, breaking ties by index like the stable sort in `getInterveningOpportunities`
+    order = np.lexsort((cols, distances, rows))
+    rows, cols = rows[order], cols[order]
+
+    counts = np.bincount(rows, minlength=n)
+    indptr = np.zeros(n+1, dtype=np.int64)
+    np.cumsum(counts, out=indptr[1:])
+
+    # Exclusive cumulative sum of the features within each neighbourhood, where the first (closest) location is the origin and isn't counted
+    starts = indptr[:-1][counts > 0]
+    sortedFeatures = features[cols,0].astype(np.float64)
+    sortedFeatures[starts] = 0.0
+    exclusive = np.cumsum(sortedFeatures) - sortedFeatures
+    values = (exclusive - np.repeat(exclusive[starts], counts[counts > 0])).astype(np.float32)
+
+    tail = np.zeros(n, dtype=np.float64)
+    if starts.shape[0] > 0:
+        tail[counts > 0] = np.add.reduceat(sortedFeatures, starts)
+
+    total = features[:,0].astype(np.float64).sum() - features[:,0].astype(np.float64)
+
+    matrix = scipy.sparse.csr_matrix((values, cols, indptr), shape=(n,n))
+    return SparseInterveningOpportunities(matrix, tail.reshape(-1,1), total.reshape(-1,1))
+
+class InterveningOpportunitiesRows(MemmapPicklable):
+    '''Callable that computes rows of the intervening opportunities matrix on the fly, for use as `s` in `evaluateModelTiled`.
+
+    `distances` is either the (n x n) distance matrix (can be a memory map, only the requested rows are read, and it is pickled by
+    reference when the rows are computed by worker processes, see `MigrationDistances.MemmapPicklable`) or a function
+    `f(rowStart, rowEnd)` returning those rows of it.
+    '''
+    def __init__(self, features, distances):
+        self.features = features
+        self.distances = distances
+
+    def __call__(self, rowStart, rowEnd):
+        return getInterveningOpportunitiesRows(self.features, getRows(self.distances, rowStart, rowEnd))
+
+def getRows(x, rowStart, rowEnd):
+    '''Returns rows [rowStart, rowEnd) of `x`, which is either a 2D array or a function `f(rowStart, rowEnd)`.
+    '''
+    if callable(x):
+        return x(rowStart, rowEnd)
+    return np.asarray(x[rowStart:rowEnd])
+
+#-----------------------------------------------------------------------------------------------------------------------------------
+# Tiled evaluation
+#-----------------------------------------------------------------------------------------------------------------------------------
+MODELS = ["radiation", "extendedRadiation", "gravity"]
+
+def evaluateModelTile(model, origins, destinations, x, alpha=None, decay="power", dtype=np.float64, out=None):
+    '''Evaluates `model` for one block of origins (or all of them), where `x` is the matching block of rows of `s` (radiation models)
+    or `d` (gravity).
+    '''
+    assert model in MODELS, "`model` must be one of %s" % (", ".join(MODELS))
+    if model == "radiation":
+        return radiationModel(origins, destinations, x, dtype=dtype, out=out)
+    elif model == "extendedRadiation":
+        return extendedRadiationModel(origins, destinations, x, alpha, dtype=dtype, out=out)
+    elif model == "gravity":
+        return gravityModel(origins, destinations, x, alpha, decay=decay, dtype=dtype, out=out)
+
+def _evaluateModelTileJob(args):
+    '''Worker for `evaluateModelTiled`, `x` is either the tile of `s`/`d`, a `MemmapReference` to it, or a function to compute it with.
+    '''
+    model, origins, destinations, x, rowStart, rowEnd, alpha, decay, dtype = args
+    if isinstance(x, MemmapReference):
+        x = np.asarray(openMemmapReference(x))
+    elif callable(x):
+        x = x(rowStart, rowEnd)
+    return rowStart, rowEnd, evaluateModelTile(model, origins, destinations, x, alpha=alpha, decay=decay, dtype=dtype)
+
+def evaluateModelTiled(model, origins, destinations, x, alpha=None, decay="power", tileSize=1024, out=None, callback=None, workers=1, dtype=np.float64):
+    '''Evaluates one of the models for blocks of `tileSize` origins at a time, so that neither the full `s`/`d` matrix nor the full result
+    need to be in memory (e.g. for block groups, where n x n is too large to hold in RAM).
+
+    Inputs:
+        model - one of "radiation", "extendedRadiation" or "gravity"
+        origins, destinations - (n x 1) and (m x 1) features, as in the model functions
+        x - `s` for the radiation models or `d` for the gravity model, either an (n x m) array (which can be a memory map, only the
+            rows of the current tile are read, by the workers themselves when workers > 1) or a function `f(rowStart, rowEnd)`
+            computing those rows on the fly (e.g. `InterveningOpportunitiesRows`)
+        alpha, decay - model parameters, see the model functions
+        out - an (n x m) array (e.g. `np.memmap`) or the filename of a `.npy` file to create as a memory map, to write the result to
+        callback - function `f(rowStart, rowEnd, P)` called with each tile of the result, tiles are not passed in order when workers > 1
+        workers - number of processes to evaluate tiles with, `x` must be picklable when workers > 1
+
+    returns: the result (`out`, or a new (n x m) array when neither `out` nor `callback` are given), or None
+    '''
+    assert model in MODELS, "`model` must be one of %s" % (", ".join(MODELS))
+    assert len(origins.shape) == 2 and origins.shape[1] == 1, "`origins` and `destinations` must be 2D with a single column"
+    assert len(destinations.shape) == 2 and destinations.shape[1] == 1, "`origins` and `destinations` must be 2D with a single column"
+
+    n = origins.shape[0]
+    m = destinations.shape[0]
+
+    if not callable(x):
+        assert len(x.shape) == 2 and x.shape[0] == n and x.shape[1] == m, "`x` must be a matrix with same length/width as the origin and destination features"
+
+    if isinstance(out, str):
+        out = np.lib.format.open_memmap(out, mode="w+", dtype=dtype, shape=(n,m))
+    elif out is None and callback is None:
+        out = np.empty((n,m), dtype=dtype)
+    if out is not None:
+        assert out.shape == (n,m), "`out` must have shape %s" % (str((n,m)))
+
+    def handleTile(rowStart, rowEnd, P):
+        if out is not None:
+            out[rowStart:rowEnd] = P
+        if callback is not None:
+            callback(rowStart, rowEnd, P)
+
+    tiles = [(rowStart, min(rowStart+tileSize, n)) for rowStart in range(0, n, tileSize)]
+
+    if workers == 1:
+        for rowStart, rowEnd in tiles:
+            P = evaluateModelTile(model, origins[rowStart:rowEnd], destinations, getRows(x, rowStart, rowEnd), alpha=alpha, decay=decay, dtype=dtype)
+            handleTile(rowStart, rowEnd, P)
+    else:
+        # Array rows are sliced here so that each job only pickles its own tile (or a reference to it in a memory mapped file),
+        # functions are pickled and called in the workers
+        def getJob(rowStart, rowEnd):
+            if callable(x):
+                xTile = x
+            else:
+                xTile = getMemmapReference(x[rowStart:rowEnd])
+                if xTile is None:
+                    xTile = getRows(x, rowStart, rowEnd)
+            return (model, origins[rowStart:rowEnd], destinations, xTile, rowStart, rowEnd, alpha, decay, dtype)
+
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            # Keep a bounded number of tiles in flight so that memory use does not grow with the number of tiles
+            pending = set()
+            tiles = iter(tiles)
+            for rowStart, rowEnd in tiles:
+                pending.add(executor.submit(_evaluateModelTileJob, getJob(rowStart, rowEnd)))
+                if len(pending) >= 2 * workers:
+                    done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        handleTile(*future.result())
+            for future in concurrent.futures.as_completed(pending):
+                handleTile(*future.result())
+
+    if out is not None and isinstance(out, np.memmap):
+        out.flush()
+
+    return out
+
+#-----------------------------------------------------------------------------------------------------------------------------------
+# Constrained models
+#-----------------------------------------------------------------------------------------------------------------------------------
+CONSTRAINTS = ["production", "attraction", "doubly"]
+
+def getMatrixShape(P, shape=None):
+    '''Returns the shape of `P`, which is either a 2D array (dense, memory map or scipy.sparse) or a function `f(rowStart, rowEnd)`
+    returning rows of it (in which case `shape` must be given).
+    '''
+    if callable(P):
+        assert shape is not None, "`shape` must be given when `P` is a function"
+        return tuple(shape)
+    assert len(P.shape) == 2, "`P` must be a 2D matrix"
+    return P.shape
+
+def getRowTiles(P, n, tileSize):
+    '''Yields (rowStart, rowEnd, rows) for the row tiles of `P`, sparse matrices are yielded as a single tile.
+    '''
+    if scipy.sparse.issparse(P):
+        yield 0, n, P
+        return
+    for rowStart in range(0, n, tileSize):
+        rowEnd = min(rowStart+tileSize, n)
+        yield rowStart, rowEnd, getRows(P, rowStart, rowEnd)
+
+def relaxFactors(old, new, omega):
+    '''Over-relaxed update of balancing factors in log space, `old * (new/old)**omega`, entries where `old` is 0 take the plain update.
+    '''
+    if omega == 1.0 or old is None:
+        return new
+    with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+        relaxed = old * np.power(new / old, omega)
+    mask = (old > 0) & np.isfinite(relaxed)
+    relaxed[~mask] = new[~mask]
+    return relaxed
+
+def getBalancingFactors(P, outgoing=None, incoming=None, constraint="doubly", tol=1e-6, maxIter=1000, warmStart=None, omega=1.5, tileSize=1024, shape=None, verbose=False):
+    '''Computes the balancing factors `a` and `b` such that `a_i * P_ij * b_j` has row sums `outgoing` and/or column sums `incoming`.
+
+    The doubly constrained factors are found with the Furness (iterative proportional fitting) method. Each iteration is a single pass
+    over the row tiles of P that updates the row factors of a tile and immediately accumulates its contribution to the column sums, so
+    P can be a memory map or be computed on the fly. The updates are over-relaxed in log space by `omega` to speed up convergence,
+    whenever the error increases `omega` is halved towards 1 (the plain Furness update).
+
+    Inputs:
+        P - (n x m) matrix of model values, a 2D array (dense, memory map or scipy.sparse) or a function `f(rowStart, rowEnd)`
+        outgoing - (n,) known outflow totals, required for the "production" and "doubly" constraints
+        incoming - (m,) known inflow totals, required for the "attraction" and "doubly" constraints
+        constraint - one of "production", "attraction" or "doubly"
+        tol - the iterations stop once the row and column sums are within a relative (L1) error of `tol` of the totals
+        maxIter - maximum number of iterations
+        warmStart - (a, b) factors to start from, e.g. the factors of the previous year
+        omega - over-relaxation factor, 1 disables the acceleration
+        tileSize - number of rows of P read at a time
+        shape - (n, m), only needed when P is a function
+
+    returns: a, b - (n x 1) and (m x 1) balancing factors
+             numIterations - number of passes over P
+             error - the relative error of the row/column sums of the returned factors
+    '''
+    assert constraint in CONSTRAINTS, "`constraint` must be one of %s" % (", ".join(CONSTRAINTS))
+    n, m = getMatrixShape(P, shape)
+
+    if constraint in ["production", "doubly"]:
+        assert outgoing is not None, "`outgoing` must be given for the %s constraint" % (constraint)
+        outgoing = np.asarray(outgoing, dtype=np.float64).ravel()
+        assert outgoing.shape[0] == n, "`outgoing` must have %d entries" % (n)
+    if constraint in ["attraction", "doubly"]:
+        assert incoming is not None, "`incoming` must be given for the %s constraint" % (constraint)
+        incoming = np.asarray(incoming, dtype=np.float64).ravel()
+        assert incoming.shape[0] == m, "`incoming` must have %d entries" % (m)
+    if constraint == "doubly":
+        assert np.isclose(outgoing.sum(), incoming.sum(), rtol=1e-6), "`outgoing` and `incoming` must have the same total"
+
+    def divide(totals, sums):
+        return np.divide(totals, sums, out=np.zeros_like(totals), where=sums > 0)
+
+    def relativeError(sums, totals):
+        total = totals.sum()
+        return np.abs(sums - totals).sum() / total if total > 0 else 0.0
+
+    def balancingError(a, b):
+        # Exact error of the doubly constrained factors (a, b), with one more pass over P
+        rowSums = np.zeros(n, dtype=np.float64)
+        colSums = np.zeros(m, dtype=np.float64)
+        for rowStart, rowEnd, rows in getRowTiles(P, n, tileSize):
+            rowSums[rowStart:rowEnd] = np.asarray(rows.dot(b), dtype=np.float64).ravel()
+            colSums += np.asarray(rows.T.dot(a[rowStart:rowEnd]), dtype=np.float64).ravel()
+        return max(relativeError(a * rowSums, outgoing), relativeError(b * colSums, incoming))
+
+    # The singly constrained factors only need the row or the column sums of P
+    if constraint != "doubly":
+        rowSums = np.zeros(n, dtype=np.float64)
+        colSums = np.zeros(m, dtype=np.float64)
+        for rowStart, rowEnd, rows in getRowTiles(P, n, tileSize):
+            rowSums[rowStart:rowEnd] = np.asarray(rows.sum(axis=1), dtype=np.float64).ravel()
+            colSums += np.asarray(rows.sum(axis=0), dtype=np.float64).ravel()
+        if constraint == "production":
+            a, b = divide(outgoing, rowSums), np.ones(m, dtype=np.float64)
+            error = relativeError(a * rowSums, outgoing)
+        else:
+            a, b = np.ones(n, dtype=np.float64), divide(incoming, colSums)
+            error = relativeError(b * colSums, incoming)
+        return a.reshape(-1,1), b.reshape(-1,1), 1, error
+
+    if warmStart is not None:
+        a = np.asarray(warmStart[0], dtype=np.float64).ravel().copy()
+        b = np.asarray(warmStart[1], dtype=np.float64).ravel().copy()
+        assert a.shape[0] == n and b.shape[0] == m, "`warmStart` factors must have %d and %d entries" % (n, m)
+    else:
+        a = None
+        b = np.ones(m, dtype=np.float64)
+
+    error = np.inf
+    numIterations = 0
+    while numIterations < maxIter:
+        numIterations += 1
+
+        # One pass over P: row factors for each tile, then that tile's contribution to the column sums with the new row factors
+        rowError = 0.0
+        colSums = np.zeros(m, dtype=np.float64)
+        newA = np.empty(n, dtype=np.float64)
+        for rowStart, rowEnd, rows in getRowTiles(P, n, tileSize):
+            rowSums = np.asarray(rows.dot(b), dtype=np.float64).ravel()
+            tileOutgoing = outgoing[rowStart:rowEnd]
+            tileA = a[rowStart:rowEnd] if a is not None else None
+            if tileA is not None:
+                rowError += np.abs(tileA * rowSums - tileOutgoing).sum()
+            tileA = relaxFactors(tileA, divide(tileOutgoing, rowSums), omega)
+            newA[rowStart:rowEnd] = tileA
+            colSums += np.asarray(rows.T.dot(tileA), dtype=np.float64).ravel()
+
+        # The row error is measured before this iteration's update of `a`, the column error after it
+        previousError = error
+        if a is not None:
+            error = max(rowError / outgoing.sum(), relativeError(b * colSums, incoming))
+        a = newA
+
+        if verbose:
+            print("Iteration %d, error %0.2e, omega %0.3f" % (numIterations, error, omega))
+        if error < tol:
+            # `error` is an estimate from the row factors before this iteration's (over-relaxed) update, so it is only accepted once
+            # the factors that are returned are within `tol`
+            error = balancingError(a, b)
+            if error < tol:
+                break
+
+        b = relaxFactors(b, divide(incoming, colSums), omega)
+
+        if error > previousError and omega > 1.0:
+            omega = 1.0 + (omega - 1.0) / 2.0
+            if omega < 1.05:
+                omega = 1.0
+
+    if error >= tol:
+        error = balancingError(a, b)
+    return a.reshape(-1,1), b.reshape(-1,1), numIterations, error
+
+def applyBalancingFactors(P, a, b, out=None, tileSize=1024, dtype=np.float64):
+    '''Returns `a_i * P_ij * b_j`, written to `out` in tiles of `tileSize` rows. P is balanced in place when `out` is P, otherwise `out`
+    can be a preallocated (n x m) array (e.g. `np.memmap`). `P` can be any of the inputs of `getBalancingFactors`.
+    '''
+    n, m = getMatrixShape(P, None if out is None else out.shape)
+    a = np.asarray(a, dtype=np.float64).reshape(-1,1)
+    b = np.asarray(b, dtype=np.float64).reshape(1,-1)
+
+    if scipy.sparse.issparse(P):
+        return scipy.sparse.csr_matrix(P.multiply(a).multiply(b))
+
+    out = getOutputBuffer(out, (n,m), dtype if out is None else out.dtype)
+    for rowStart, rowEnd, rows in getRowTiles(P, n, tileSize):
+        tile = out[rowStart:rowEnd]
+        if not np.shares_memory(rows, tile):
+            tile[:] = rows
+        tile *= a[rowStart:rowEnd]
+        tile *= b
+
+    if isinstance(out, np.memmap):
+        out.flush()
+    return out
+
+def constrainedModel(model, origins, destinations, x, outgoing=None, incoming=None, constraint="doubly", alpha=None, decay="power",
+        tol=1e-6, maxIter=1000, warmStart=None, omega=1.5, tileSize=1024, out=None, workers=1, dtype=np.float64):
+    '''Production, attraction or doubly constrained version of one of the models, i.e. the model values balanced so that the flows
+    leaving each origin sum to `outgoing` and/or the flows entering each destination sum to `incoming`.
+
+    The unconstrained model is evaluated with `evaluateModelTiled` (`x`, `out` and `workers` can be any of its inputs) and then balanced
+    in place with the factors from `getBalancingFactors`. The "production" constraint with `outgoing = origins*beta` gives the same
+    result as `productionFunction(origins, row_normalize(P), beta)`.
+
+    returns: T - the (n x m) constrained flows
+             a, b - the balancing factors, which can be passed as `warmStart` when constraining the model for the next year
+    '''
+    P = evaluateModelTiled(model, origins, destinations, x, alpha=alpha, decay=decay, tileSize=tileSize, out=out, workers=workers, dtype=dtype)
+    a, b, numIterations, error = getBalancingFactors(P, outgoing, incoming, constraint=constraint, tol=tol, maxIter=maxIter,
+            warmStart=warmStart, omega=omega, tileSize=tileSize)
+    if error >= tol:
+        warnings.warn("The balancing factors did not converge after %d iterations (error %0.2e)" % (numIterations, error), RuntimeWarning)
+    T = applyBalancingFactors(P, a, b, out=P, tileSize=tileSize)
+    return T, a, b
 
 if __name__ == "__main__":
     pass
\ No newline at end of file
@@ -0,0 +1,330 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2017 Caleb Robinson <calebrob6@gmail.com>
+#
+# Distributed under terms of the MIT license.
+'''Benchmarks the vectorized implementations in MigrationModels on synthetic data, and checks them against their `slowMode` versions.
+
+For each problem size this times (best of `--repeats` runs) and measures the peak memory allocated (with `tracemalloc`, which numpy
+reports its array allocations to) by `getInterveningOpportunities`, `radiationModel`, `extendedRadiationModel` and `gravityModel`.
+The results are written to a JSON file, which can be passed as `--baseline` to a later run to report regressions between versions.
+
+Note that the dense inputs and results take 8*n*n bytes each, i.e. ~3.2GB each for 20,000 units.
+
+With `--mode metrics` the evaluation metrics in MigrationEvaluationMethods are benchmarked on sparse synthetic flow matrices instead,
+at county (~3,100) to tract (~73,000) scale, and compared to the same metrics on the densified matrices for sizes up to
+`--dense-max-size`. Their sparse/dense parity is tested in tests/test_MigrationEvaluationMethods.py.
+
+Usage:
+    python benchmark_migration_models.py --sizes 100 1000 3000 --output benchmark_results.json
+    python benchmark_migration_models.py --sizes 100 1000 3000 --baseline benchmark_results.json
+    python benchmark_migration_models.py --mode metrics --sizes 3100 73000 --output metric_results.json
+'''
+import sys
+import os
+import time
+import json
+import argparse
+import platform
+import tracemalloc
+
+import numpy as np
+import scipy.sparse
+
+import MigrationModels
+import MigrationDistances
+import MigrationEvaluationMethods
+
+# Rough bounds of the continental US, used to generate synthetic coordinates
+LATITUDE_BOUNDS = (25.0, 49.0)
+LONGITUDE_BOUNDS = (-124.0, -67.0)
+
+#-----------------------------------------------------------------------------------------------------------------------------------
+# Synthetic data
+#-----------------------------------------------------------------------------------------------------------------------------------
+def get_synthetic_data(n, seed=0):
+    '''Returns a dict with (n x 1) origin/destination populations, (n x 2) coordinates and the (n x n) distance matrix (in km) of `n`
+    synthetic units. Populations are log-normally distributed, like county populations.
+    '''
+    rng = np.random.RandomState(seed)
+    coordinates = np.stack([
+        rng.uniform(LATITUDE_BOUNDS[0], LATITUDE_BOUNDS[1], size=n),
+        rng.uniform(LONGITUDE_BOUNDS[0], LONGITUDE_BOUNDS[1], size=n)
+    ], axis=1)
+    population = np.round(rng.lognormal(10, 1.5, size=(n,1))).astype(np.int64) + 1
+
+    return {
+        "origins": population,
+        "destinations": population,
+        "coordinates": coordinates,
+        "d": MigrationDistances.getDistanceMatrix(coordinates),
+    }
+
+#-----------------------------------------------------------------------------------------------------------------------------------
+# Measurement
+#-----------------------------------------------------------------------------------------------------------------------------------
+def time_function(f, repeats=3):
+    '''Returns the result of `f()` and the run times (in seconds) of `repeats` calls to it.
+    '''
+    times = []
+    result = None
+    for i in range(repeats):
+        result = None
+        tic = time.perf_counter()
+        result = f()
+        times.append(time.perf_counter() - tic)
+    return result, times
+
+def measure_peak_memory(f):
+    '''Returns the peak memory (in bytes) allocated while running `f()`, not counting memory that was allocated before the call.
+    '''
+    tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        f()
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak
+
+def compare_results(fast, slow, rtol=1e-7, atol=0.0, ignore_diagonal=False):
+    '''Compares the results of a vectorized implementation and its slowMode version, optionally only off the diagonal.
+    '''
+    fast = np.asarray(fast, dtype=np.float64)
+    slow = np.asarray(slow, dtype=np.float64)
+    if ignore_diagonal:
+        mask = ~np.eye(fast.shape[0], fast.shape[1], dtype=bool)
+        fast, slow = fast[mask], slow[mask]
+    absolute = np.abs(fast - slow)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        relative = np.where(slow != 0, absolute / np.abs(slow), absolute)
+    return {
+        "equal": bool(np.allclose(fast, slow, rtol=rtol, atol=atol)),
+        "max_abs_diff": float(absolute.max()) if absolute.size > 0 else 0.0,
+        "max_rel_diff": float(relative.max()) if relative.size > 0 else 0.0,
+    }
+
+#-----------------------------------------------------------------------------------------------------------------------------------
+# Benchmarks
+#-----------------------------------------------------------------------------------------------------------------------------------
+def get_benchmarks(data, alpha=1.5, dtype=np.float64):
+    '''Returns (name, f(slowMode), ignore_diagonal) tuples for the functions to benchmark. The radiation models use the intervening
+    opportunities matrix, which is computed (once) when first needed.
+
+    The slowMode gravity model skips the diagonal (where the distance is 0), while the vectorized exponential decay gives origins*destinations
+    there, so the gravity models are only checked off the diagonal.
+    '''
+    origins, destinations, d = data["origins"], data["destinations"], data["d"]
+
+    def get_s():
+        if "s" not in data:
+            data["s"] = MigrationModels.getInterveningOpportunities(origins, d)
+        return data["s"]
+
+    return [
+        ("getInterveningOpportunities", lambda slowMode: MigrationModels.getInterveningOpportunities(origins, d, slowMode=slowMode), False),
+        ("radiationModel", lambda slowMode: MigrationModels.radiationModel(origins, destinations, get_s(), slowMode=slowMode, **({} if slowMode else {"dtype": dtype})), False),
+        ("extendedRadiationModel", lambda slowMode: MigrationModels.extendedRadiationModel(origins, destinations, get_s(), alpha, slowMode=slowMode, **({} if slowMode else {"dtype": dtype})), False),
+        ("gravityModel_power", lambda slowMode: MigrationModels.gravityModel(origins, destinations, d, alpha, decay="power", slowMode=slowMode, **({} if slowMode else {"dtype": dtype})), True),
+        ("gravityModel_exponential", lambda slowMode: MigrationModels.gravityModel(origins, destinations, d, alpha/100.0, decay="exponential", slowMode=slowMode, **({} if slowMode else {"dtype": dtype})), True),
+    ]
+
+def run_benchmarks(sizes, repeats=3, slow_max_size=200, seed=0, alpha=1.5, dtype=np.float64, benchmarks=None, verbose=False):
+    '''Runs the benchmarks for each problem size in `sizes`, and checks the results against slowMode for sizes up to `slow_max_size`.
+
+    returns: a list of dicts, one per (size, function), with the run times, peak memory and equivalence check results
+    '''
+    # In single precision the radiation models lose precision on the smallest entries (1/(x+1) - 1/(y+1) cancels), so they are also
+    # compared with an absolute tolerance relative to the largest entry
+    rtol, atol = (1e-7, 0.0) if np.dtype(dtype) == np.float64 else (1e-4, 1e-6)
+    results = []
+    for n in sizes:
+        data = get_synthetic_data(n, seed=seed)
+        for name, f, ignore_diagonal in get_benchmarks(data, alpha=alpha, dtype=dtype):
+            if benchmarks is not None and name not in benchmarks:
+                continue
+
+            # Inputs that are computed lazily are built before measuring
+            f(False)
+            fast, times = time_function(lambda: f(False), repeats=repeats)
+            peak = measure_peak_memory(lambda: f(False))
+
+            result = {
+                "name": name,
+                "n": n,
+                "dtype": np.dtype(dtype).name,
+                "times": times,
+                "best_time": min(times),
+                "peak_memory": peak,
+                "peak_memory_per_cell": peak / float(n*n),
+            }
+
+            if n <= slow_max_size:
+                slow, slow_times = time_function(lambda: f(True), repeats=1)
+                result["slow_time"] = slow_times[0]
+                result["speedup"] = slow_times[0] / min(times)
+                result["check"] = compare_results(fast, slow, rtol=rtol, atol=atol*float(np.abs(slow).max()), ignore_diagonal=ignore_diagonal)
+
+            if verbose:
+                line = "%s n=%d -- %0.4fs, peak %0.1fMB" % (name, n, result["best_time"], peak / 2.0**20)
+                if "check" in result:
+                    line += ", %0.1fx faster than slowMode, %s (max rel diff %0.2e)" % (result["speedup"], "equal" if result["check"]["equal"] else "NOT EQUAL", result["check"]["max_rel_diff"])
+                print(line)
+            results.append(result)
+            del fast
+    return results
+
+#-----------------------------------------------------------------------------------------------------------------------------------
+# Sparse evaluation metrics
+#-----------------------------------------------------------------------------------------------------------------------------------
+METRICS = ["cpc", "cpl", "cpc_d", "nrmse", "rmse", "evaluate_metrics"]
+
+def get_synthetic_flows(n, nonzeros_per_row=50, seed=0):
+    '''Returns sparse (CSR) synthetic observed and generated (n x n) flow matrices. The observed matrix has about `nonzeros_per_row`
+    integer flows per origin, the generated one has noisy values at the same entries plus as many other entries.
+    '''
+    rng = np.random.RandomState(seed)
+    rows = np.repeat(np.arange(n), nonzeros_per_row)
+    cols = rng.randint(0, n, size=rows.shape[0])
+    values = np.ceil(rng.lognormal(1, 1.5, size=rows.shape[0]))
+    O = scipy.sparse.csr_matrix((values, (rows, cols)), shape=(n,n))
+
+    otherCols = rng.randint(0, n, size=rows.shape[0])
+    G = scipy.sparse.csr_matrix((
+        np.concatenate([values * rng.lognormal(0, 0.5, size=rows.shape[0]), rng.lognormal(0, 1, size=rows.shape[0])]),
+        (np.concatenate([rows, rows]), np.concatenate([cols, otherCols]))
+    ), shape=(n,n))
+    return O, G
+
+def get_sparse_matrix_bytes(X):
+    return X.data.nbytes + X.indices.nbytes + X.indptr.nbytes
+
+def run_metric_benchmarks(sizes, nonzeros_per_row=50, repeats=3, dense_max_size=5000, distance_max_size=5000, seed=0, benchmarks=None, verbose=False):
+    '''Benchmarks the evaluation metrics on sparse synthetic flows for each problem size in `sizes`. For sizes up to `dense_max_size`
+    the same metrics are also timed on the densified matrices (the sparse and dense results are checked against each other in
+    tests/test_MigrationEvaluationMethods.py). cpc_d (and evaluate_metrics' cpc_d) needs a distance matrix, so it is only computed up
+    to `distance_max_size`.
+
+    returns: a list of dicts, one per (size, metric), with the run times, peak memory and input sizes
+    '''
+    results = []
+    for n in sizes:
+        O, G = get_synthetic_flows(n, nonzeros_per_row=nonzeros_per_row, seed=seed)
+        d = get_synthetic_data(n, seed=seed)["d"] if n <= distance_max_size else None
+        OD, GD = (O.toarray(), G.toarray()) if n <= dense_max_size else (None, None)
+
+        functions = {
+            "cpc": MigrationEvaluationMethods.cpc,
+            "cpl": MigrationEvaluationMethods.cpl,
+            "cpc_d": lambda O, G: MigrationEvaluationMethods.cpc_d(O, G, d),
+            "nrmse": MigrationEvaluationMethods.nrmse,
+            "rmse": MigrationEvaluationMethods.rmse,
+            "evaluate_metrics": lambda O, G: MigrationEvaluationMethods.evaluate_metrics(O, G, d),
+        }
+        for name in METRICS:
+            if (benchmarks is not None and name not in benchmarks) or (name == "cpc_d" and d is None):
+                continue
+            f = functions[name]
+
+            _, times = time_function(lambda: f(O, G), repeats=repeats)
+            result = {
+                "name": "%s_sparse" % (name),
+                "n": n,
+                "dtype": "float64",
+                "nonzeros": int(O.nnz + G.nnz),
+                "input_bytes": get_sparse_matrix_bytes(O) + get_sparse_matrix_bytes(G),
+                "times": times,
+                "best_time": min(times),
+                "peak_memory": measure_peak_memory(lambda: f(O, G)),
+            }
+
+            if OD is not None:
+                _, denseTimes = time_function(lambda: f(OD, GD), repeats=repeats)
+                result["dense_best_time"] = min(denseTimes)
+                result["dense_input_bytes"] = OD.nbytes + GD.nbytes
+                result["dense_peak_memory"] = measure_peak_memory(lambda: f(OD, GD))
+                result["speedup"] = result["dense_best_time"] / result["best_time"]
+
+            if verbose:
+                line = "%s n=%d -- %0.4fs, peak %0.1fMB, inputs %0.1fMB" % (result["name"], n, result["best_time"], result["peak_memory"] / 2.0**20, result["input_bytes"] / 2.0**20)
+                if "dense_best_time" in result:
+                    line += " (dense %0.4fs, peak %0.1fMB, inputs %0.1fMB)" % (
+                        result["dense_best_time"], result["dense_peak_memory"] / 2.0**20, result["dense_input_bytes"] / 2.0**20
+                    )
+                print(line)
+            results.append(result)
+    return results
+
+def compare_to_baseline(results, baseline, threshold=1.25, verbose=False):
+    '''Returns the results whose best time or peak memory is more than `threshold` times that of the matching result in `baseline`.
+    '''
+    baseline = {(r["name"], r["n"], r["dtype"]): r for r in baseline}
+    regressions = []
+    for result in results:
+        key = (result["name"], result["n"], result["dtype"])
+        if key not in baseline:
+            continue
+        for field in ["best_time", "peak_memory"]:
+            ratio = result[field] / float(baseline[key][field]) if baseline[key][field] > 0 else 1.0
+            if ratio > threshold:
+                regressions.append({"name": result["name"], "n": result["n"], "dtype": result["dtype"], "field": field, "ratio": ratio})
+                if verbose:
+                    print("Regression: %s n=%d %s is %0.2fx the baseline" % (result["name"], result["n"], field, ratio))
+    return regressions
+
+def get_environment():
+    return {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the vectorized migration models against their slowMode implementations")
+    parser.add_argument("--mode", choices=["models", "metrics"], default="models", help="Benchmark the models, or the evaluation metrics on sparse flows")
+    parser.add_argument("--sizes", type=int, nargs="+", default=None, help="Numbers of units to benchmark (defaults to 100 1000 3000 for the models, 3100 73000 for the metrics)")
+    parser.add_argument("--repeats", type=int, default=3, help="Number of timed runs per benchmark")
+    parser.add_argument("--slow-max-size", type=int, default=200, help="Largest size to check (and time) the slowMode implementations at")
+    parser.add_argument("--alpha", type=float, default=1.5, help="Value of alpha used in the models (divided by 100 for exponential decay)")
+    parser.add_argument("--dtype", choices=["float64", "float32"], default="float64", help="Precision to compute the models in")
+    parser.add_argument("--benchmarks", nargs="+", default=None, help="Only run these benchmarks")
+    parser.add_argument("--nonzeros-per-row", type=int, default=50, help="Average number of flows per origin in the sparse flow matrices")
+    parser.add_argument("--dense-max-size", type=int, default=5000, help="Largest size to densify the flow matrices at")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="benchmark_results.json", help="JSON file to write the results to")
+    parser.add_argument("--baseline", default=None, help="JSON file of a previous run to check for regressions against")
+    parser.add_argument("--threshold", type=float, default=1.25, help="Ratio to the baseline above which a result is a regression")
+    args = parser.parse_args()
+
+    if args.mode == "models":
+        sizes = args.sizes if args.sizes is not None else [100, 1000, 3000]
+        results = run_benchmarks(sizes, repeats=args.repeats, slow_max_size=args.slow_max_size, seed=args.seed, alpha=args.alpha,
+            dtype=np.dtype(args.dtype), benchmarks=args.benchmarks, verbose=True)
+    else:
+        sizes = args.sizes if args.sizes is not None else [3100, 73000]
+        results = run_metric_benchmarks(sizes, nonzeros_per_row=args.nonzeros_per_row, repeats=args.repeats,
+            dense_max_size=args.dense_max_size, distance_max_size=args.dense_max_size, seed=args.seed, benchmarks=args.benchmarks, verbose=True)
+
+    output = {"environment": get_environment(), "arguments": vars(args), "results": results}
+
+    failed = [result for result in results if "check" in result and not result["check"]["equal"]]
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        output["regressions"] = compare_to_baseline(results, baseline["results"], threshold=args.threshold, verbose=True)
+
+    with open(args.output, "w") as f:
+        json.dump(output, f, indent=2)
+    print("Wrote results to %s" % (args.output))
+
+    if len(failed) > 0:
+        print("%d benchmarks do not match their slowMode implementations" % (len(failed)))
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
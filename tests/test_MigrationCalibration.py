@@ -0,0 +1,182 @@
+'''
+Checks the calibrators against the `fit_traditional_models` objective of the "Compare migration models" notebook, and the calibration runner.
+'''
+import numpy as np
+import pandas as pd
+import scipy.optimize
+import scipy.sparse
+import pytest
+
+import MigrationCalibration
+import MigrationData
+import MigrationDistances
+import MigrationModels
+import MigrationEvaluationMethods
+
+def get_problem(n=40, seed=0):
+    '''Returns a small synthetic calibration problem, with flows drawn from a gravity model, as the `args` of `fit_traditional_models`.
+    '''
+    rng = np.random.RandomState(seed)
+    population = rng.lognormal(10, 1, size=(n, 1)).astype(np.int64)
+    coordinates = np.stack([rng.uniform(30, 40, size=n), rng.uniform(-100, -85, size=n)], axis=1)
+    # distances in hundreds of km, so that exp(-alpha * d) doesn't underflow for the alphas in [0, 3]
+    D = MigrationDistances.getDistanceMatrix(coordinates) / 100.0
+    S = MigrationModels.getInterveningOpportunities(population, D).astype(float)
+
+    P = MigrationModels.gravityModel(population, population, D, 1.3)
+    T = rng.poisson(MigrationModels.productionFunction(population, MigrationModels.row_normalize(P), 0.02)).astype(float)
+    beta = np.dot(population[:,0], T.sum(axis=1)) / np.dot(population[:,0], population[:,0])
+
+    return {"origin_pop": population, "destination_pop": population, "S": S, "D": D, "T": T, "beta": beta}
+
+def run_traditional_models(alpha, args):
+    model = args["model"]
+    origin_pop, destination_pop = args["origin_pop"], args["destination_pop"]
+    S, D, T = args["S"], args["D"], args["T"]
+    beta = args["beta"]
+
+    if model == "extrad":
+        P = MigrationModels.extendedRadiationModel(origin_pop, destination_pop, S, alpha)
+    elif model == "gravpow":
+        P = MigrationModels.gravityModel(origin_pop, destination_pop, D, alpha, decay="power")
+    elif model == "gravexp":
+        P = MigrationModels.gravityModel(origin_pop, destination_pop, D, alpha, decay="exponential")
+
+    P = MigrationModels.row_normalize(P)
+    T_pred = MigrationModels.productionFunction(origin_pop, P, beta=beta)
+    return T, T_pred
+
+def fit_traditional_models(alpha, args):
+    T, T_pred = run_traditional_models(alpha, args)
+    return -MigrationEvaluationMethods.cpc(T, T_pred)
+
+def get_calibrator(model, args):
+    if model == "extrad":
+        return MigrationCalibration.ExtendedRadiationCalibrator(args["origin_pop"], args["destination_pop"], args["S"], args["T"], args["beta"])
+    decay = "power" if model == "gravpow" else "exponential"
+    return MigrationCalibration.GravityCalibrator(args["origin_pop"], args["destination_pop"], args["D"], args["T"], args["beta"], decay=decay)
+
+@pytest.mark.parametrize("model", ["extrad", "gravpow", "gravexp"])
+@pytest.mark.parametrize("alpha", [0.3, 1.0, 2.5])
+def test_objective_matches_notebook(model, alpha):
+    args = dict(get_problem(), model=model)
+    calibrator = get_calibrator(model, args)
+
+    np.testing.assert_allclose(calibrator.objective([alpha]), fit_traditional_models(alpha, args), rtol=1e-10)
+    T, T_pred = run_traditional_models(alpha, args)
+    np.testing.assert_allclose(calibrator.predict(alpha), T_pred, rtol=1e-10)
+
+    # with beta as a parameter
+    args["beta"] *= 1.5
+    np.testing.assert_allclose(calibrator.objective([alpha, args["beta"]]), fit_traditional_models(alpha, args), rtol=1e-10)
+
+@pytest.mark.parametrize("model", ["extrad", "gravpow", "gravexp"])
+@pytest.mark.parametrize("alpha", [0.3, 1.0, 2.5])
+def test_gradient_matches_finite_differences(model, alpha):
+    args = dict(get_problem(), model=model)
+    calibrator = get_calibrator(model, args)
+    params = np.array([alpha, 1.2 * args["beta"]])
+    h = 1e-6
+
+    # the objective is piecewise smooth (min(T_pred, T) switches between its arguments), so use steps that are too small to cross a switch
+    f, gradient = calibrator.objectiveAndGradient(params)
+    assert f == calibrator.objective(params)
+    for i in range(len(params)):
+        step = np.zeros(len(params))
+        step[i] = h * max(1.0, abs(params[i]))
+        numerical = (calibrator.objective(params + step) - calibrator.objective(params - step)) / (2 * step[i])
+        np.testing.assert_allclose(gradient[i], numerical, rtol=1e-4, atol=1e-9)
+
+    # without beta, the alpha gradient is the same
+    gradient1 = calibrator.objectiveAndGradient(params[:1])[1]
+    assert gradient1.shape == (1,)
+    calibrator.beta = params[1]
+    np.testing.assert_allclose(calibrator.objectiveAndGradient(params[:1])[1], gradient[:1], rtol=1e-12)
+
+def test_fit_matches_notebook():
+    args = dict(get_problem(), model="gravpow")
+    calibrator = get_calibrator("gravpow", args)
+
+    expected = scipy.optimize.minimize(fit_traditional_models, x0=[1.0], args=args, bounds=[[0,3]])
+    result = calibrator.fit(x0=1.0, bounds=(0, 3))
+
+    assert result.success
+    np.testing.assert_allclose(result.x[0], expected.x[0], atol=1e-3)
+    # the calibrator gets at least as good a fit as the notebook
+    assert result.fun <= expected.fun + 1e-9
+    np.testing.assert_allclose(result.fun, fit_traditional_models(result.x[0], args), rtol=1e-10)
+
+def get_inputs(n=30, numYears=2, seed=0):
+    '''Returns the (populations, distances, interveningOpportunities, migrationMatrices) inputs of `runCalibration` for a few years.
+    '''
+    rng = np.random.RandomState(seed)
+    problem = get_problem(n=n, seed=seed)
+    populations = np.stack([problem["origin_pop"] + rng.randint(0, 1000, size=(n, 1)) for i in range(numYears)])
+    D = problem["D"]
+    S = MigrationModels.getInterveningOpportunities(populations, D)
+    T = np.stack([
+        rng.poisson(MigrationModels.productionFunction(population, MigrationModels.row_normalize(MigrationModels.gravityModel(population, population, D, 1.3)), 0.02))
+        for population in populations
+    ]).astype(np.int32)
+    return populations, D, S, T
+
+@pytest.mark.parametrize("numIdxs,numFolds", [(10, 2), (17, 3), (17, 5), (30, 7)])
+def test_kfold_splits_match_sklearn(numIdxs, numFolds):
+    sklearn = pytest.importorskip("sklearn.model_selection")
+    idxs = np.arange(0, 2*numIdxs, 2)
+    splits = MigrationCalibration.getKFoldSplits(idxs, numFolds)
+    expected = list(sklearn.KFold(numFolds).split(idxs))
+
+    assert len(splits) == len(expected)
+    for (train, test), (expectedTrain, expectedTest) in zip(splits, expected):
+        np.testing.assert_array_equal(train, idxs[expectedTrain])
+        np.testing.assert_array_equal(test, idxs[expectedTest])
+
+def test_run_calibration_workers(tmp_path):
+    populations, D, S, T = get_inputs()
+    kwargs = {"models": ["extrad", "rad", "gravpow"], "countyIdxs": np.arange(0, 30, 2), "numFolds": 3, "yearLabels": [2004, 2005]}
+
+    expected = MigrationCalibration.runCalibration(populations, D, S, T, workers=1, **kwargs)
+    assert len(expected) == 3 * 2 * 3
+    # the inputs are written to `workDir`, as files the parent process doesn't keep open, and the migration matrices can be sparse
+    actual = MigrationCalibration.runCalibration(populations, D, S, [scipy.sparse.csr_matrix(x) for x in T], workers=2,
+        workDir=str(tmp_path), **kwargs)
+    assert MigrationCalibration._WORKER_DATASET is None
+
+    columns = [column for column in expected.columns if column not in ("fit_time", "evaluate_time")]
+    pd.testing.assert_frame_equal(actual[columns], expected[columns])
+
+def test_calibration_store(tmp_path):
+    populations, D, S, T = get_inputs()
+    dataset = MigrationData.MigrationDataset(populations, D, S, T)
+    trainIdxs, testIdxs = MigrationCalibration.getKFoldSplits(np.arange(30), 3)[0]
+    store = MigrationCalibration.CalibrationStore(str(tmp_path / "store"))
+
+    result = store.calibrate("gravpow", dataset, 1, trainIdxs, testIdxs)
+    assert (store.hits, store.misses) == (0, 1)
+    assert store.calibrate("gravpow", dataset, 1, trainIdxs, testIdxs) == result
+    assert (store.hits, store.misses) == (1, 1)
+
+    # changed data, in the year that is fit
+    changedT = T.copy()
+    changedT[1, 0, 1] += 1
+    store.calibrate("gravpow", MigrationData.MigrationDataset(populations, D, S, changedT), 1, trainIdxs, testIdxs)
+    assert (store.hits, store.misses) == (1, 2)
+
+    # changed optimizer settings
+    store.calibrate("gravpow", dataset, 1, trainIdxs, testIdxs, x0=0.5)
+    assert (store.hits, store.misses) == (1, 3)
+    store.calibrate("gravpow", dataset, 1, trainIdxs, testIdxs, x0=np.float64(0.5))
+    assert (store.hits, store.misses) == (2, 3)
+    assert len(store.getEntries()) == 3
+
+    # settings that can't be fingerprinted
+    with pytest.raises(TypeError):
+        store.calibrate("gravpow", dataset, 1, trainIdxs, testIdxs, callback=lambda x: None)
+
+    # runCalibration skips the stored jobs
+    kwargs = {"models": ["gravpow"], "years": [1], "splits": [(trainIdxs, testIdxs)], "store": store}
+    df = MigrationCalibration.runCalibration(populations, D, S, T, **kwargs)
+    assert (store.hits, store.misses) == (3, 3)
+    for key, value in result.items():
+        assert df.loc[0, key] == value
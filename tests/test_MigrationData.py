@@ -0,0 +1,286 @@
+'''
+Checks the columnar and streaming loaders against the reference `load_file_*` methods on small synthetic IRS migration files, and the
+reads of `MigrationCube` and `MigrationDataset` against the dense migration matrices.
+'''
+import os
+import hashlib
+
+import numpy as np
+import scipy.sparse
+import pytest
+
+import MigrationData
+
+A, B, C, D = '01001', '01003', '02010', '01005'
+
+# (origin, destination, exemptions) of the flows in the inflow and outflow files, and records that are not county to county flows
+IN_FLOWS = [(A, B, 10), (B, A, 5), (C, A, 7), (D, A, 3)]
+OUT_FLOWS = [(A, B, 10), (B, A, 8), (A, C, 4), (C, A, 9), (B, D, 6)]
+OTHER_FLOWS = [('01000', A, 100), (A, '96000', 50), (B, '97001', 20)]
+
+def format_row_04_08(origin, destination, value):
+    return '%s %s %s %s %s %-32s %9d %10d %11d' % (origin[:2], origin[2:], destination[:2], destination[2:], 'AL', 'Some County', value // 2, value, value * 1000)
+
+def write_04_08(fn, flows, swap):
+    # the 2004 - 2008 inflow files have the origin and destination fields backwards
+    f = open(fn, 'w')
+    for origin, destination, value in flows:
+        if swap:
+            origin, destination = destination, origin
+        f.write(format_row_04_08(origin, destination, value) + '\n')
+    f.write('\n')
+    f.close()
+
+def write_csv(fn, flows, columns):
+    f = open(fn, 'w')
+    f.write(','.join(columns) + '\n')
+    for origin, destination, value in flows:
+        f.write('%s,%s,%s,%s,AL,Some County,%d,%d,%d\n' % (origin[:2], origin[2:], destination[:2], destination[2:], value // 2, value, value * 1000))
+    f.close()
+
+COLUMNS_08_11 = ['State_Code_Origin', 'County_Code_Origin', 'State_Code_Dest', 'County_Code_Dest', 'State_Abbrv', 'County_Name', 'Return_Num', 'Exmpt_Num', 'Aggr_AGI']
+COLUMNS_11_15 = ['y1_statefips', 'y1_countyfips', 'y2_statefips', 'y2_countyfips', 'y2_state', 'y2_countyname', 'n1', 'n2', 'agi']
+
+@pytest.fixture
+def data_dir(tmp_path):
+    for year in [2004, 2008, 2011]:
+        dirname, in_fn, out_fn = MigrationData.IRSMigrationData.YEAR_FN_MAP[year]
+        os.makedirs(str(tmp_path / dirname))
+        in_fn, out_fn = str(tmp_path / dirname / in_fn), str(tmp_path / dirname / out_fn)
+        if year == 2004:
+            write_04_08(in_fn, IN_FLOWS + OTHER_FLOWS, swap=True)
+            write_04_08(out_fn, OUT_FLOWS + OTHER_FLOWS, swap=False)
+        else:
+            columns = COLUMNS_08_11 if year == 2008 else COLUMNS_11_15
+            write_csv(in_fn, IN_FLOWS + OTHER_FLOWS, columns)
+            write_csv(out_fn, OUT_FLOWS + OTHER_FLOWS, columns)
+    return str(tmp_path)
+
+@pytest.mark.parametrize('year', [2004, 2008, 2011])
+def test_columnar_loaders(data_dir, year):
+    migration_data = MigrationData.IRSMigrationData(data_dir=data_dir)
+    for fn in migration_data.get_fn_from_year(year):
+        reference = MigrationData.records_to_columnar(migration_data.get_loader_from_year(year)(fn))
+        columnar = migration_data.get_loader_from_year(year, columnar=True)(fn)
+        batches = list(migration_data.get_iterator_from_year(year)(fn, batch_size=3))
+        streamed = [np.concatenate([batch[k] for batch in batches]) for k in range(3)]
+        assert len(batches) == 3
+        for expected, actual, actual_streamed in zip(reference, columnar, streamed):
+            assert actual.dtype == np.int64
+            assert np.array_equal(expected, actual)
+            assert np.array_equal(expected, actual_streamed)
+
+    assert MigrationData.columnar_to_records(*columnar) == migration_data.get_loader_from_year(year)(fn)
+
+def test_record_cache(data_dir, tmp_path):
+    cache = MigrationData.RecordCache(cache_dir=str(tmp_path / 'cache'))
+    migration_data = MigrationData.IRSMigrationData(data_dir=data_dir)
+    cached_migration_data = MigrationData.IRSMigrationData(data_dir=data_dir, cache=cache)
+    for i in range(2):
+        assert cached_migration_data.get_raw_data(2004) == migration_data.get_raw_data(2004)
+    assert (cache.hits, cache.misses) == (2, 2)
+
+@pytest.mark.parametrize('year', [2004, 2008, 2011])
+def test_processed_data(data_dir, year):
+    migration_data = MigrationData.IRSMigrationData(data_dir=data_dir)
+    county_fips = [A, B, C]
+
+    expected = np.zeros((3, 3), dtype=np.int32)
+    expected[0, 1] = 10
+    expected[0, 2] = 4
+    expected[1, 0] = 8
+    expected[2, 0] = 9
+
+    reference = np.zeros((3, 3), dtype=np.int32)
+    reference_counts = migration_data._fill_migration_matrix_slow(year, MigrationData.fips_to_int(county_fips), reference)
+    origin_idx, destination_idx, value, repeats, discrepancies = migration_data._get_migration_entries(year, MigrationData.fips_to_int(county_fips))
+
+    # B -> A and C -> A are repeated in the outflow file with different values (8 vs 5 and 9 vs 7)
+    assert reference_counts == (2, 5)
+    assert (repeats, discrepancies) == reference_counts
+    assert np.array_equal(reference, expected)
+
+    for fips in [county_fips, MigrationData.fips_to_int(county_fips)]:
+        assert np.array_equal(migration_data.get_processed_data(year, fips), expected)
+        assert np.array_equal(migration_data.get_processed_data(year, fips, slow_mode=True), expected)
+        sparse = migration_data.get_processed_data(year, fips, sparse=True)
+        assert sparse.nnz == 4
+        assert np.array_equal(sparse.toarray(), expected)
+
+    cube = migration_data.get_processed_cube([year, year], county_fips, workers=1)
+    assert cube.shape == (2, 3, 3) and np.array_equal(cube[1], expected)
+
+def get_migration_matrices(num_years=3, n=12, seed=0):
+    rng = np.random.RandomState(seed)
+    matrices = rng.randint(0, 100, size=(num_years, n, n)).astype(np.int32)
+    matrices[rng.rand(num_years, n, n) < 0.5] = 0
+    return matrices
+
+def file_state(fn):
+    stat = os.stat(fn)
+    f = open(fn, 'rb')
+    data = f.read()
+    f.close()
+    return stat.st_mtime_ns, hashlib.sha224(data).hexdigest()
+
+def test_migration_cube(tmp_path):
+    matrices = get_migration_matrices()
+    n = matrices.shape[1]
+    years = [2004, 2005, 2006]
+    county_fips = ['%05d' % (1001 + 2*i) for i in range(n)]
+    path = str(tmp_path / 'cube')
+
+    # matrices can be dense, sparse or filenames
+    fn = str(tmp_path / 'matrix.npy')
+    MigrationData.save_migration_matrix(fn, matrices[2])
+    cube = MigrationData.MigrationCube.from_matrices(path, years, county_fips, [matrices[0], scipy.sparse.csr_matrix(matrices[1]), fn])
+    cube_fn = os.path.join(path, MigrationData.MigrationCube.CUBE_FN)
+    state = file_state(cube_fn)
+
+    cube = MigrationData.MigrationCube(path)
+    assert cube.shape == matrices.shape and cube.county_fips == county_fips
+    assert np.array_equal(cube.get_county_idxs([county_fips[3], int(county_fips[0])]), [3, 0])
+    with pytest.raises(ValueError):
+        cube.get_county_idxs(['99001'])
+    with pytest.raises(ValueError):
+        cube.get(2010)
+
+    selectors = [None, slice(2, 9), slice(None, None, 2), np.array([5, 1, 7]), np.arange(3, 11), np.array([0, 11, 4, 6])]
+    for i, year in enumerate(years):
+        for remove_diagonal in [False, True]:
+            dense = matrices[i].copy()
+            if remove_diagonal:
+                np.fill_diagonal(dense, 0)
+            for origins in selectors:
+                for destinations in selectors:
+                    expected = dense[slice(None) if origins is None else origins][:, slice(None) if destinations is None else destinations]
+                    block = cube.get(year, origins, destinations, remove_diagonal=remove_diagonal)
+                    assert block.dtype == np.int32
+                    assert np.array_equal(block, expected)
+                    # views of the memory map can't be written to, and new arrays don't share memory with it
+                    assert not block.flags.writeable or not np.may_share_memory(block, cube.data)
+        assert np.array_equal(cube.get_years([year], np.array([5, 1, 7]), None, remove_diagonal=True)[0], cube.get(year, np.array([5, 1, 7]), remove_diagonal=True))
+    assert np.array_equal(cube.get_years(), matrices)
+
+    # reads never modify the store
+    assert file_state(cube_fn) == state
+    assert np.array_equal(np.load(cube_fn), matrices)
+
+def get_full_dataset(population_vectors, distances, intervening_opportunities, migration_matrices, year_idx, origin_list, destination_list):
+    ''' The `get_full_dataset` of the model notebooks.
+    '''
+    origin_pop = population_vectors[year_idx][origin_list].astype(float)
+    T = migration_matrices[year_idx][origin_list,:][:,destination_list].astype(float)
+    return {
+        'origin_pop': origin_pop,
+        'destination_pop': population_vectors[year_idx][destination_list].astype(float),
+        'S': intervening_opportunities[year_idx][origin_list,:][:,destination_list].astype(float),
+        'D': distances[origin_list,:][:,destination_list].astype(float),
+        'T': T,
+        'beta': np.dot(origin_pop[:,0], T.sum(axis=1)) / np.dot(origin_pop[:,0], origin_pop[:,0]),
+    }
+
+def get_dataset_inputs(num_years=3, n=12, seed=0):
+    rng = np.random.RandomState(seed)
+    population_vectors = rng.randint(1000, 100000, size=(num_years, n, 1))
+    distances = rng.uniform(0, 1000, size=(n, n))
+    intervening_opportunities = rng.uniform(0, 1e6, size=(num_years, n, n)).astype(np.float32)
+    return population_vectors, distances, intervening_opportunities, get_migration_matrices(num_years, n, seed)
+
+@pytest.mark.parametrize('sparse', [False, True])
+def test_migration_dataset(sparse):
+    population_vectors, distances, intervening_opportunities, migration_matrices = get_dataset_inputs()
+    n = distances.shape[0]
+    groups = {'flooded': [7, 2, 9], 'unflooded': [0, 1, 3, 4, 5]}
+    inputs = (population_vectors, distances, intervening_opportunities, [scipy.sparse.csr_matrix(x) for x in migration_matrices] if sparse else migration_matrices)
+
+    subsets = [None, 'flooded', 'unflooded', [7, 2, 9], [3, 4, 5], [11, 0, 6, 2], np.arange(0, n, 3)]
+    for dataset_groups in [None, groups]:
+        dataset = MigrationData.MigrationDataset(*inputs, groups=dataset_groups)
+        for origins in subsets:
+            for destinations in subsets:
+                if (isinstance(origins, str) or isinstance(destinations, str)) and dataset_groups is None:
+                    continue
+                # None is all of the counties, in the order they are stored in (the groups first)
+                origin_list = groups[origins] if isinstance(origins, str) else (dataset.order if origins is None else origins)
+                destination_list = groups[destinations] if isinstance(destinations, str) else (dataset.order if destinations is None else destinations)
+                assert np.array_equal(dataset.get_county_idxs(origins), origin_list)
+
+                expected = get_full_dataset(population_vectors, distances, intervening_opportunities, migration_matrices, 1, origin_list, destination_list)
+                data = dataset.get(1, origins, destinations)
+                for key in ['origin_pop', 'destination_pop', 'S', 'D', 'T']:
+                    actual = data[key].toarray() if scipy.sparse.issparse(data[key]) else data[key]
+                    assert np.array_equal(actual.astype(float), expected[key]), key
+                assert np.isclose(data['beta'], expected['beta'], rtol=1e-12)
+
+                # contiguous subsets (e.g. every group of a dataset with groups) are views of the stored arrays
+                if isinstance(dataset.get_selector(origins), slice) and isinstance(dataset.get_selector(destinations), slice):
+                    assert np.shares_memory(data['D'], dataset.distances)
+        if dataset_groups is not None:
+            assert isinstance(dataset.get_selector('flooded'), slice) and isinstance(dataset.get_selector([7, 2]), slice)
+
+def test_migration_dataset_fingerprint():
+    population_vectors, distances, intervening_opportunities, migration_matrices = get_dataset_inputs()
+    dataset = MigrationData.MigrationDataset(population_vectors, distances, intervening_opportunities, migration_matrices)
+    fingerprints = [dataset.get_fingerprint(i) for i in range(3)]
+    assert len(set(fingerprints)) == 3
+
+    # sparse migration matrices (also with explicitly stored zeros) give the same fingerprints as dense ones
+    sparse_matrices = [scipy.sparse.csr_matrix(x) for x in migration_matrices]
+    sparse_matrices[1] = scipy.sparse.csr_matrix(migration_matrices[1] + 1)
+    sparse_matrices[1].data -= 1
+    sparse_dataset = MigrationData.MigrationDataset(population_vectors, distances, intervening_opportunities, sparse_matrices)
+    assert [sparse_dataset.get_fingerprint(i) for i in range(3)] == fingerprints
+    assert sparse_matrices[1].nnz == migration_matrices[1].size
+
+    # a change to any of the inputs of a year changes its fingerprint only
+    changed = migration_matrices.copy()
+    changed[2, 0, 1] += 1
+    changed_dataset = MigrationData.MigrationDataset(population_vectors, distances, intervening_opportunities, changed)
+    assert [changed_dataset.get_fingerprint(i) for i in range(3)] == fingerprints[:2] + [changed_dataset.get_fingerprint(2)]
+    assert changed_dataset.get_fingerprint(2) != fingerprints[2]
+    changed_dataset = MigrationData.MigrationDataset(population_vectors, distances * 2, intervening_opportunities, migration_matrices)
+    assert not set(changed_dataset.get_fingerprint(i) for i in range(3)) & set(fingerprints)
+
+def test_record_cache_eviction(data_dir, tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    migration_data = MigrationData.IRSMigrationData(data_dir=data_dir)
+    fns = [fn for year in [2004, 2008, 2011] for fn in migration_data.get_fn_from_year(year)]
+    loaders = [migration_data.get_loader_from_year(year, columnar=True) for year in [2004, 2008, 2011] for _ in range(2)]
+
+    cache = MigrationData.RecordCache(cache_dir=cache_dir)
+    for fn, loader in zip(fns, loaders):
+        cache.load(fn, loader)
+    entries = cache.get_entries()
+    assert len(entries) == 6
+
+    # a file written by a concurrent writer is neither an entry nor removed
+    tmp_fn = '%s.%d.tmp.npz' % (cache.get_cache_fn(fns[0])[:-4], os.getpid() + 1)
+    open(tmp_fn, 'w').close()
+
+    # a modified source file misses the cache and replaces its stale entry
+    stale_fn = cache.get_cache_fn(fns[0])
+    stat = os.stat(fns[0])
+    os.utime(fns[0], ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert cache.get_cache_fn(fns[0]) != stale_fn
+    for expected, actual in zip(loaders[0](fns[0]), cache.load(fns[0], loaders[0])):
+        assert np.array_equal(expected, actual)
+    assert (cache.hits, cache.misses) == (0, 7)
+    assert not os.path.exists(stale_fn) and os.path.exists(cache.get_cache_fn(fns[0])) and os.path.exists(tmp_fn)
+    assert len(cache.get_entries()) == 6
+
+    # the least recently used entries are evicted until the cache fits, the entry that was just written is kept
+    for i, (_, _, cache_fn) in enumerate(cache.get_entries()):
+        os.utime(cache_fn, (1000000000 + i, 1000000000 + i))
+    sizes = {cache_fn: size for _, size, cache_fn in cache.get_entries()}
+    cache.load(fns[1], loaders[1]) # a hit, which makes it the most recently used entry
+    max_bytes = sizes[cache.get_cache_fn(fns[1])] + sizes[cache.get_cache_fn(fns[2])]
+    cache = MigrationData.RecordCache(cache_dir=cache_dir, max_bytes=max_bytes)
+    os.utime(fns[2], ns=(os.stat(fns[2]).st_atime_ns, os.stat(fns[2]).st_mtime_ns + 10**9))
+    cache.load(fns[2], loaders[2]) # a new entry with the same size
+    assert sorted(cache_fn for _, _, cache_fn in cache.get_entries()) == sorted([cache.get_cache_fn(fns[1]), cache.get_cache_fn(fns[2])])
+    assert sum(size for _, size, _ in cache.get_entries()) <= max_bytes
+    assert os.path.exists(tmp_fn)
+
+    cache.clear()
+    assert cache.get_entries() == [] and (cache.hits, cache.misses) == (0, 0)
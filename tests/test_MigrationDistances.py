@@ -0,0 +1,72 @@
+'''
+Checks the distance matrices against `scipy.spatial.distance.cdist` and `squareform`.
+'''
+import numpy as np
+import scipy.spatial.distance
+import pytest
+
+import MigrationDistances
+
+def get_coordinates(n=50, seed=0):
+    rng = np.random.RandomState(seed)
+    return np.stack([rng.uniform(-80, 80, size=n), rng.uniform(-180, 180, size=n)], axis=1)
+
+def haversine(u, v, radius=MigrationDistances.EARTH_RADIUS_KM):
+    '''Great-circle distance between two (latitude, longitude) points, as in the `haversine` package.
+    '''
+    lat1, lon1, lat2, lon2 = np.radians([u[0], u[1], v[0], v[1]])
+    a = np.sin((lat2 - lat1) / 2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2)**2
+    return 2 * radius * np.arcsin(np.sqrt(a))
+
+def test_haversine_distances():
+    coordinatesA, coordinatesB = get_coordinates(20, seed=0), get_coordinates(30, seed=1)
+    expected = scipy.spatial.distance.cdist(coordinatesA, coordinatesB, haversine)
+    np.testing.assert_allclose(MigrationDistances.haversineDistances(coordinatesA, coordinatesB), expected, rtol=1e-10)
+    np.testing.assert_allclose(MigrationDistances.haversineDistances(coordinatesA, coordinatesB, radius=1.0), expected / MigrationDistances.EARTH_RADIUS_KM, rtol=1e-10)
+    np.testing.assert_allclose(MigrationDistances.haversineDistances(coordinatesA, coordinatesB, dtype=np.float32), expected, rtol=1e-3)
+
+    # against the package itself when it is installed
+    haversinePackage = pytest.importorskip("haversine")
+    np.testing.assert_allclose(expected, scipy.spatial.distance.cdist(coordinatesA, coordinatesB, haversinePackage.haversine), rtol=1e-10)
+
+@pytest.mark.parametrize("tileSize", [1024, 7])
+def test_distance_matrix(tileSize):
+    coordinates = get_coordinates()
+    expected = scipy.spatial.distance.cdist(coordinates, coordinates, haversine)
+
+    D = MigrationDistances.getDistanceMatrix(coordinates, tileSize=tileSize)
+    np.testing.assert_allclose(D, expected, rtol=1e-10, atol=1e-9)
+
+    condensed = MigrationDistances.getDistanceMatrix(coordinates, condensed=True, tileSize=tileSize)
+    np.testing.assert_array_equal(condensed, scipy.spatial.distance.squareform(D, checks=False))
+    out = np.empty_like(condensed)
+    assert MigrationDistances.getDistanceMatrix(coordinates, condensed=True, tileSize=tileSize, out=out) is out
+    np.testing.assert_array_equal(out, condensed)
+
+    assert MigrationDistances.isCondensed(condensed) and not MigrationDistances.isCondensed(D)
+    assert MigrationDistances.getDistanceMatrixSize(condensed) == MigrationDistances.getDistanceMatrixSize(D) == coordinates.shape[0]
+
+def test_condensed_rows():
+    coordinates = get_coordinates()
+    n = coordinates.shape[0]
+    condensed = MigrationDistances.getDistanceMatrix(coordinates, condensed=True)
+    square = scipy.spatial.distance.squareform(condensed)
+
+    for rowStart, rowEnd in [(0, n), (0, 1), (n-1, n), (7, 23)]:
+        np.testing.assert_array_equal(MigrationDistances.getCondensedRows(condensed, rowStart, rowEnd), square[rowStart:rowEnd])
+        np.testing.assert_array_equal(MigrationDistances.getDistanceRows(condensed, rowStart, rowEnd), square[rowStart:rowEnd])
+        np.testing.assert_array_equal(MigrationDistances.CondensedDistanceRows(condensed)(rowStart, rowEnd), square[rowStart:rowEnd])
+
+    np.testing.assert_allclose(MigrationDistances.HaversineDistanceRows(coordinates)(7, 23), square[7:23], rtol=1e-10, atol=1e-9)
+
+def test_distances():
+    coordinates = get_coordinates()
+    n = coordinates.shape[0]
+    condensed = MigrationDistances.getDistanceMatrix(coordinates, condensed=True)
+    square = scipy.spatial.distance.squareform(condensed)
+
+    rng = np.random.RandomState(0)
+    rows, cols = rng.randint(0, n, size=200), rng.randint(0, n, size=200)
+    rows[:n], cols[:n] = np.arange(n), np.arange(n) # the diagonal
+    np.testing.assert_array_equal(MigrationDistances.getDistances(condensed, rows, cols), square[rows, cols])
+    np.testing.assert_array_equal(MigrationDistances.getDistances(square, rows, cols), square[rows, cols])
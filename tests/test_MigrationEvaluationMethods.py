@@ -0,0 +1,113 @@
+'''
+Checks that the evaluation metrics give the same results for scipy.sparse and dense flow matrices, and for square, condensed and
+binned (`DistanceBins`) distance matrices.
+'''
+import numpy as np
+import scipy.sparse
+import scipy.spatial.distance
+import pytest
+
+import MigrationEvaluationMethods
+
+N = 60
+
+def get_flows(seed=0):
+    '''Returns sparse observed and generated (N x N) flows: O has duplicate COO entries and explicitly stored zeros, G shares some of
+    the entries of O, has some of its own, and a few negative values.
+    '''
+    rng = np.random.RandomState(seed)
+    rows = rng.randint(0, N, size=5*N)
+    cols = rng.randint(0, N, size=5*N)
+    values = np.ceil(rng.lognormal(1, 1.5, size=5*N))
+    values[::17] = 0
+    O = scipy.sparse.coo_matrix((values, (rows, cols)), shape=(N,N))
+
+    otherRows = rng.randint(0, N, size=3*N)
+    otherCols = rng.randint(0, N, size=3*N)
+    gValues = np.concatenate([values * rng.lognormal(0, 0.5, size=values.shape[0]), rng.lognormal(0, 1, size=otherRows.shape[0])])
+    gValues[::23] *= -1
+    G = scipy.sparse.csr_matrix((gValues, (np.concatenate([rows, otherRows]), np.concatenate([cols, otherCols]))), shape=(N,N))
+    return O, G
+
+def get_distances(seed=0):
+    rng = np.random.RandomState(seed)
+    points = rng.uniform(0, 100, size=(N, 2))
+    return scipy.spatial.distance.cdist(points, points)
+
+def assert_results_equal(expected, actual):
+    for name, value in expected._asdict().items():
+        np.testing.assert_allclose(getattr(actual, name), value, rtol=1e-9, atol=1e-12, err_msg=name)
+
+@pytest.fixture
+def flows():
+    O, G = get_flows()
+    return O, G, O.toarray(), G.toarray()
+
+@pytest.mark.parametrize('sparseO', [True, False])
+@pytest.mark.parametrize('sparseG', [True, False])
+def test_pair_statistics(flows, sparseO, sparseG):
+    O, G, denseO, denseG = flows
+    expected = MigrationEvaluationMethods.get_pair_statistics(denseO, denseG, tileSize=7)
+    actual = MigrationEvaluationMethods.get_pair_statistics(O if sparseO else denseO, G if sparseG else denseG, tileSize=7)
+    np.testing.assert_allclose(actual, expected, rtol=1e-9)
+
+@pytest.mark.parametrize('sparseO', [True, False])
+@pytest.mark.parametrize('sparseG', [True, False])
+@pytest.mark.parametrize('distanceForm', ['square', 'condensed', 'bins'])
+def test_evaluate_metrics(flows, sparseO, sparseG, distanceForm):
+    O, G, denseO, denseG = flows
+    distances = get_distances()
+    expected = MigrationEvaluationMethods.evaluate_metrics(denseO, denseG, distances)
+
+    if distanceForm == 'condensed':
+        distances = scipy.spatial.distance.squareform(distances, checks=False)
+    elif distanceForm == 'bins':
+        distances = MigrationEvaluationMethods.DistanceBins(distances)
+    actual = MigrationEvaluationMethods.evaluate_metrics(O if sparseO else denseO, G if sparseG else denseG, distances, tileSize=7)
+    assert_results_equal(expected, actual)
+
+    for name in ['cpc', 'cpl', 'nrmse', 'rmse']:
+        metric = getattr(MigrationEvaluationMethods, name)
+        assert np.isclose(metric(O if sparseO else denseO, G if sparseG else denseG), metric(denseO, denseG), rtol=1e-9)
+
+@pytest.mark.parametrize('sparseO', [True, False])
+def test_observed_flows(flows, sparseO):
+    O, G, denseO, denseG = flows
+    distances = get_distances()
+    observed = MigrationEvaluationMethods.ObservedFlows(O if sparseO else denseO, distances, tileSize=7)
+
+    predictions = [denseG, G, np.abs(denseG)]
+    for prediction in predictions:
+        expected = MigrationEvaluationMethods.evaluate_metrics(denseO, prediction.toarray() if scipy.sparse.issparse(prediction) else prediction, distances)
+        assert_results_equal(expected, observed.evaluate(prediction))
+
+    frame = MigrationEvaluationMethods.evaluate_many(observed, predictions, labels=['dense', 'sparse', 'abs'])
+    np.testing.assert_allclose(frame.loc['sparse'].values, frame.loc['dense'].values, rtol=1e-9)
+
+@pytest.mark.parametrize('distanceForm', ['square', 'condensed', 'file'])
+def test_distance_bins(flows, tmp_path, distanceForm):
+    O, G, denseO, denseG = flows
+    distances = get_distances()
+    # G with a different distribution over the bins, and G without its negative entries
+    Gs = [denseG, denseG[::-1], np.abs(denseG)]
+    expected = np.array([MigrationEvaluationMethods.cpc_d(denseO, X, distances) for X in Gs])
+
+    source = distances if distanceForm == 'square' else scipy.spatial.distance.squareform(distances, checks=False)
+    if distanceForm == 'file':
+        np.save(str(tmp_path / 'distances.npy'), source)
+        source = str(tmp_path / 'distances.npy')
+    distanceBins = MigrationEvaluationMethods.DistanceBins(source, tileSize=7)
+    assert distanceBins.shape == (N, N)
+
+    fn = str(tmp_path / 'bins.npz')
+    distanceBins.save(fn)
+    for bins in [distanceBins, MigrationEvaluationMethods.DistanceBins.load(fn, tileSize=7)]:
+        assert bins.numBins == distanceBins.numBins and bins.binWidth == 2
+        np.testing.assert_array_equal(bins.index, distanceBins.index)
+        for i, X in enumerate(Gs):
+            np.testing.assert_allclose(bins.cpc_d(denseO, X), expected[i], rtol=1e-12)
+            np.testing.assert_allclose(bins.cpc_d(O, scipy.sparse.csr_matrix(X)), expected[i], rtol=1e-12)
+            np.testing.assert_allclose(MigrationEvaluationMethods.cpc_d(denseO, X, bins), expected[i], rtol=1e-12)
+        np.testing.assert_allclose(bins.cpc_d_batch(denseO, Gs), expected, rtol=1e-12)
+        np.testing.assert_allclose(bins.cpc_d_batch(O, np.stack(Gs)), expected, rtol=1e-12)
+        np.testing.assert_allclose(bins.cpc_d_batch(denseO, [scipy.sparse.csr_matrix(X) for X in Gs]), expected, rtol=1e-12)
@@ -0,0 +1,64 @@
+'''
+Checks the vectorized pair features against the `slowMode` loop, for dense and scipy.sparse migration matrices.
+'''
+import numpy as np
+import scipy.sparse
+import pytest
+
+import MigrationModels
+import MigrationFeatures
+
+def get_inputs(n=23, m=23, seed=0):
+    rng = np.random.RandomState(seed)
+    origins = rng.randint(100, 10000, size=(n, 1))
+    destinations = origins[:m] if m == n else rng.randint(100, 10000, size=(m, 1))
+    d = rng.uniform(0, 500, size=(n, m))
+    s = rng.uniform(0, 1e5, size=(n, m))
+    T = (rng.rand(n, m) < 0.2) * rng.randint(1, 50, size=(n, m))
+    return origins, destinations, d, s, T
+
+@pytest.mark.parametrize('form', ['dense', 'csr', 'coo'])
+def test_pair_features(form):
+    origins, destinations, d, s, T = get_inputs()
+    expectedX, expectedY = MigrationFeatures.getPairFeatures(origins, destinations, d, s, T=T, slowMode=True)
+
+    if form == 'csr':
+        T = scipy.sparse.csr_matrix(T)
+    elif form == 'coo':
+        T = scipy.sparse.coo_matrix(T)
+    X, Y = MigrationFeatures.getPairFeatures(origins, destinations, d, s, T=T, chunkSize=5)
+    assert np.array_equal(X, expectedX)
+    assert np.array_equal(Y, expectedY)
+
+    # the chunks share a buffer, so they are copied as they are yielded
+    chunks = [YChunk.copy() for _, _, _, YChunk in MigrationFeatures.iterPairFeatures(origins, destinations, d, s, T=T, chunkSize=5)]
+    assert np.array_equal(np.concatenate(chunks), expectedY)
+
+def test_pair_features_outputs(tmp_path):
+    origins, destinations, d, s, T = get_inputs(n=17, m=17)
+    expectedX, expectedY = MigrationFeatures.getPairFeatures(origins, destinations, d, s, T=T, slowMode=True)
+
+    # intervening opportunities computed on the fly, written to memory maps
+    s = MigrationModels.InterveningOpportunitiesRows(origins, d)
+    expectedX[:,3] = MigrationModels.getInterveningOpportunities(origins, d).ravel()
+    X, Y = MigrationFeatures.getPairFeatures(origins, destinations, d, s, T=T, chunkSize=4, out=str(tmp_path / 'X.npy'), yOut=str(tmp_path / 'Y.npy'))
+    assert isinstance(X, np.memmap)
+    assert np.array_equal(np.load(str(tmp_path / 'X.npy')), expectedX)
+    assert np.array_equal(np.load(str(tmp_path / 'Y.npy')), expectedY)
+
+    with pytest.raises(AssertionError):
+        MigrationFeatures.getPairFeatures(origins, destinations, d, s, out=np.empty((17*17, 8))[:, ::2])
+
+def test_pair_sampler():
+    origins, destinations, d, s, T = get_inputs(n=20, m=30)
+    X, Y = MigrationFeatures.getPairFeatures(origins, destinations, d, s, T=T)
+
+    for sampledT in [T, scipy.sparse.csr_matrix(T)]:
+        sampler = MigrationFeatures.PairSampler(sampledT, negativeRatio=3, seed=0)
+        rows, cols, sampledY = sampler.sample(shuffle=True)
+        assert np.count_nonzero(sampledY) == np.count_nonzero(T)
+        assert np.all(T[rows[sampledY == 0], cols[sampledY == 0]] == 0)
+
+        sampledX = MigrationFeatures.getPairFeaturesAt(origins, destinations, d, s, rows, cols)
+        assert np.array_equal(sampledX, X[rows * T.shape[1] + cols])
+        assert np.array_equal(sampledY, Y[rows * T.shape[1] + cols])
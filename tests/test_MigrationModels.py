@@ -0,0 +1,250 @@
+'''
+Checks the vectorized models against their `slowMode` implementations, and the balancing factors of the constrained models.
+'''
+import pickle
+import warnings
+
+import numpy as np
+import scipy.sparse
+import pytest
+
+import MigrationModels
+import MigrationDistances
+
+def get_locations(n=30, seed=0):
+    '''Returns (n x 1) populations, (n x 2) coordinates and the matching square distance and intervening opportunities matrices.
+    '''
+    rng = np.random.RandomState(seed)
+    features = rng.randint(100, 100000, size=(n, 1))
+    coordinates = np.stack([rng.uniform(25, 49, size=n), rng.uniform(-124, -67, size=n)], axis=1)
+    d = MigrationDistances.getDistanceMatrix(coordinates)
+    s = MigrationModels.getInterveningOpportunities(features, d)
+    return features, coordinates, d, s
+
+# (model, decay, alpha), alpha is per km for the exponential decay
+MODEL_CASES = [("radiation", None, None), ("extendedRadiation", None, 0.7), ("gravity", "power", 1.5), ("gravity", "exponential", 0.01)]
+
+def evaluate(model, decay, alpha, features, x, **kwargs):
+    if model == "radiation":
+        return MigrationModels.radiationModel(features, features, x, **kwargs)
+    elif model == "extendedRadiation":
+        return MigrationModels.extendedRadiationModel(features, features, x, alpha, **kwargs)
+    return MigrationModels.gravityModel(features, features, x, alpha, decay=decay, **kwargs)
+
+def assert_matches_slow_mode(model, decay, actual, expected, rtol):
+    if decay == "exponential":
+        # slowMode skips the diagonal, where the vectorized exponential decay gives origins * destinations (d = 0)
+        mask = ~np.eye(expected.shape[0], dtype=bool)
+        actual, expected = actual[mask], expected[mask]
+    np.testing.assert_allclose(actual, expected, rtol=rtol, atol=0)
+
+@pytest.mark.parametrize("model,decay,alpha", MODEL_CASES)
+@pytest.mark.parametrize("dtype,rtol", [(np.float64, 1e-10), (np.float32, 1e-4)])
+def test_models_match_slow_mode(model, decay, alpha, dtype, rtol):
+    features, coordinates, d, s = get_locations()
+    x = d if model == "gravity" else s
+    expected = evaluate(model, decay, alpha, features, x, slowMode=True)
+
+    actual = evaluate(model, decay, alpha, features, x, dtype=dtype)
+    assert actual.dtype == dtype
+    assert_matches_slow_mode(model, decay, actual, expected, rtol)
+
+    out = np.full(expected.shape, np.nan, dtype=dtype)
+    assert evaluate(model, decay, alpha, features, x, dtype=dtype, out=out) is out
+    assert_matches_slow_mode(model, decay, out, expected, rtol)
+
+@pytest.mark.parametrize("model,decay,alpha", MODEL_CASES[:2])
+def test_sparse_s_matches_slow_mode(model, decay, alpha):
+    features, coordinates, d, s = get_locations()
+    expected = evaluate(model, decay, alpha, features, s, slowMode=True)
+
+    # with every destination in the neighbourhoods the sparse model has the same values as the dense one
+    sparseS = MigrationModels.getSparseInterveningOpportunities(features, coordinates, k=features.shape[0])
+    actual = evaluate(model, decay, alpha, features, sparseS)
+    assert scipy.sparse.issparse(actual) and actual.nnz == features.shape[0]**2
+    np.testing.assert_allclose(actual.toarray(), expected, rtol=1e-6)
+
+@pytest.mark.parametrize("model,decay,alpha", MODEL_CASES[2:])
+def test_condensed_d_matches_slow_mode(model, decay, alpha):
+    features, coordinates, d, s = get_locations()
+    expected = evaluate(model, decay, alpha, features, d, slowMode=True)
+    condensed = MigrationDistances.getDistanceMatrix(coordinates, condensed=True)
+    assert_matches_slow_mode(model, decay, evaluate(model, decay, alpha, features, condensed), expected, 1e-10)
+
+def test_extended_radiation_large_alpha():
+    # For large alphas ((s + origins)**alpha + 1) * ((s + origins + destinations)**alpha + 1) overflows, the slowMode implementation
+    # gives inf/inf (set to 0) while the vectorized one, which never forms that product, still gives the finite value of the model
+    features = np.array([[500], [800]])
+    s = np.array([[0.0, 300.0], [200.0, 0.0]])
+    alpha = 60.0
+
+    with np.errstate(over="ignore", invalid="ignore"):
+        expected = MigrationModels.extendedRadiationModel(features, features, s, alpha, slowMode=True)
+    actual = MigrationModels.extendedRadiationModel(features, features, s, alpha)
+    assert np.all(expected == 0)
+    assert np.all(np.isfinite(actual)) and np.all(actual > 0)
+
+    # the same values computed in log space: (origins**alpha + 1) * (1/(x + 1) - 1/(y + 1)) ~ origins**alpha * (1/x - 1/y)
+    logOrigins = np.log(features.astype(float))
+    logX = alpha * np.log(s + features)
+    logY = alpha * np.log(s + features + features.T)
+    np.testing.assert_allclose(actual, np.exp(alpha * logOrigins - logX) - np.exp(alpha * logOrigins - logY), rtol=1e-9)
+
+    # both implementations agree below the overflow
+    np.testing.assert_allclose(MigrationModels.extendedRadiationModel(features, features, s, 20.0),
+        MigrationModels.extendedRadiationModel(features, features, s, 20.0, slowMode=True), rtol=1e-10)
+
+@pytest.mark.parametrize("tileSize", [1024, 7])
+def test_intervening_opportunities_match_slow_mode(tileSize):
+    features, coordinates, d, s = get_locations()
+    expected = MigrationModels.getInterveningOpportunities(features, d, slowMode=True)
+    np.testing.assert_array_equal(MigrationModels.getInterveningOpportunities(features, d, tileSize=tileSize), expected)
+
+    # precomputed ranks, with and without the distance matrix
+    ranks = MigrationModels.getDistanceRanks(d, tileSize=tileSize)
+    np.testing.assert_array_equal(ranks, np.argsort(d, kind="mergesort", axis=1))
+    np.testing.assert_array_equal(MigrationModels.getInterveningOpportunities(features, d, ranks=ranks, tileSize=tileSize), expected)
+    np.testing.assert_array_equal(MigrationModels.getInterveningOpportunities(features, None, ranks=ranks, tileSize=tileSize), expected)
+
+    out = np.empty_like(expected)
+    assert MigrationModels.scatterInterveningOpportunities(features, ranks, out) is out
+    np.testing.assert_array_equal(out, expected)
+
+def test_intervening_opportunities_stacked_features():
+    features, coordinates, d, s = get_locations()
+    rng = np.random.RandomState(1)
+    stacked = np.stack([features, features + rng.randint(0, 1000, size=features.shape), rng.randint(100, 100000, size=features.shape)])
+
+    expected = np.stack([MigrationModels.getInterveningOpportunities(stacked[i], d, slowMode=True) for i in range(stacked.shape[0])])
+    np.testing.assert_array_equal(MigrationModels.getInterveningOpportunities(stacked, d, slowMode=True), expected)
+    np.testing.assert_array_equal(MigrationModels.getInterveningOpportunities(stacked, d), expected)
+    ranks = MigrationModels.getDistanceRanks(d)
+    np.testing.assert_array_equal(MigrationModels.getInterveningOpportunities(stacked, None, ranks=ranks), expected)
+
+def test_intervening_opportunities_condensed():
+    features, coordinates, d, s = get_locations()
+    condensed = MigrationDistances.getDistanceMatrix(coordinates, condensed=True)
+    # the condensed matrix is the upper triangle, mirrored to the lower one when rows are read
+    square = MigrationDistances.getCondensedRows(condensed, 0, features.shape[0])
+    expected = MigrationModels.getInterveningOpportunities(features, square, slowMode=True)
+
+    np.testing.assert_array_equal(MigrationModels.getInterveningOpportunities(features, condensed, tileSize=7), expected)
+    np.testing.assert_array_equal(MigrationModels.getDistanceRanks(condensed, tileSize=7), MigrationModels.getDistanceRanks(square))
+    np.testing.assert_array_equal(MigrationModels.getInterveningOpportunities(features, condensed), s)
+
+@pytest.mark.parametrize("k,radius", [(5, None), (29, None), (None, 1000.0), (8, 1500.0), (None, 1.0)])
+def test_sparse_intervening_opportunities(k, radius):
+    features, coordinates, d, s = get_locations()
+    n = features.shape[0]
+    sparseS = MigrationModels.getSparseInterveningOpportunities(features, coordinates, k=k, radius=radius)
+    matrix = sparseS.matrix.tocoo()
+
+    # the neighbourhoods are the closest destinations of each origin (including the origin itself)
+    counts = np.diff(sparseS.matrix.indptr)
+    expectedCounts = np.full(n, n) if radius is None else (d <= radius).sum(axis=1)
+    if k is not None:
+        expectedCounts = np.minimum(expectedCounts, k + 1)
+    np.testing.assert_array_equal(counts, expectedCounts)
+    np.testing.assert_array_equal(np.sort(sparseS.matrix.indices[sparseS.matrix.indptr[:-1]]), np.arange(n))
+
+    # the stored entries are the entries of the dense S
+    np.testing.assert_allclose(matrix.data, s[matrix.row, matrix.col], rtol=1e-6)
+    np.testing.assert_allclose(sparseS.total[:,0], features[:,0].sum() - features[:,0])
+
+    # and the stored sums plus the tails are the row sums of the dense models
+    for model, alpha in [("radiation", None), ("extendedRadiation", 0.7)]:
+        expected = evaluate(model, None, alpha, features, s).sum(axis=1)
+        if model == "radiation":
+            P = MigrationModels.radiationModel(features, features, sparseS)
+            tail = MigrationModels.radiationModelTail(features, sparseS)
+        else:
+            P = MigrationModels.extendedRadiationModel(features, features, sparseS, alpha)
+            tail = MigrationModels.extendedRadiationModelTail(features, sparseS, alpha)
+        assert tail.shape == (n, 1) and np.all(tail >= 0)
+        np.testing.assert_allclose(np.asarray(P.sum(axis=1))[:,0] + tail[:,0], expected, rtol=1e-6)
+
+def save_memmap(fn, x):
+    np.save(fn, x)
+    return np.load(fn, mmap_mode="r")
+
+@pytest.mark.parametrize("workers", [1, 2])
+@pytest.mark.parametrize("model,decay,alpha", MODEL_CASES)
+def test_evaluate_model_tiled(tmp_path, workers, model, decay, alpha):
+    features, coordinates, d, s = get_locations()
+    x = d if model == "gravity" else s
+    expected = MigrationModels.evaluateModelTile(model, features, features, x, alpha=alpha, decay=decay)
+
+    # a memory mapped `x` and a `.npy` output
+    xMemmap = save_memmap(str(tmp_path / "x.npy"), x)
+    outFn = str(tmp_path / "P.npy")
+    out = MigrationModels.evaluateModelTiled(model, features, features, xMemmap, alpha=alpha, decay=decay, tileSize=7, out=outFn, workers=workers)
+    assert isinstance(out, np.memmap)
+    np.testing.assert_array_equal(out, expected)
+    del out
+    np.testing.assert_array_equal(np.load(outFn), expected)
+
+    # rows computed on the fly, and tiles passed to a callback
+    if model == "gravity":
+        rows = MigrationDistances.CondensedDistanceRows(MigrationDistances.getDistanceMatrix(coordinates, condensed=True))
+    else:
+        rows = MigrationModels.InterveningOpportunitiesRows(features, save_memmap(str(tmp_path / "d.npy"), d))
+    tiles = {}
+    def callback(rowStart, rowEnd, P):
+        tiles[rowStart] = (rowEnd, P.copy())
+    assert MigrationModels.evaluateModelTiled(model, features, features, rows, alpha=alpha, decay=decay, tileSize=7, callback=callback, workers=workers) is None
+    assert sorted(tiles) == list(range(0, features.shape[0], 7))
+    for rowStart, (rowEnd, P) in tiles.items():
+        np.testing.assert_allclose(P, expected[rowStart:rowEnd], rtol=1e-12)
+
+def test_memmap_tiles_pickled_by_reference(tmp_path):
+    features, coordinates, d, s = get_locations()
+    sMemmap = save_memmap(str(tmp_path / "s.npy"), s)
+
+    # a block of rows of a memory map is sent to the workers as its location in the file
+    reference = MigrationDistances.getMemmapReference(sMemmap[7:14])
+    assert reference is not None and len(pickle.dumps(reference)) < sMemmap[7:14].nbytes
+    job = ("radiation", features[7:14], features, reference, 7, 14, None, "power", np.float64)
+    rowStart, rowEnd, P = MigrationModels._evaluateModelTileJob(pickle.loads(pickle.dumps(job)))
+    np.testing.assert_array_equal(P, MigrationModels.radiationModel(features, features, s)[7:14])
+
+    # and so are the memory maps of the row functions
+    dMemmap = save_memmap(str(tmp_path / "d.npy"), d)
+    rows = MigrationModels.InterveningOpportunitiesRows(features, dMemmap)
+    assert len(pickle.dumps(rows)) < dMemmap.nbytes
+    np.testing.assert_array_equal(pickle.loads(pickle.dumps(rows))(7, 14), s[7:14])
+
+def get_inputs(n=40, seed=0):
+    rng = np.random.RandomState(seed)
+    P = rng.lognormal(0, 2, size=(n, n))
+    outgoing = rng.uniform(10, 1000, size=n)
+    incoming = rng.uniform(10, 1000, size=n)
+    incoming *= outgoing.sum() / incoming.sum()
+    return P, outgoing, incoming
+
+@pytest.mark.parametrize('omega', [1.0, 1.5, 1.9])
+@pytest.mark.parametrize('sparse', [False, True])
+def test_balancing_factors(omega, sparse):
+    P, outgoing, incoming = get_inputs()
+    tol = 1e-8
+    a, b, numIterations, error = MigrationModels.getBalancingFactors(scipy.sparse.csr_matrix(P) if sparse else P, outgoing, incoming,
+        tol=tol, omega=omega, tileSize=7)
+
+    # the reported error is the error of the returned factors
+    T = a * P * b.T
+    rowError = np.abs(T.sum(axis=1) - outgoing).sum() / outgoing.sum()
+    colError = np.abs(T.sum(axis=0) - incoming).sum() / incoming.sum()
+    assert error < tol
+    assert np.isclose(error, max(rowError, colError), rtol=1e-6, atol=1e-15)
+
+def test_constrained_model_warns():
+    rng = np.random.RandomState(0)
+    origins = rng.randint(100, 10000, size=(30, 1))
+    d = rng.uniform(1, 500, size=(30, 30))
+    P, outgoing, incoming = get_inputs(n=30)
+    with pytest.warns(RuntimeWarning, match="did not converge"):
+        MigrationModels.constrainedModel("gravity", origins, origins, d, outgoing, incoming, alpha=2.0, maxIter=2)
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        T, a, b = MigrationModels.constrainedModel("gravity", origins, origins, d, outgoing, incoming, alpha=2.0)
+    assert np.allclose(T.sum(axis=1), outgoing, rtol=1e-4)